@@ -0,0 +1,154 @@
+# agent_metrics.py
+import time
+import threading
+from langchain.callbacks.base import BaseCallbackHandler
+
+# Name of the pseudo-tool LangChain runs when handle_parsing_errors catches a malformed reply
+PARSE_ERROR_TOOL = "_Exception"
+
+
+class AgentRunCounter(BaseCallbackHandler):
+    """Per-invocation counter: LLM calls, tool calls and parse-error retries of ONE agent run."""
+
+    def __init__(self):
+        self.llm_calls = 0
+        self.tool_calls = 0
+        self.parse_errors = 0
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.llm_calls += 1
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.llm_calls += 1
+
+    def on_agent_action(self, action, **kwargs):
+        if action.tool == PARSE_ERROR_TOOL:
+            self.parse_errors += 1
+        else:
+            self.tool_calls += 1
+
+
+class AgentMetrics:
+    """
+    Aggregates AgentRunCounter results per (executor, mode), so ReAct and native
+    tool calling can be compared on the same workload (see /api/metrics).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._runs = {}
+
+    def invoke(self, executor, name, mode, payload, callbacks=None):
+        """Runs executor.invoke(payload) with a fresh counter attached and records the run."""
+        counter = AgentRunCounter()
+        started = time.monotonic()
+        failed = True
+        try:
+            result = executor.invoke(payload, config={"callbacks": list(callbacks or []) + [counter]})
+            failed = False
+            return result
+        finally:
+            self.record(name, mode, counter, time.monotonic() - started, failed)
+
+    def record(self, name, mode, counter, elapsed, failed=False):
+        with self._lock:
+            s = self._runs.setdefault(f"{name}:{mode}", {
+                "runs": 0, "failed": 0, "llm_calls": 0, "tool_calls": 0, "parse_errors": 0, "seconds": 0.0
+            })
+            s["runs"] += 1
+            s["failed"] += int(failed)
+            s["llm_calls"] += counter.llm_calls
+            s["tool_calls"] += counter.tool_calls
+            s["parse_errors"] += counter.parse_errors
+            s["seconds"] += elapsed
+
+    def stats(self):
+        with self._lock:
+            out = {}
+            for key, s in self._runs.items():
+                runs = s["runs"] or 1
+                out[key] = {
+                    "runs": s["runs"],
+                    "failed": s["failed"],
+                    "parse_error_retries": s["parse_errors"],
+                    "avg_llm_calls": round(s["llm_calls"] / runs, 2),
+                    "avg_tool_calls": round(s["tool_calls"] / runs, 2),
+                    "avg_parse_errors": round(s["parse_errors"] / runs, 2),
+                    "avg_seconds": round(s["seconds"] / runs, 2),
+                }
+            return out
+
+
+class ToolObservationCapture(BaseCallbackHandler):
+    """
+    Per-invocation record of every tool call (name, input, output) of ONE agent run,
+    so the caller can reuse what the agent already fetched instead of calling the tool again.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self.observations = []  # [(tool_name, tool_input, output)]
+
+    def on_tool_start(self, serialized, input_str, run_id=None, inputs=None, **kwargs):
+        name = (serialized or {}).get("name") or kwargs.get("name")
+        # Structured (tool calling) tools report their arguments as a dict
+        if isinstance(inputs, dict) and len(inputs) == 1:
+            input_str = next(iter(inputs.values()))
+        self._pending[run_id] = (name, input_str)
+
+    def on_tool_end(self, output, run_id=None, **kwargs):
+        name, tool_input = self._pending.pop(run_id, (kwargs.get("name"), None))
+        self.observations.append((name, tool_input, str(getattr(output, "content", output))))
+
+    def on_tool_error(self, error, run_id=None, **kwargs):
+        self._pending.pop(run_id, None)
+
+    def latest(self, tool_name, tool_input=None):
+        """Output of the most recent call to tool_name (optionally with that exact input, case-insensitive), or None."""
+        wanted = tool_input.strip().lower() if tool_input is not None else None
+        for name, observed_input, output in reversed(self.observations):
+            if name != tool_name:
+                continue
+            if wanted is None or str(observed_input or "").strip().strip('"\'').lower() == wanted:
+                return output
+        return None
+
+
+class DependencySlotHandler(BaseCallbackHandler):
+    """
+    Holds a per-dependency concurrency slot (tools_concurrency) for the duration of every LLM
+    call. Attached to the LLM itself, so agent runs and direct llm.invoke calls share the cap.
+    """
+
+    def __init__(self, limiter, dependency="llm"):
+        self.limiter = limiter
+        self.dependency = dependency
+        self._held = set()
+        self._lock = threading.Lock()
+
+    def _acquire(self, run_id):
+        self.limiter.acquire(self.dependency)
+        with self._lock:
+            self._held.add(run_id)
+
+    def _release(self, run_id):
+        with self._lock:
+            if run_id not in self._held:
+                return
+            self._held.discard(run_id)
+        self.limiter.release(self.dependency)
+
+    def on_llm_start(self, serialized, prompts, run_id=None, **kwargs):
+        self._acquire(run_id)
+
+    def on_chat_model_start(self, serialized, messages, run_id=None, **kwargs):
+        self._acquire(run_id)
+
+    def on_llm_end(self, response, run_id=None, **kwargs):
+        self._release(run_id)
+
+    def on_llm_error(self, error, run_id=None, **kwargs):
+        self._release(run_id)
+
+
+agent_metrics = AgentMetrics()
@@ -0,0 +1,126 @@
+# bench_history_search.py
+"""
+Benchmark: history search at 100k records, full scan (old behaviour) vs inverted index (top 50).
+
+    python bench_history_search.py [num_records]
+
+SQLite backend at 1M records: point lookups, date ranges and ranked text search.
+
+    python bench_history_search.py --sqlite [num_records]
+
+Runs against a throwaway ledger / database in a temp directory; does not touch the real history.
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+from tools_history import HistoryLedger, HistorySearchIndex, SqliteHistoryStore
+
+FIRST = ["Avi", "Barbara", "Carlos", "Dana", "Elena", "Farid", "Grace", "Hiro", "Ines", "Jamal"]
+LAST = ["Green", "Levy", "Ortiz", "Smith", "Nakamura", "Okafor", "Rossi", "Chen", "Novak", "Patel"]
+COMPANY = ["United Oil", "Edge Communications", "Burlington Textiles", "GenePoint", "Grand Hotels", "Pyramid Construction", "Dickenson", "Express Logistics"]
+QUERIES = ["Barbara", "United Oil", "avi.gr", "genepoint installation", "006dm00000", "Hiro Nakamura", "nomatchatall"]
+
+
+def make_record(i):
+    first, last, company = random.choice(FIRST), random.choice(LAST), random.choice(COMPANY)
+    envelope = f"{random.getrandbits(128):032x}"
+    return {
+        "Id": f"006dm{i:013d}",
+        "Name": f"{company} Installation {i}",
+        "Amount": str(random.randint(5, 500) * 1000),
+        "PrimaryContactName": f"{first} {last}",
+        "PrimaryContactEmail": f"{first.lower()}.{last.lower()}@{company.split()[0].lower()}.com",
+        "CloseDate": f"2025-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}",
+        "Status": "SOW Sent",
+        "EnvelopeId": envelope,
+        "DocuSignLink": f"https://apps-d.docusign.com/send/documents/details/{envelope}"
+    }
+
+
+def full_scan(history, query):
+    """The previous search_history_for_chat matching logic."""
+    terms = query.lower().split()
+    return [r for r in history if all(t in " ".join(str(v).lower() for v in r.values()) for t in terms)]
+
+
+def timed(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - started) / repeat * 1000, result
+
+
+def main_sqlite(num_records):
+    random.seed(42)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SqliteHistoryStore(path=os.path.join(tmp, "history.db"), import_paths=())
+        started = time.perf_counter()
+        for offset in range(0, num_records, 50_000):
+            store._bulk_append([make_record(i) for i in range(offset, min(offset + 50_000, num_records))])
+        print(f"Loaded {store.count():,} records in {time.perf_counter() - started:.1f}s "
+              f"({os.path.getsize(store.path) / 2**20:,.0f} MB)\n")
+
+        sample = random.sample(range(num_records), 200)
+        opp_ids = [f"006dm{i:013d}" for i in sample]
+        envelopes = [store.get_by_opportunity(opp_id)[0]["EnvelopeId"] for opp_id in opp_ids]
+        # (name, fn returning one result list per operation)
+        cases = [
+            ("get_by_opportunity", lambda: [store.get_by_opportunity(opp_id) for opp_id in opp_ids]),
+            ("get_by_envelope", lambda: [[store.get_by_envelope(env_id)] for env_id in envelopes]),
+            ("in_date_range 1 day (all)", lambda: [store.in_date_range("2025-06-15", "2025-06-15")]),
+            ("in_date_range 1 week (all)", lambda: [store.in_date_range("2025-06-08", "2025-06-14")]),
+            ("in_date_range 1 week (limit 50)", lambda: [store.in_date_range("2025-06-08", "2025-06-14", limit=50)]),
+        ]
+        cases += [(f"search {query!r} (top 10)", lambda q=query: [store.search(q, limit=10)]) for query in QUERIES]
+        cases += [
+            ("search by Opportunity ID", lambda: [store.search(opp_id, limit=10) for opp_id in opp_ids]),
+            ("search match_any (chat context)", lambda: [store.search("status of grace rossi grand hotels", limit=10, match_any=True)]),
+        ]
+
+        print(f"{'query':<40}{'ms/op':>10}{'results':>9}")
+        for name, fn in cases:
+            fn()  # Warm the page cache
+            total_ms, results = timed(fn, 5)
+            print(f"{name:<40}{total_ms / len(results):>10.3f}{len(results[0]):>9}")
+
+        append_ms, _ = timed(lambda: store.append(make_record(num_records)), 20)
+        print(f"\nappend (one transaction, FTS trigger included): {append_ms:.2f} ms")
+
+
+def main():
+    if "--sqlite" in sys.argv:
+        args = [a for a in sys.argv[1:] if a != "--sqlite"]
+        return main_sqlite(int(args[0]) if args else 1_000_000)
+
+    num_records = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    random.seed(42)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ledger = HistoryLedger(path=os.path.join(tmp, "history.jsonl"), legacy_path=None, compact_every=10**9)
+        started = time.perf_counter()
+        with open(ledger.path, "w") as f:  # Bulk-load the fixture directly
+            for i in range(num_records):
+                f.write(json.dumps(make_record(i)) + "\n")
+        history = ledger.records()
+        print(f"Loaded {len(history):,} records in {time.perf_counter() - started:.1f}s")
+
+        index = HistorySearchIndex(ledger)
+        build_ms, _ = timed(index.sync, 1)
+        print(f"Index build: {build_ms:,.0f} ms ({len(index._postings):,} tokens)\n")
+
+        print(f"{'query':<26}{'scan ms':>10}{'index ms':>10}{'speedup':>9}{'matches':>9}")
+        for query in QUERIES:
+            scan_ms, scan_hits = timed(lambda: full_scan(history, query), 3)
+            index_ms, index_hits = timed(lambda: index.search(query, limit=50), 20)
+            print(f"{query:<26}{scan_ms:>10.1f}{index_ms:>10.2f}{scan_ms / max(index_ms, 1e-6):>8.0f}x{len(scan_hits):>9}")
+
+        append_ms, _ = timed(lambda: ledger.append(make_record(num_records)), 1)
+        print(f"\nAppend + incremental index update: {append_ms:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+# chat_router.py
+import os
+import re
+import math
+import threading
+from collections import Counter
+
+# Intents the router can answer without the LLM. They map 1:1 to the UI actions the chat
+# agent signals with its [RENDER_TABLE] / [RENDER_HISTORY] / [RENDER_SEARCH] / [TRIGGER_CLOSING] tags.
+GREETING = "greeting"
+THANKS = "thanks"
+FETCH_OPEN = "fetch_open"
+FETCH_HISTORY = "fetch_history"
+SEARCH_HISTORY = "search_history"
+TRIGGER_CLOSING = "trigger_closing"
+
+# Anything with these words is not a plain command ("don't close", "why was ...") -> ask the LLM
+_UNSURE = re.compile(r"\b(not|don'?t|do not|never|why|how come|didn'?t|wasn'?t|if|unless|except|instead|but)\b", re.I)
+
+# History searches must name the history; these words mean a live Salesforce/DocuSign lookup
+# ("find the opportunity details for 006..", "find open deals") -> never a history search
+_NOT_HISTORY = r"(?!.*\b(?:warranty|line\s*items?|details?|open|active)\b)"
+
+# Ordered: the first matching pattern wins. Patterns only cover short imperative phrasings.
+INTENT_PATTERNS = [
+    (SEARCH_HISTORY, re.compile(_NOT_HISTORY + r"^\s*(?:search|find|look\s*up|lookup)\s+(?:(?:in|through)\s+)?(?:the\s+|our\s+|my\s+)?(?:sow\s+|deal\s+)?(?:history|past deals|sows?)\s+(?:(?:for|of|with|about)\s+)?(?P<query>[^?]+?)\s*\??\s*$", re.I)),
+    (SEARCH_HISTORY, re.compile(_NOT_HISTORY + r"^\s*(?:show\s+(?:me\s+)?)?(?:the\s+)?(?:history|past deals|sows?)\s+(?:for|of|with)\s+(?P<query>[^?]+?)\s*\??\s*$", re.I)),
+    (FETCH_HISTORY, re.compile(r"^\s*(?:(?:show|display|open|view|fetch|load|get|list)\s+(?:me\s+)?)?(?:the\s+)?(?:full|entire|whole|complete|all)?\s*(?:sow\s+|deal\s+)?(?:history|log)(?:\s+(?:log|table))?\s*[.!?]*\s*$", re.I)),
+    (FETCH_OPEN, re.compile(r"^\s*(?:(?:please\s+)?(?:show|list|find|fetch|load|get|display|pull\s+up|refresh)\s+(?:me\s+)?)?(?:all\s+)?(?:the\s+)?(?:my\s+)?(?:open|active|new|current)\s+(?:projects?|deals?|opportunit(?:y|ies)|opps|pipeline)\s*[.!?]*\s*$", re.I)),
+    (FETCH_OPEN, re.compile(r"^\s*what(?:'s| is| are)\s+(?:in\s+)?(?:the\s+|my\s+)?(?:open\s+|active\s+)?(?:pipeline|open (?:projects|deals|opportunities))\s*\??\s*$", re.I)),
+    (TRIGGER_CLOSING, re.compile(r"^\s*(?:please\s+)?(?:close|send|process|finali[sz]e|start\s+closing)\s+(?:the\s+|these\s+|all\s+)?(?:selected\s+)?(?:deals?|sows?|opportunit(?:y|ies)|opps|contracts?|them|it)?\s*(?:now)?\s*[.!]*\s*$", re.I)),
+    (GREETING, re.compile(r"^\s*(?:hi|hello|hey|hiya|howdy|good\s+(?:morning|afternoon|evening))(?:\s+(?:there|team|closer))?\s*[!.,]*\s*$", re.I)),
+    (THANKS, re.compile(r"^\s*(?:thanks|thank\s+you|thx|cheers|great,?\s+thanks)(?:\s+(?:a lot|so much))?\s*[!.,]*\s*$", re.I)),
+]
+
+# Training phrases for the optional local classifier (no query extraction, so no SEARCH_HISTORY).
+# "other" soaks up everything the agent should keep answering.
+CLASSIFIER_EXAMPLES = {
+    FETCH_OPEN: [
+        "show me the open opportunities", "which deals are still open", "load the active projects",
+        "what can I work on today", "list new deals to close", "pull the current pipeline from salesforce",
+        "any open projects", "show active deals please",
+    ],
+    FETCH_HISTORY: [
+        "show the full history", "display all past deals", "open the sow log", "everything we sent so far",
+        "show me every sow we sent", "the complete deal history table",
+    ],
+    TRIGGER_CLOSING: [
+        "close the selected deals", "send the sows now", "go ahead and send them", "start the closing process",
+        "generate and send contracts for these", "kick off the agents for the selected ones",
+    ],
+    GREETING: ["hi", "hello there", "hey closer", "good morning", "hey how are you", "hello how is it going"],
+    "other": [
+        "did we send the sow for united oil", "give me the docusign link for acme", "what is the warranty status of agreement",
+        "how much was the burlington deal", "who is the contact for edge communications", "tell me a joke",
+        "when did we close the genwatt deal", "what does a fixed fee sow include", "is the grand hotels contract signed",
+        "what did barbara sign last week",
+    ],
+}
+
+_TOKEN = re.compile(r"[a-z0-9']+")
+
+
+class NaiveBayesIntentClassifier:
+    """Tiny multinomial Naive Bayes over word unigrams + bigrams. Trains in microseconds, no dependencies."""
+
+    def __init__(self, examples=CLASSIFIER_EXAMPLES, alpha=0.5):
+        self.alpha = alpha
+        self.word_counts = {}
+        self.totals = {}
+        self.priors = {}
+        vocabulary = set()
+        total_examples = sum(len(v) for v in examples.values())
+        for label, phrases in examples.items():
+            counts = Counter()
+            for phrase in phrases:
+                counts.update(self._features(phrase))
+            self.word_counts[label] = counts
+            self.totals[label] = sum(counts.values())
+            self.priors[label] = math.log(len(phrases) / total_examples)
+            vocabulary.update(counts)
+        self.vocabulary_size = len(vocabulary)
+
+    @staticmethod
+    def _features(text):
+        words = _TOKEN.findall(text.lower())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def predict(self, text):
+        """Returns (label, probability)."""
+        features = [f for f in self._features(text) if any(f in c for c in self.word_counts.values())]
+        if not features:
+            return "other", 0.0
+        scores = {}
+        for label, counts in self.word_counts.items():
+            denominator = self.totals[label] + self.alpha * self.vocabulary_size
+            scores[label] = self.priors[label] + sum(math.log((counts[f] + self.alpha) / denominator) for f in features)
+        best = max(scores, key=scores.get)
+        normalizer = sum(math.exp(s - scores[best]) for s in scores.values())
+        return best, 1.0 / normalizer
+
+
+class ChatRouter:
+    """
+    Fast path in front of the chat agent: answers the common, fully determined intents
+    (greetings, open projects, full history, history search, close deals) with no LLM call.
+    route() returns (intent, query) or None when the message should go to the agent.
+    """
+
+    def __init__(self, use_classifier=None, min_confidence=None, max_words=None):
+        if use_classifier is None:
+            use_classifier = os.getenv("CHAT_ROUTER_CLASSIFIER", "false").lower() == "true"
+        self.classifier = NaiveBayesIntentClassifier() if use_classifier else None
+        self.min_confidence = min_confidence if min_confidence is not None else float(os.getenv("CHAT_ROUTER_MIN_CONFIDENCE", "0.9"))
+        self.max_words = max_words or int(os.getenv("CHAT_ROUTER_MAX_WORDS", "12"))
+
+        self._lock = threading.Lock()
+        self.handled = Counter()
+        self.escalated = 0
+        self.router_seconds = 0.0
+        self.agent_seconds = 0.0
+
+    def route(self, message):
+        text = (message or "").strip()
+        if not text or _UNSURE.search(text) or len(text.split()) > self.max_words:
+            return None
+
+        for intent, pattern in INTENT_PATTERNS:
+            match = pattern.match(text)
+            if match:
+                return intent, (match.groupdict().get("query") or "").strip() or None
+
+        if self.classifier:
+            label, probability = self.classifier.predict(text)
+            if label != "other" and probability >= self.min_confidence:
+                return label, None
+        return None
+
+    # --- METRICS ---
+
+    def record_fast_path(self, intent, elapsed):
+        with self._lock:
+            self.handled[intent] += 1
+            self.router_seconds += elapsed
+            saved = self._avg_agent_seconds() - elapsed
+        print(f"⚡ ROUTER: '{intent}' answered without the LLM in {elapsed * 1000:.1f}ms (saved ~{max(saved, 0):.1f}s)")
+
+    def record_agent(self, elapsed):
+        with self._lock:
+            self.escalated += 1
+            self.agent_seconds += elapsed
+
+    def _avg_agent_seconds(self):
+        return self.agent_seconds / self.escalated if self.escalated else 0.0
+
+    def stats(self):
+        with self._lock:
+            handled = sum(self.handled.values())
+            avg_agent = self._avg_agent_seconds()
+            return {
+                "handled": handled,
+                "handled_by_intent": dict(self.handled),
+                "escalated": self.escalated,
+                "fast_path_ratio": round(handled / (handled + self.escalated), 3) if handled + self.escalated else 0.0,
+                "avg_router_ms": round(1000 * self.router_seconds / handled, 2) if handled else 0.0,
+                "avg_agent_seconds": round(avg_agent, 2),
+                "estimated_seconds_saved": round(max(handled * avg_agent - self.router_seconds, 0), 1),
+            }
+
+
+chat_router = ChatRouter()
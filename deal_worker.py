@@ -0,0 +1,153 @@
+# deal_worker.py
+"""
+Worker process for the durable deal job queue (job_queue.py).
+
+Run standalone:   python deal_worker.py --processes 4
+or let listener.py spawn DEAL_WORKER_PROCESSES of them on startup.
+Each process runs jobs on DEAL_WORKER_THREADS threads and claims more as threads free up.
+Jobs are claimed in groups from one task, whose Salesforce data is prefetched in bulk.
+Finalize jobs are claimed up to DEAL_WORKER_FINALIZE_BATCH at a time and run as one batch on a
+single thread, so the stage changes of a burst of signed envelopes go out together.
+"""
+import os
+import time
+import socket
+import argparse
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+WORKER_THREADS = int(os.getenv("DEAL_WORKER_THREADS", "4"))
+POLL_SECONDS = float(os.getenv("DEAL_WORKER_POLL_SECONDS", "1.0"))
+FINALIZE_BATCH = int(os.getenv("DEAL_WORKER_FINALIZE_BATCH", "100"))
+
+
+def run_worker(worker_name=None, db_path=None, rate_share=1):
+    """Main loop of one worker process. Heavy imports happen here, in the child."""
+    from tools_concurrency import rate_limits
+    rate_limits.set_share(rate_share)
+    from main import start_deal_process, finalize_deals, batch_drafting_enabled, prepare_sow_drafts
+    from tools import prefetch_opportunity_snapshot
+    from task_events import AgentLogHandler
+    from job_queue import JobQueue
+    from tools import history_store
+
+    queue = JobQueue(db_path)
+    worker = worker_name or f"{socket.gethostname()}:{os.getpid()}"
+    print(f"👷 Deal worker {worker} started ({WORKER_THREADS} threads, queue {queue.path}).")
+
+    def heartbeat():
+        while True:
+            time.sleep(max(queue.lease_seconds / 3, 1))
+            try:
+                queue.renew_leases(worker)
+            except Exception as e:
+                print(f"⚠️ [{worker}] Lease renewal failed: {e}")
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+
+    def run_deal(job, snapshot, drafted):
+        params = job["payload"]
+        opp_id = job["item_key"]
+        log_handler = AgentLogHandler(job["task_id"], opp_id, queue.publisher(job["task_id"], opp_id, job["job_id"]))
+        sent_before = {r.get("EnvelopeId") for r in history_store.get_by_opportunity(opp_id)}
+        # Progress goes through the queue's events, so the in-process task dict stays empty
+        start_deal_process(opp_id, params["template_id"], params["signer_role"], job["task_id"], {}, threading.Lock(),
+                           log_handler, params["use_docgen"], snapshot,
+                           params.get("force_regenerate", False) and opp_id not in drafted)
+        if not log_handler.envelope_id and log_handler.send_attempted:
+            # The Envelope ID is parsed from tool output; the SOW tools also log every sent
+            # envelope to the history store, so a missed parse is recovered from there
+            sent_now = [r.get("EnvelopeId") for r in history_store.get_by_opportunity(opp_id)
+                        if r.get("EnvelopeId") not in sent_before and r.get("EnvelopeId") not in (None, "N/A")]
+            if sent_now:
+                log_handler.save_envelope_id(sent_now[0])
+        succeeded = bool(log_handler.envelope_id)
+        queue.finish(job, succeeded, None if succeeded else "No Envelope ID was captured")
+
+    def run_finalize_group(jobs):
+        finalized = finalize_deals([job["payload"] for job in jobs])
+        for job in jobs:
+            succeeded = finalized.get(job["payload"]["envelope_id"], False)
+            queue.finish(job, succeeded, None if succeeded else "Finalization failed")
+
+    def submit_group(pool, jobs):
+        """
+        Starts one claimed group (same task and kind). Returns [(future, [jobs it runs])]:
+        one future per deal, whose Salesforce prefetch and batch drafting are per group,
+        or one future for a whole finalize group.
+        """
+        if jobs[0]["kind"] == "finalize":
+            return [(pool.submit(run_finalize_group, jobs), jobs)]
+
+        task_id = jobs[0]["task_id"]
+        opp_ids = [job["item_key"] for job in jobs]
+        queue.add_event(task_id, None, "step", "📦 Prefetching Salesforce data...")
+        snapshot = prefetch_opportunity_snapshot(opp_ids)
+
+        drafted = set()
+        if batch_drafting_enabled(len(opp_ids)):
+            queue.add_event(task_id, None, "step", f"✍️ Drafting {len(opp_ids)} SOWs in batches...")
+            try:
+                drafted = prepare_sow_drafts(opp_ids, snapshot, jobs[0]["payload"].get("force_regenerate", False))
+            except Exception as e:
+                print(f"⚠️ Batch drafting failed, each deal drafts on its own: {e}")
+
+        return [(pool.submit(run_deal, job, snapshot, drafted), [job]) for job in jobs]
+
+    # Jobs are claimed as threads free up, so one slow deal never idles the rest of the pool
+    running = {}  # future -> jobs
+    with ThreadPoolExecutor(max_workers=WORKER_THREADS) as pool:
+        while True:
+            jobs = []
+            free = WORKER_THREADS - len(running)
+            if free > 0:
+                try:
+                    jobs = queue.claim_batch(worker, limit=free, kind_limits={"finalize": FINALIZE_BATCH})
+                except Exception as e:
+                    print(f"⚠️ [{worker}] Could not claim jobs: {e}")
+                for future, group in (submit_group(pool, jobs) if jobs else []):
+                    running[future] = group
+
+            if not running:
+                time.sleep(POLL_SECONDS)
+                continue
+            if jobs and len(running) < WORKER_THREADS:
+                continue  # Still room: try to claim another group right away
+
+            done, _ = wait(running, timeout=POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in done:
+                group = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    for job in group:
+                        print(f"❌ [{worker}] Job {job['item_key']} crashed: {e}")
+                        queue.finish(job, False, f"{type(e).__name__} - {e}")
+
+
+def start_worker_processes(count, db_path=None, rate_share=None):
+    """
+    Spawns 'count' daemon worker processes (used by listener.py). Returns the Process objects.
+    Each gets 1/rate_share of every API quota (default: one share per worker plus the web process).
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for index in range(count):
+        process = context.Process(target=run_worker, args=(None, db_path, rate_share or count + 1), name=f"deal-worker-{index + 1}", daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drain the durable deal job queue.")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("DEAL_WORKER_PROCESSES", "2")))
+    parser.add_argument("--db", default=None, help="Queue database (default DEAL_QUEUE_DB or deal_jobs.db)")
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_worker(db_path=args.db, rate_share=int(os.getenv("RATE_LIMIT_SHARE", "1")))
+    else:
+        for process in start_worker_processes(args.processes, args.db, int(os.getenv("RATE_LIMIT_SHARE", str(args.processes)))):
+            process.join()
@@ -0,0 +1,309 @@
+# job_queue.py
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from task_events import new_task_state, apply_task_event
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class JobQueue:
+    """
+    Durable deal job queue (SQLite, WAL), shared by the web process and the worker processes.
+
+    One row per unit of work ("deal" = send the SOW for one Opportunity, "finalize" = attach the
+    signed document for one envelope) with its state, attempts and Envelope ID. Workers lease
+    jobs; a job whose worker died is picked up again once its lease expires, so nothing queued
+    is lost on a crash or redeploy. A deal job is only ever retried if it failed before a
+    SOW-sending tool started (send_started_at): after that, a second run could email the
+    customer a second SOW, so it fails for a human to check instead. Progress (steps, logs, envelope IDs) is appended to
+    job_events, which the web process tails to serve /task-status.
+    """
+
+    def __init__(self, path=None, lease_seconds=None, max_attempts=None):
+        self.path = path or os.getenv("DEAL_QUEUE_DB", "deal_jobs.db")
+        self.lease_seconds = lease_seconds or int(os.getenv("DEAL_JOB_LEASE_SECONDS", "300"))
+        self.max_attempts = max_attempts or int(os.getenv("DEAL_JOB_MAX_ATTEMPTS", "2"))
+        self._lock = threading.Lock()
+        # Autocommit mode: every write is its own transaction unless we BEGIN explicitly
+        self._conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                total INTEGER NOT NULL,
+                current_step TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT,
+                kind TEXT NOT NULL,
+                item_key TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                envelope_id TEXT,
+                error TEXT,
+                worker TEXT,
+                lease_until REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, job_id);
+            CREATE INDEX IF NOT EXISTS jobs_task ON jobs(task_id);
+            CREATE TABLE IF NOT EXISTS job_events (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT,
+                item_key TEXT,
+                kind TEXT NOT NULL,
+                value TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS job_events_task ON job_events(task_id, event_id);
+        """)
+        # Queues created before send tracking
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "send_started_at" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN send_started_at REAL")
+
+    # --- ENQUEUE ---
+
+    def enqueue_task(self, task_id, kind, items, current_step="⏳ Queued..."):
+        """Creates a task and one queued job per (item_key, payload) in a single transaction."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO tasks (task_id, total, current_step, created_at) VALUES (?, ?, ?, ?)",
+                    (task_id, len(items), current_step, now)
+                )
+                self._conn.executemany(
+                    "INSERT INTO jobs (task_id, kind, item_key, payload, state, max_attempts, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(task_id, kind, key, json.dumps(payload), QUEUED, self.max_attempts, now, now) for key, payload in items]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def enqueue(self, kind, item_key, payload):
+        """Queues one job that does not belong to a UI task (e.g. webhook finalization)."""
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (task_id, kind, item_key, payload, state, max_attempts, created_at, updated_at) "
+                "VALUES (NULL, ?, ?, ?, ?, ?, ?, ?)",
+                (kind, item_key, json.dumps(payload), QUEUED, self.max_attempts, now, now)
+            )
+            return cursor.lastrowid
+
+    def queued_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+
+    # --- WORKER SIDE ---
+
+    def claim_batch(self, worker, limit=1, kind_limits=None):
+        """
+        Leases up to 'limit' jobs of the oldest waiting task (same task and kind, so the worker
+        can prefetch and draft them together); 'kind_limits' ({kind: limit}) overrides 'limit'
+        for the kind that comes up. Expired leases are reclaimed here: a job that
+        already has an Envelope ID is marked succeeded instead of sending a second SOW, and a
+        job that started sending or is out of attempts is marked failed.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._reap_expired(now)
+                first = self._conn.execute(
+                    "SELECT task_id, kind FROM jobs WHERE state = ? OR (state = ? AND lease_until < ?) ORDER BY job_id LIMIT 1",
+                    (QUEUED, RUNNING, now)
+                ).fetchone()
+                if not first:
+                    self._conn.execute("COMMIT")
+                    return []
+                rows = self._conn.execute(
+                    "SELECT * FROM jobs WHERE task_id IS ? AND kind = ? AND (state = ? OR (state = ? AND lease_until < ?)) "
+                    "ORDER BY job_id LIMIT ?",
+                    (first["task_id"], first["kind"], QUEUED, RUNNING, now, (kind_limits or {}).get(first["kind"], limit))
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE jobs SET state = ?, attempts = attempts + 1, worker = ?, lease_until = ?, updated_at = ? WHERE job_id = ?",
+                    [(RUNNING, worker, now + self.lease_seconds, now, row["job_id"]) for row in rows]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [dict(row, payload=json.loads(row["payload"]), attempts=row["attempts"] + 1) for row in rows]
+
+    def _reap_expired(self, now):
+        # Called inside the claim transaction
+        expired = self._conn.execute(
+            "SELECT job_id, task_id, item_key, envelope_id, attempts, max_attempts, send_started_at FROM jobs "
+            "WHERE state = ? AND lease_until < ? "
+            "AND (envelope_id IS NOT NULL OR send_started_at IS NOT NULL OR attempts >= max_attempts)",
+            (RUNNING, now)
+        ).fetchall()
+        for row in expired:
+            if row["envelope_id"]:
+                state, error = SUCCEEDED, None
+            elif row["send_started_at"]:
+                state, error = FAILED, "Worker lost while sending the SOW; not retried (check DocuSign before re-sending)"
+            else:
+                state, error = FAILED, f"Worker lost after {row['attempts']} attempt(s)"
+            self._finish_locked(row["job_id"], row["task_id"], row["item_key"], state, error, now)
+
+    def renew_leases(self, worker):
+        """Heartbeat: extends the lease of every job this worker is still running."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE worker = ? AND state = ?",
+                (now + self.lease_seconds, worker, RUNNING)
+            )
+
+    def set_envelope(self, job_id, envelope_id):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET envelope_id = ?, updated_at = ? WHERE job_id = ?", (envelope_id, time.time(), job_id)
+            )
+
+    def mark_send_started(self, job_id):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET send_started_at = COALESCE(send_started_at, ?) WHERE job_id = ?", (time.time(), job_id)
+            )
+
+    def finish(self, job, succeeded, error=None):
+        """
+        Marks a claimed job done. A failure is re-queued until it runs out of attempts, unless
+        the job already started sending its SOW.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                send_started = self._conn.execute(
+                    "SELECT send_started_at FROM jobs WHERE job_id = ?", (job["job_id"],)
+                ).fetchone()["send_started_at"]
+                if not succeeded and send_started:
+                    error = f"{error or 'Failed'} after the SOW send started; not retried (check DocuSign before re-sending)"
+                if not succeeded and not send_started and job["attempts"] < job["max_attempts"]:
+                    self._conn.execute(
+                        "UPDATE jobs SET state = ?, error = ?, worker = NULL, lease_until = NULL, updated_at = ? WHERE job_id = ?",
+                        (QUEUED, error, now, job["job_id"])
+                    )
+                    self._add_event_locked(job["task_id"], job["item_key"], "log",
+                                           f"[{job['item_key']}] 🔁 Retrying (attempt {job['attempts'] + 1} of {job['max_attempts']})...", now)
+                else:
+                    self._finish_locked(job["job_id"], job["task_id"], job["item_key"], SUCCEEDED if succeeded else FAILED, error, now)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _finish_locked(self, job_id, task_id, item_key, state, error, now):
+        self._conn.execute(
+            "UPDATE jobs SET state = ?, error = ?, lease_until = NULL, updated_at = ? WHERE job_id = ?",
+            (state, error, now, job_id)
+        )
+        if state == FAILED and error:
+            self._add_event_locked(task_id, item_key, "log", f"[{item_key}] ❌ {error}", now)
+        self._add_event_locked(task_id, item_key, "job_finished", state, now)
+
+    # --- PROGRESS EVENTS ---
+
+    def add_event(self, task_id, item_key, kind, value):
+        with self._lock:
+            self._add_event_locked(task_id, item_key, kind, value, time.time())
+
+    def _add_event_locked(self, task_id, item_key, kind, value, now):
+        if task_id is None:
+            return
+        self._conn.execute(
+            "INSERT INTO job_events (task_id, item_key, kind, value, created_at) VALUES (?, ?, ?, ?, ?)",
+            (task_id, item_key, kind, value, now)
+        )
+
+    def publisher(self, task_id, item_key, job_id=None):
+        """fn(kind, value) for an AgentLogHandler running in a worker; envelope and sending events are also saved on the job."""
+        def publish(kind, value):
+            if kind == "sending":
+                if job_id is not None:
+                    self.mark_send_started(job_id)
+                return
+            if kind == "envelope" and job_id is not None:
+                self.set_envelope(job_id, value)
+            self.add_event(task_id, item_key, kind, value)
+        return publish
+
+    def events_since(self, event_id, limit=500):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(
+                "SELECT event_id, task_id, item_key, kind, value FROM job_events WHERE event_id > ? ORDER BY event_id LIMIT ?",
+                (event_id, limit)
+            ).fetchall()]
+
+    def last_event_id(self):
+        with self._lock:
+            return self._conn.execute("SELECT COALESCE(MAX(event_id), 0) FROM job_events").fetchone()[0]
+
+    # --- READ SIDE ---
+
+    def task_snapshot(self, task_id):
+        """Rebuilds the /task-status view of a task from its events (None if unknown), e.g. after a restart."""
+        with self._lock:
+            task_row = self._conn.execute("SELECT total, current_step FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if not task_row:
+                return None
+            events = self._conn.execute(
+                "SELECT event_id, item_key, kind, value FROM job_events WHERE task_id = ? ORDER BY event_id", (task_id,)
+            ).fetchall()
+            opportunity_ids = [row[0] for row in self._conn.execute(
+                "SELECT item_key FROM jobs WHERE task_id = ? ORDER BY job_id", (task_id,)
+            ).fetchall()]
+        task = new_task_state(task_row["total"], task_row["current_step"])
+        task["opportunity_ids"] = opportunity_ids
+        task["last_event_id"] = 0
+        for event in events:
+            apply_task_event(task, event["item_key"], event["kind"], event["value"])
+            task["last_event_id"] = event["event_id"]
+        return task
+
+    def positions(self, task_id):
+        """{item_key: {"state": "running"} | {"state": "queued", "position": n}} (position is 1-based, queue-wide)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT j.item_key, j.state, "
+                "(SELECT COUNT(*) FROM jobs q WHERE q.state = ? AND q.job_id <= j.job_id) AS position "
+                "FROM jobs j WHERE j.task_id = ? AND j.state IN (?, ?)",
+                (QUEUED, task_id, QUEUED, RUNNING)
+            ).fetchall()
+        return {row["item_key"]: {"state": RUNNING} if row["state"] == RUNNING else {"state": QUEUED, "position": row["position"]}
+                for row in rows}
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            oldest = self._conn.execute("SELECT MIN(created_at) FROM jobs WHERE state = ?", (QUEUED,)).fetchone()[0]
+        return {
+            "queued": counts.get(QUEUED, 0),
+            "running": counts.get(RUNNING, 0),
+            "succeeded": counts.get(SUCCEEDED, 0),
+            "failed": counts.get(FAILED, 0),
+            "oldest_queued_seconds": round(time.time() - oldest, 1) if oldest else 0.0,
+        }
@@ -3,157 +3,182 @@ import re # <--- ADD THIS AT THE TOP
 from main import start_deal_process
 import os
 import json
-from flask import Flask, request, Response, render_template, redirect, url_for,jsonify
-from tools import get_open_opportunities, update_contact_email,get_local_history
+from flask import Flask, request, Response, render_template, redirect, url_for,jsonify, stream_with_context
+from tools import get_open_opportunities, update_contact_email,get_local_history, prefetch_opportunity_snapshot, page_open_opportunities
 import xmltodict
 import threading
 import uuid
+import time
+import queue
 
 # Import the agent functions from your main.py file
-from main import start_deal_process, finalize_deal,handle_chat_interaction
+from main import start_deal_process, finalize_deal,handle_chat_interaction, OPEN_OPPS_PAGE_SIZE, batch_drafting_enabled, prepare_sow_drafts
 # Import the new tool from tools.py
 from tools import get_open_opportunities
 from main import classify_intent
-from main import agent_executor
-
-from langchain.callbacks.base import BaseCallbackHandler
+from main import agent_executor, WORKER_AGENT_MODE
+from agent_metrics import agent_metrics
+from chat_router import chat_router
+from tools_concurrency import BoundedWorkerPool, dependency_limits, rate_limits
+from task_events import AgentLogHandler
+from task_store import TaskStore, TaskFailureLog, failed_deal_summaries
+from job_queue import JobQueue
 
 app = Flask(__name__)
-tasks = {}
-tasks_lock = threading.Lock()
-
-# --- NEW CLASS: Agent Log Listener ---
-# 1. Update the AgentLogHandler class
-class AgentLogHandler(BaseCallbackHandler):
-    def __init__(self, task_id, opp_id):
-        self.task_id = task_id
-        # --- FIX 1: SAVE THE OPPORTUNITY ID ---
-        self.opp_id = opp_id 
-        # --------------------------------------
-        self.prefix = f"[{opp_id}] "
-        self.last_message = ""
-        self.account_name = "Client" 
-        self.sow_sent = False # Track if we actually sent it
-    
-    def update_status(self, status_text):
-        with tasks_lock:
-            if self.task_id in tasks:
-                tasks[self.task_id]['current_step'] = status_text
-
-    def save_envelope_id(self, envelope_id):
-        with tasks_lock:
-            if self.task_id in tasks:
-                # Map the Opportunity ID to the Envelope ID
-                tasks[self.task_id]['results'][self.opp_id] = envelope_id
-
-    def mark_deal_complete(self):
-        """Adds the account name to the finished list for the UI"""
-        with tasks_lock:
-            if self.task_id in tasks:
-                # Only add if not already there to avoid duplicates
-                if self.account_name not in tasks[self.task_id]['finished_deals']:
-                    tasks[self.task_id]['finished_deals'].append(self.account_name)
-
-    def log(self, message):
-        if message == self.last_message: return
-        self.last_message = message
-        with tasks_lock:
-            if self.task_id in tasks:
-                tasks[self.task_id]['logs'].append(self.prefix + message)
-
-    # --- EVENT HANDLERS ---
-
-    def on_chain_start(self, serialized, inputs, **kwargs):
-        # --- FIX 2: CHECK IF SERIALIZED EXISTS ---
-        # Sometimes 'serialized' is None, causing the 'NoneType' error.
-        if serialized and serialized.get("name") == "AgentExecutor":
-            self.log("🤖 Agent activated.")
-            self.update_status("🧠 Agent Initializing...")
-
-    def on_tool_start(self, serialized, input_str, **kwargs):
-        tool_name = serialized['name']
-        
-        if "Create Composite SOW" in tool_name:
-            try:
-                args = json.loads(input_str)
-                found_name = args.get('account_name') or args.get('client_name')
-                if found_name:
-                    self.account_name = found_name
-            except: pass
-            
-            self.sow_sent = True # Mark that we attempted to send
-            friendly_status = f"📝 Generating PDF for {self.account_name}..."
-            self.update_status(friendly_status)
-
-        elif "Get Opportunity Details" in tool_name:
-            self.update_status("🔍 Reading Salesforce Data...")
-        elif "Get Opportunity Line Items" in tool_name:
-            self.update_status("📦 Analyzing Products...")
-        else:
-            self.update_status(f"🛠️ Executing: {tool_name}...")
-        
-        self.log(f"Using tool: {tool_name}")
-
-    def on_tool_end(self, output, **kwargs):
-        # --- NEW DEBUG LINE ---
-        # Convert output to string just in case it's an object
-        print(f"🔥 DEBUG: RAW TOOL OUTPUT: {str(output)}") 
-        # ----------------------
-
-        # Existing logic
-        if "Envelope ID:" in output:
-            match = re.search(r"Envelope ID:\s*([a-fA-F0-9\-]+)", output)
-            if match:
-                env_id = match.group(1)
-                print(f"✅ CAPTURED ENVELOPE ID: {env_id}")
-                self.save_envelope_id(env_id)
-            else:
-                print(f"❌ Regex failed to match inside: {output}")
-
-    def on_agent_action(self, action, **kwargs):
-        thought = action.log.split('Action:')[0].replace("Thought:", "").strip()
-        if thought:
-            self.log(f"🤔 Thought: {thought}")
-            if "draft" in thought.lower() or "prepare" in thought.lower():
-                self.update_status(f"✍️ Drafting SOW content for {self.account_name}...")
-
-    def on_chain_end(self, outputs, **kwargs):
-        if 'output' in outputs:
-            self.log("🏁 Task process finished.")
-            # If we sent the SOW, add to the success list
-            if self.sow_sent:
-                self.mark_deal_complete()
-                self.update_status(f"✅ SOW Sent to {self.account_name}!")
 
-@app.route('/', methods=['GET'])
-def index():
-    """Renders the main UI page with a list of opportunities."""
-    from tools import get_open_opportunities
-    print("--- [UI] Page requested. Calling get_open_opportunities tool. ---")
+# Failed deals of evicted tasks (sent ones are already in the SOW history)
+task_failure_log = TaskFailureLog()
 
-    opportunities = [] # Default to an empty list
+def _persist_task_summary(task_id, task):
+    """Called before a finished task is evicted: its failed deals go to the task failure log."""
+    saved = task_failure_log.append_new(failed_deal_summaries(task_id, task))
+    if saved:
+        print(f"💾 MEMORY: Logged {saved} failed deal(s) of task {task_id} to {task_failure_log.path} before evicting it.")
+
+# Progress of every deal task (bounded logs, finished tasks evicted after TASK_TTL_SECONDS)
+task_store = TaskStore(on_evict=_persist_task_summary)
+
+# Where deal jobs run:
+#   "sqlite" (default) -> durable job queue (job_queue.py) drained by worker processes (deal_worker.py)
+#   "memory"           -> bounded thread pool inside this process; queued work is lost on restart
+DEAL_QUEUE_BACKEND = os.getenv("DEAL_QUEUE_BACKEND", "sqlite").lower()
+DEAL_WORKER_PROCESSES = int(os.getenv("DEAL_WORKER_PROCESSES", "2"))
+DEAL_QUEUE_MAX = int(os.getenv("DEAL_QUEUE_MAX", "1000"))
+
+# Shared, bounded executor for deal processing and webhook finalization (DEAL_WORKERS, DEAL_QUEUE_MAX)
+deal_pool = BoundedWorkerPool(name="deals") if DEAL_QUEUE_BACKEND == "memory" else None
+job_queue = JobQueue() if DEAL_QUEUE_BACKEND == "sqlite" else None
+
+def _run_deal_in_memory(opp_id, template_id, signer_role, task_id, log_handler, use_docgen, snapshot, force_regenerate):
+    # Progress goes through the handler; completion is published here so the task store sees every event
     try:
-        # 1. Get the raw JSON string from the tool
-        opportunities_json = get_open_opportunities()
-        print(f"--- [UI] Raw JSON received from tool: {opportunities_json} ---")
-
-        # 2. Check if the received data is a valid-looking JSON array (after stripping whitespace)
-        if opportunities_json and opportunities_json.strip().startswith('['):
-            # 3. Parse the JSON into a Python list
-            opportunities = json.loads(opportunities_json)
-            print(f"--- [UI] Successfully parsed JSON. Found {len(opportunities)} opportunities. ---")
-        else:
-            print("--- [UI] Data received from tool was not a valid JSON array. Passing empty list to UI. ---")
+        start_deal_process(opp_id, template_id, signer_role, task_id, {}, threading.Lock(), log_handler, use_docgen, snapshot, force_regenerate)
+    finally:
+        task_store.publish(task_id, opp_id, "job_finished", "succeeded" if log_handler.envelope_id else "failed")
+
+# --- JOB QUEUE RELAY ---
+# Worker processes write progress to job_events; this thread folds them into the task store so
+# /task-status keeps reading memory. Tasks not in memory (e.g. after a restart) are
+# rebuilt from the queue on first read.
+_relay_started = False
+_relay_lock = threading.Lock()
+
+def _relay_job_events():
+    last_id = job_queue.last_event_id()
+    while True:
+        try:
+            events = job_queue.events_since(last_id)
+        except Exception as e:
+            print(f"⚠️ Job event relay failed: {e}")
+            events = []
+        if not events:
+            time.sleep(0.5)
+            continue
+        for event in events:
+            task_store.publish(event["task_id"], event["item_key"], event["kind"], event["value"], event_id=event["event_id"])
+        last_id = events[-1]["event_id"]
+
+def start_background_services():
+    """Starts the job event relay and DEAL_WORKER_PROCESSES worker processes (sqlite backend only). Idempotent."""
+    global _relay_started
+    if job_queue is None:
+        return
+    with _relay_lock:
+        if _relay_started:
+            return
+        _relay_started = True
+    threading.Thread(target=_relay_job_events, name="job-event-relay", daemon=True).start()
+    if DEAL_WORKER_PROCESSES > 0:
+        from deal_worker import start_worker_processes
+        # This process and every worker get an equal share of each API quota
+        rate_limits.set_share(DEAL_WORKER_PROCESSES + 1)
+        start_worker_processes(DEAL_WORKER_PROCESSES)
+        print(f"👷 Started {DEAL_WORKER_PROCESSES} deal worker processes.")
+
+def can_accept_deals(count):
+    if job_queue is not None:
+        return job_queue.queued_count() + count <= DEAL_QUEUE_MAX
+    return deal_pool.can_accept(count)
+
+def launch_deal_agents(task_id, opportunity_ids, template_id, signer_role, use_docgen, force_regenerate=False):
+    """
+    Queues one job per Opportunity. With the sqlite backend the jobs are persisted and the worker
+    processes do the prefetching and drafting; with the memory backend this prefetches Salesforce
+    data in bulk in a background thread, then submits to the shared deal pool.
+    'force_regenerate' bypasses the SOW draft cache.
+    """
+    if job_queue is not None:
+        start_background_services()
+        params = {"template_id": template_id, "signer_role": signer_role, "use_docgen": use_docgen,
+                  "force_regenerate": force_regenerate}
+        job_queue.enqueue_task(task_id, "deal", [(opp_id, params) for opp_id in opportunity_ids],
+                               current_step=f"⏳ {len(opportunity_ids)} deals queued...")
+        task_store.publish(task_id, None, "step", f"⏳ {len(opportunity_ids)} deals queued...")
+        print(f"Queued {len(opportunity_ids)} deal jobs for task {task_id}")
+        return
+
+    publish = task_store.publisher(task_id)
+
+    def _launch():
+        publish("step", "📦 Prefetching Salesforce data...")
+        snapshot = prefetch_opportunity_snapshot(opportunity_ids)
+
+        drafted = set()
+        if batch_drafting_enabled(len(opportunity_ids)):
+            publish("step", f"✍️ Drafting {len(opportunity_ids)} SOWs in batches...")
+            try:
+                drafted = prepare_sow_drafts(opportunity_ids, snapshot, force_regenerate)
+            except Exception as e:
+                print(f"⚠️ Batch drafting failed, each deal drafts on its own: {e}")
 
-    except Exception as e:
-        print(f"❌ ERROR in index route: {type(e).__name__} - {e}")
+        for opp_id in opportunity_ids:
+            print(f"Queueing deal process for Opportunity: {opp_id}")
+            # Create a handler specific to this Opportunity
+            log_handler = AgentLogHandler(task_id, opp_id, task_store.publisher(task_id, opp_id))
+            # Pass the task_id (and the shared snapshot) to the pool; the HTTP request already checked capacity
+            deal_pool.submit(task_id, opp_id, _run_deal_in_memory, opp_id, template_id, signer_role, task_id,
+                             log_handler, use_docgen, snapshot, force_regenerate and opp_id not in drafted, force=True)
+        publish("step", f"⏳ {len(opportunity_ids)} deals queued...")
 
+    threading.Thread(target=_launch).start()
+
+@app.route('/', methods=['GET'])
+def index():
+    """
+    Renders the main UI page. The page opens on the chat; open opportunities are loaded
+    when asked for ("Show open projects"), paged through /api/opportunities.
+    """
     # --- NEW: Get the Salesforce Base URL ---
     # This ensures links work even if your domain changes
     sf_base_url = os.getenv("SALESFORCE_INSTANCE_URL")
 
     print("--- [UI] Rendering template... ---")
-    return render_template('index.html', opportunities=opportunities,sf_base_url=sf_base_url)
+    return render_template('index.html', sf_base_url=sf_base_url)
+
+@app.route('/api/opportunities', methods=['GET'])
+def list_opportunities():
+    """
+    Paged open pipeline.
+    Query params: cursor, limit, sort (Amount|CloseDate|Name|ProductCount|PrimaryContactName),
+                  order (asc|desc), q (name/contact text), min_amount, max_amount
+    """
+    args = request.args
+    try:
+        page = page_open_opportunities(
+            cursor=args.get('cursor'),
+            limit=args.get('limit', OPEN_OPPS_PAGE_SIZE, type=int),
+            sort=args.get('sort', 'Amount'),
+            order='asc' if args.get('order') == 'asc' else 'desc',
+            q=args.get('q') or None,
+            min_amount=args.get('min_amount', type=float),
+            max_amount=args.get('max_amount', type=float)
+        )
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+    except Exception as e:
+        print(f"❌ ERROR in /api/opportunities: {type(e).__name__} - {e}")
+        return jsonify({"status": "error", "message": f"Salesforce API Error: {e}"}), 502
+    return jsonify(page)
 
 @app.route('/api/a2a-handshake', methods=['POST'])
 def agent_to_agent_delegation():
@@ -174,7 +199,7 @@ def agent_to_agent_delegation():
         # We pass the goal directly to the Worker Agent's Brain
         # The Agent will analyze the text, see it needs 'Check Warranty Status',
         # call the tool, and generate a natural language response.
-        agent_response = agent_executor.invoke({"input": goal})
+        agent_response = agent_metrics.invoke(agent_executor, "a2a", WORKER_AGENT_MODE, {"input": goal})
         final_answer = agent_response['output']
         
         print(f"✅ Agent Reply: {final_answer}")
@@ -196,23 +221,15 @@ def start_closing():
 
     # Check if the toggle was checked (returns 'on' if checked, None if not)
     use_docgen = request.form.get('use_docgen') == 'on'
+    force_regenerate = request.form.get('force_regenerate') == 'on'
 
     if not opportunity_ids:
         return jsonify({"status": "error", "message": "No opportunities selected."}), 400
+    if not can_accept_deals(len(opportunity_ids)):
+        return jsonify({"status": "error", "message": "The deal queue is full. Please try again in a few minutes."}), 429
 
     task_id = str(uuid.uuid4())
-    with tasks_lock:
-        # tasks[task_id] = {"total": len(opportunity_ids), "completed": 0, "status": "running"}
-        # NEW: Initialize an empty 'logs' list
-        tasks[task_id] = {
-            "total": len(opportunity_ids), 
-            "completed": 0, 
-            "status": "running",
-            "logs": [],
-            "current_step": "🚀 Spooling up AI Agents...",
-            "finished_deals": [], # <--- NEW LIST TO TRACK COMPLETIONS
-            "results": {}
-        }
+    task_store.create(task_id, opportunity_ids, "🚀 Spooling up AI Agents...")
 
     #template_id = "8cbe3647-6fce-49fb-877a-7911cf278316"
 
@@ -226,13 +243,7 @@ def start_closing():
 
     signer_role = "ClientSigner"
 
-    for opp_id in opportunity_ids:
-        print(f"Queueing deal process for Opportunity: {opp_id}")
-        # Create a handler specific to this Opportunity
-        log_handler = AgentLogHandler(task_id, opp_id)
-        # Pass the task_id to the background thread
-        thread = threading.Thread(target=start_deal_process, args=(opp_id, template_id, signer_role, task_id, tasks, tasks_lock, log_handler, use_docgen))
-        thread.start()
+    launch_deal_agents(task_id, opportunity_ids, template_id, signer_role, use_docgen, force_regenerate)
 
     return jsonify({"status": "started", "task_id": task_id})
 
@@ -273,9 +284,13 @@ def docusign_webhook():
         print(f"✅ Webhook received: Envelope {envelope_id} | OppID {opportunity_id} | Status '{envelope_status}'")
         
         if envelope_status == 'completed' and opportunity_id:
-            print(f"🚀 Triggering agent to finalize deal for Opp ID {opportunity_id}...")
-            thread = threading.Thread(target=finalize_deal, args=(envelope_id, opportunity_id))
-            thread.start()
+            print(f"🚀 Finalizing deal for Opp ID {opportunity_id}...")
+            # Webhooks are never refused: they bypass the queue limit but still wait for a worker
+            if job_queue is not None:
+                start_background_services()
+                job_queue.enqueue("finalize", envelope_id, {"envelope_id": envelope_id, "opportunity_id": opportunity_id})
+            else:
+                deal_pool.submit("finalize", envelope_id, finalize_deal, envelope_id, opportunity_id, force=True)
         elif not opportunity_id:
             print("⚠️ Warning: Opportunity ID not found in webhook payload.")
             
@@ -304,12 +319,104 @@ def update_contact():
     else:
         return jsonify({"status": "error", "message": result}), 500
     
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    """Exposes internal performance counters (token cache, etc.)."""
+    from tools_auth import docusign_tokens
+    from tools_http import docusign_http
+    from tools import open_opportunities_cache
+    from main import get_finalize_stats, sow_draft_cache
+    return jsonify({
+        "docusign_auth": docusign_tokens.stats(),
+        "docusign_http": docusign_http.stats(),
+        "open_opportunities_cache": open_opportunities_cache.stats(),
+        "finalize": get_finalize_stats(),
+        "agent_runs": agent_metrics.stats(),
+        "chat_router": chat_router.stats(),
+        "sow_draft_cache": sow_draft_cache.stats(),
+        "deal_pool": deal_pool.stats() if deal_pool else None,
+        "deal_jobs": job_queue.stats() if job_queue else None,
+        "dependency_concurrency": dependency_limits.stats(),
+        "rate_limits": rate_limits.stats(),
+        "task_store": task_store.stats()
+    })
+
+@app.route('/api/task-failures', methods=['GET'])
+def task_failures():
+    """Failed deals of finished (evicted) tasks, newest first. ?limit=N (default 100)."""
+    try:
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    return jsonify(task_failure_log.records(limit=max(limit, 1)))
+
 @app.route('/task-status/<task_id>', methods=['GET'])
 def task_status(task_id):
-    """Checks the status of a background task."""
-    with tasks_lock:
-        task = tasks.get(task_id, {})
-    return jsonify(task)
+    """
+    Checks the status of a background task.
+    Optional ?since=<cursor> (the 'cursor' of the previous response): logs, results and
+    finished_deals then only contain what is new. 'reset': true means the full state was sent.
+    """
+    return jsonify(_task_snapshot(task_id, request.args.get('since')) or {})
+
+def _task_snapshot(task_id, since=None):
+    """Task state (incremental after 'since') with queue positions, or None for an unknown task."""
+    task = task_store.snapshot(task_id, since)
+    if task is None and job_queue is not None:
+        # Not in memory (e.g. the web process restarted or the task was evicted): rebuild it from the durable queue
+        rebuilt = job_queue.task_snapshot(task_id)
+        if rebuilt is not None:
+            start_background_services()
+            task_store.adopt(task_id, rebuilt)
+            task = task_store.snapshot(task_id, since)
+    if task:
+        # Per-opportunity state: running, or position in the shared FIFO queue
+        task["queue"] = job_queue.positions(task_id) if job_queue is not None else deal_pool.positions(task_id)
+    return task
+
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+SSE_QUEUE_REFRESH_SECONDS = float(os.getenv("SSE_QUEUE_REFRESH_SECONDS", "2"))
+
+@app.route('/task-events/<task_id>', methods=['GET'])
+def task_events(task_id):
+    """
+    Server-Sent Events stream of a task's progress (same payload as /task-status?since=...).
+    Each 'progress' event's id is the task cursor, so a reconnecting EventSource resumes from
+    Last-Event-ID. Sends a comment heartbeat every SSE_HEARTBEAT_SECONDS and a 'done' event
+    when the task completes. Clients without EventSource keep polling /task-status.
+    """
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    if _task_snapshot(task_id) is None:
+        return jsonify({"status": "error", "message": "Unknown task."}), 404
+
+    def stream():
+        wakeup = task_store.subscribe(task_id)
+        cursor, queue_state, last_sent = since, None, time.monotonic()
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                state = _task_snapshot(task_id, cursor)
+                if state is None:
+                    yield "event: gone\ndata: {}\n\n"
+                    return
+                # Queue positions move when other tasks' jobs finish, so they are re-checked on every wake-up
+                if state["cursor"] != cursor or state["queue"] != queue_state:
+                    cursor, queue_state, last_sent = state["cursor"], state["queue"], time.monotonic()
+                    yield f"id: {cursor}\nevent: progress\ndata: {json.dumps(state)}\n\n"
+                if state["status"] == "completed":
+                    yield f"event: done\ndata: {json.dumps({'cursor': cursor})}\n\n"
+                    return
+                try:
+                    wakeup.get(timeout=SSE_QUEUE_REFRESH_SECONDS)
+                except queue.Empty:
+                    if time.monotonic() - last_sent >= SSE_HEARTBEAT_SECONDS:
+                        last_sent = time.monotonic()
+                        yield ": heartbeat\n\n"
+        finally:
+            task_store.unsubscribe(task_id, wakeup)
+
+    return Response(stream_with_context(stream()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
     
@@ -319,6 +426,7 @@ def agent_chat():
     user_message = data.get('message', '')
     selected_ids = data.get('selected_ids', [])
     use_docgen = data.get('use_docgen') == 'on'
+    force_regenerate = data.get('force_regenerate') == 'on'
 
     # --- CALL THE AUTONOMOUS AGENT ---
     result = handle_chat_interaction(user_message)
@@ -326,7 +434,9 @@ def agent_chat():
     response_payload = {
         "message": result['response'],
         "action": result['action'],
-        "data": result.get('data')
+        "data": result.get('data'),
+        "cache_age": result.get('cache_age'),
+        "next_cursor": result.get('next_cursor')
     }
 
     # If the Agent decided we need to close deals, we execute the logic here
@@ -334,19 +444,13 @@ def agent_chat():
         if not selected_ids:
             response_payload["message"] = "I can do that, but please select the projects from the list first."
             response_payload["action"] = "none"
+        elif not can_accept_deals(len(selected_ids)):
+            response_payload["message"] = "The deal queue is full right now. Please try again in a few minutes."
+            response_payload["action"] = "none"
         else:
             # ... (Your existing Task ID generation logic) ...
             task_id = str(uuid.uuid4())
-            with tasks_lock:
-                tasks[task_id] = {
-                    "total": len(selected_ids), 
-                    "completed": 0, 
-                    "status": "running",
-                    "logs": [],
-                    "current_step": "🚀 Agent triggered via Chat...",
-                    "finished_deals": [],
-                    "results": {}
-                }
+            task_store.create(task_id, selected_ids, "🚀 Agent triggered via Chat...")
             
             # ... (Your existing Template selection logic) ...
             if use_docgen:
@@ -356,13 +460,7 @@ def agent_chat():
             
             signer_role = "ClientSigner"
 
-            for opp_id in selected_ids:
-                log_handler = AgentLogHandler(task_id, opp_id)
-                thread = threading.Thread(
-                    target=start_deal_process, 
-                    args=(opp_id, template_id, signer_role, task_id, tasks, tasks_lock, log_handler, use_docgen)
-                )
-                thread.start()
+            launch_deal_agents(task_id, selected_ids, template_id, signer_role, use_docgen, force_regenerate)
             
             response_payload["action"] = "start_polling"
             response_payload["task_id"] = task_id
@@ -370,4 +468,5 @@ def agent_chat():
     return jsonify(response_payload)
 
 if __name__ == "__main__":
+    start_background_services()
     app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
@@ -0,0 +1,154 @@
+# task_events.py
+import re
+import json
+from langchain.callbacks.base import BaseCallbackHandler
+
+# Progress of a deal task is a stream of small events:
+#   step          -> current_step text for the spinner
+#   log           -> one console line (the last "❌" line per opportunity is kept as its error)
+#   envelope      -> Opportunity ID -> Envelope ID
+#   deal_complete -> account name for the "finished" checklist
+#   job_finished  -> one opportunity is done (success or failure)
+#   sending       -> a tool that sends the SOW was started (the job queue stops retrying the deal)
+# The same events drive the in-memory task view (apply_task_event) whether they come from a
+# thread in this process or from a worker process through the durable job queue.
+
+
+def new_task_state(total, current_step):
+    return {
+        "total": total,
+        "completed": 0,
+        "status": "running",
+        "logs": [],
+        "current_step": current_step,
+        "finished_deals": [],
+        "results": {},
+        "errors": {}  # opportunity id -> last error line (outlives the bounded log)
+    }
+
+
+def apply_task_event(task, opp_id, kind, value):
+    """Applies one progress event to a task dict in place (the caller holds the task lock)."""
+    if kind == "step":
+        task['current_step'] = value
+    elif kind == "log":
+        task['logs'].append(value)
+        if opp_id and "❌" in value:
+            task.setdefault('errors', {})[opp_id] = value
+    elif kind == "envelope":
+        task['results'][opp_id] = value
+    elif kind == "deal_complete":
+        # Only add if not already there to avoid duplicates
+        if value not in task['finished_deals']:
+            task['finished_deals'].append(value)
+    elif kind == "job_finished":
+        task['completed'] += 1
+        if task['completed'] >= task['total']:
+            task['status'] = "completed"
+
+
+# Tools that send an envelope to the customer: once one has started, re-running the deal could send a second SOW
+SOW_SENDING_TOOLS = ("Create Composite SOW", "Create DocGen SOW", "Create and Send DocuSign from Template")
+
+
+# --- NEW CLASS: Agent Log Listener ---
+class AgentLogHandler(BaseCallbackHandler):
+    """
+    Turns agent callbacks (and direct calls from the SOW pipeline) into task progress events.
+    'publish' is fn(kind, value) for this task/opportunity: it either updates the in-memory
+    task dict or appends to the durable job queue, depending on where the deal runs.
+    """
+
+    def __init__(self, task_id, opp_id, publish):
+        self.task_id = task_id
+        # --- FIX 1: SAVE THE OPPORTUNITY ID ---
+        self.opp_id = opp_id
+        # --------------------------------------
+        self.publish = publish
+        self.prefix = f"[{opp_id}] "
+        self.last_message = ""
+        self.account_name = "Client"
+        self.sow_sent = False # Track if we actually sent it
+        self.send_attempted = False  # Any SOW-sending tool started (even if its output was never parsed)
+        self.envelope_id = None
+
+    def update_status(self, status_text):
+        self.publish("step", status_text)
+
+    def save_envelope_id(self, envelope_id):
+        # Map the Opportunity ID to the Envelope ID
+        self.envelope_id = envelope_id
+        self.publish("envelope", envelope_id)
+
+    def mark_deal_complete(self):
+        """Adds the account name to the finished list for the UI"""
+        self.publish("deal_complete", self.account_name)
+
+    def log(self, message):
+        if message == self.last_message: return
+        self.last_message = message
+        self.publish("log", self.prefix + message)
+
+    # --- EVENT HANDLERS ---
+
+    def on_chain_start(self, serialized, inputs, **kwargs):
+        # --- FIX 2: CHECK IF SERIALIZED EXISTS ---
+        # Sometimes 'serialized' is None, causing the 'NoneType' error.
+        if serialized and serialized.get("name") == "AgentExecutor":
+            self.log("🤖 Agent activated.")
+            self.update_status("🧠 Agent Initializing...")
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        tool_name = serialized['name']
+        if tool_name in SOW_SENDING_TOOLS and not self.send_attempted:
+            self.send_attempted = True
+            self.publish("sending", tool_name)
+
+        if "Create Composite SOW" in tool_name:
+            try:
+                # Structured (tool calling) tools pass their arguments as a dict in 'inputs'
+                args = kwargs.get('inputs') or json.loads(input_str)
+                found_name = args.get('account_name') or args.get('client_name')
+                if found_name:
+                    self.account_name = found_name
+            except: pass
+
+            self.sow_sent = True # Mark that we attempted to send
+            friendly_status = f"📝 Generating PDF for {self.account_name}..."
+            self.update_status(friendly_status)
+
+        elif "Get Opportunity Details" in tool_name:
+            self.update_status("🔍 Reading Salesforce Data...")
+        elif "Get Opportunity Line Items" in tool_name:
+            self.update_status("📦 Analyzing Products...")
+        else:
+            self.update_status(f"🛠️ Executing: {tool_name}...")
+
+        self.log(f"Using tool: {tool_name}")
+
+    def on_tool_end(self, output, **kwargs):
+        # Structured tools may hand back a message object rather than a string
+        output = str(output)
+        if "Envelope ID:" in output:
+            match = re.search(r"Envelope ID:\s*([a-fA-F0-9\-]+)", output)
+            if match:
+                env_id = match.group(1)
+                print(f"✅ CAPTURED ENVELOPE ID: {env_id}")
+                self.save_envelope_id(env_id)
+            else:
+                print(f"❌ Regex failed to match inside: {output}")
+
+    def on_agent_action(self, action, **kwargs):
+        thought = action.log.split('Action:')[0].replace("Thought:", "").strip()
+        if thought:
+            self.log(f"🤔 Thought: {thought}")
+            if "draft" in thought.lower() or "prepare" in thought.lower():
+                self.update_status(f"✍️ Drafting SOW content for {self.account_name}...")
+
+    def on_chain_end(self, outputs, **kwargs):
+        if 'output' in outputs:
+            self.log("🏁 Task process finished.")
+            # If we sent the SOW, add to the success list
+            if self.sow_sent:
+                self.mark_deal_complete()
+                self.update_status(f"✅ SOW Sent to {self.account_name}!")
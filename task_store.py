@@ -0,0 +1,280 @@
+# task_store.py
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import datetime
+import threading
+from collections import deque
+
+from task_events import new_task_state, apply_task_event
+
+TASK_LOG_MAX_LINES = int(os.getenv("TASK_LOG_MAX_LINES", "500"))
+TASK_TTL_SECONDS = int(os.getenv("TASK_TTL_SECONDS", "3600"))
+TASK_SWEEP_INTERVAL = int(os.getenv("TASK_SWEEP_INTERVAL", "60"))
+TASK_FAILURE_LOG = os.getenv("TASK_FAILURE_LOG", "task_failures.jsonl")
+
+# Scalar fields returned as-is by snapshot() (the lists are diffed against the cursor)
+_PUBLIC_FIELDS = ("total", "completed", "status", "current_step", "logs_dropped")
+
+
+class TaskStore:
+    """
+    In-memory progress of deal tasks for /task-status.
+
+    - Each task keeps only its last 'max_logs' log lines (ring buffer); older lines are counted
+      in 'logs_dropped'.
+    - Finished tasks are evicted 'ttl_seconds' after they complete. Before that, on_evict(task_id,
+      task) is called so their outcome can be persisted (see failed_deal_summaries).
+    - stats() reports the number of tasks, log lines and an approximate memory footprint.
+    - Every applied event bumps the task's sequence number, so snapshot(task_id, since=cursor)
+      can return only what changed after a client's last poll.
+    - subscribe(task_id) returns a wake-up queue that gets a token whenever the task changes
+      (fan-out for the /task-events stream).
+    """
+
+    def __init__(self, max_logs=TASK_LOG_MAX_LINES, ttl_seconds=TASK_TTL_SECONDS, on_evict=None, sweep_interval=TASK_SWEEP_INTERVAL):
+        self.max_logs = max_logs
+        self.ttl = ttl_seconds
+        self.on_evict = on_evict
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self._subscribers = {}  # task_id -> set of queue.Queue(maxsize=1)
+        self._last_sweep = time.monotonic()
+        self.evicted = 0
+
+    # --- WRITES ---
+
+    def create(self, task_id, opportunity_ids, current_step):
+        task = new_task_state(len(opportunity_ids), current_step)
+        task["opportunity_ids"] = list(opportunity_ids)
+        self.adopt(task_id, task)
+
+    def adopt(self, task_id, task):
+        """Stores a task built elsewhere (e.g. rebuilt from the job queue) unless one is already there."""
+        task = dict(task)
+        task["logs"] = deque(task.get("logs", []), maxlen=self.max_logs)
+        task.setdefault("logs_dropped", 0)
+        task.setdefault("finished_at", time.monotonic() if task.get("status") == "completed" else None)
+        # Cursor bookkeeping: a new epoch per stored copy, so cursors from before a restart or
+        # eviction are recognised as stale and answered with the full state
+        task["epoch"] = uuid.uuid4().hex[:8]
+        task["seq"] = 0
+        task["log_seqs"] = deque([0] * len(task["logs"]), maxlen=self.max_logs)
+        task["result_seqs"] = {opp_id: 0 for opp_id in task["results"]}
+        task["finished_seqs"] = [0] * len(task["finished_deals"])
+        with self._lock:
+            self._tasks.setdefault(task_id, task)
+        self.sweep()
+
+    def publish(self, task_id, opp_id, kind, value, event_id=None):
+        """Applies one progress event (ignored for unknown tasks, or already-applied queue events)."""
+        if kind == "sending":
+            return  # Only the job queue acts on it
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return
+            if event_id is not None:
+                if event_id <= task.get("last_event_id", 0):
+                    return
+                task["last_event_id"] = event_id
+            if kind == "log" and len(task["logs"]) == task["logs"].maxlen:
+                task["logs_dropped"] += 1
+            finished_before = len(task["finished_deals"])
+            apply_task_event(task, opp_id, kind, value)
+            task["seq"] += 1
+            if kind == "log":
+                task["log_seqs"].append(task["seq"])
+            elif kind == "envelope":
+                task["result_seqs"][opp_id] = task["seq"]
+            elif len(task["finished_deals"]) > finished_before:
+                task["finished_seqs"].append(task["seq"])
+            if task["status"] == "completed" and task["finished_at"] is None:
+                task["finished_at"] = time.monotonic()
+            self._notify(task_id)
+
+    def publisher(self, task_id, opp_id=None):
+        """fn(kind, value) bound to one task/opportunity, for AgentLogHandler."""
+        return lambda kind, value: self.publish(task_id, opp_id, kind, value)
+
+    # --- SUBSCRIPTIONS ---
+
+    def subscribe(self, task_id):
+        """Wake-up queue for one listener. It holds at most one token: bursts of events coalesce."""
+        wakeup = queue.Queue(maxsize=1)
+        with self._lock:
+            self._subscribers.setdefault(task_id, set()).add(wakeup)
+        return wakeup
+
+    def unsubscribe(self, task_id, wakeup):
+        with self._lock:
+            listeners = self._subscribers.get(task_id)
+            if listeners is not None:
+                listeners.discard(wakeup)
+                if not listeners:
+                    del self._subscribers[task_id]
+
+    def _notify(self, task_id):
+        # Called with the lock held
+        for wakeup in self._subscribers.get(task_id, ()):
+            try:
+                wakeup.put_nowait(True)
+            except queue.Full:
+                pass  # Already has a pending wake-up
+
+    # --- READS ---
+
+    def __contains__(self, task_id):
+        with self._lock:
+            return task_id in self._tasks
+
+    def snapshot(self, task_id, since=None):
+        """
+        JSON-ready copy of a task, or None. Always carries a 'cursor'.
+        With 'since' (a cursor from an earlier snapshot) logs, results and finished_deals only
+        hold what changed after it; 'reset' is True when the full state is returned instead
+        (no cursor, or a cursor from another epoch).
+        """
+        self.sweep()
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return None
+            after = self._parse_cursor(task, since)
+            out = {k: v for k, v in task.items() if k in _PUBLIC_FIELDS}
+            out["logs"] = [line for seq, line in zip(task["log_seqs"], task["logs"]) if seq > after]
+            out["finished_deals"] = [deal for seq, deal in zip(task["finished_seqs"], task["finished_deals"]) if seq > after]
+            out["results"] = {opp_id: env_id for opp_id, env_id in task["results"].items() if task["result_seqs"].get(opp_id, 0) > after}
+            out["cursor"] = f"{task['epoch']}.{task['seq']}"
+            out["reset"] = after < 0
+            return out
+
+    @staticmethod
+    def _parse_cursor(task, cursor):
+        # Returns the sequence number to diff from, or -1 for "send everything"
+        epoch, _, seq = (cursor or "").partition(".")
+        if epoch != task["epoch"] or not seq.isdigit() or int(seq) > task["seq"]:
+            return -1
+        return int(seq)
+
+    # --- EVICTION ---
+
+    def sweep(self, force=False):
+        """Evicts finished tasks older than the TTL. Runs at most once per sweep_interval unless forced."""
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_sweep < self.sweep_interval:
+                return 0
+            self._last_sweep = now
+            expired = [(task_id, task) for task_id, task in self._tasks.items()
+                       if task["finished_at"] is not None and now - task["finished_at"] >= self.ttl]
+            for task_id, _ in expired:
+                del self._tasks[task_id]
+                self._notify(task_id)
+            self.evicted += len(expired)
+
+        # Persist outside the lock so status reads are never blocked by the history store
+        for task_id, task in expired:
+            if self.on_evict:
+                try:
+                    self.on_evict(task_id, task)
+                except Exception as e:
+                    print(f"⚠️ Could not persist summary of task {task_id}: {e}")
+        return len(expired)
+
+    def stats(self):
+        self.sweep()
+        with self._lock:
+            running = sum(1 for t in self._tasks.values() if t["finished_at"] is None)
+            log_lines = sum(len(t["logs"]) for t in self._tasks.values())
+            approx_bytes = sum(
+                sys.getsizeof(t) + sys.getsizeof(t["logs"]) + sys.getsizeof(t["log_seqs"]) + sum(sys.getsizeof(line) for line in t["logs"])
+                + sum(sys.getsizeof(v) for v in t["results"].values()) + sum(sys.getsizeof(v) for v in t["finished_deals"])
+                for t in self._tasks.values()
+            )
+            return {
+                "tasks": len(self._tasks),
+                "subscribers": sum(len(s) for s in self._subscribers.values()),
+                "running": running,
+                "finished": len(self._tasks) - running,
+                "log_lines": log_lines,
+                "logs_dropped": sum(t["logs_dropped"] for t in self._tasks.values()),
+                "approx_bytes": approx_bytes,
+                "evicted": self.evicted,
+                "max_log_lines_per_task": self.max_logs,
+                "ttl_seconds": self.ttl,
+            }
+
+
+class TaskFailureLog:
+    """
+    Append-only JSONL file (TASK_FAILURE_LOG) of the deals that failed in finished tasks.
+    Kept apart from the SOW history on purpose: a failed run is not a deal, and must not show
+    up in the history table, the history search or the chat's history context.
+    """
+
+    def __init__(self, path=TASK_FAILURE_LOG):
+        self.path = path
+        self._lock = threading.Lock()
+        self._keys = None  # (TaskId, OpportunityId) already logged, loaded on first write
+
+    def append_new(self, summaries):
+        """Appends the summaries not logged yet (a task rebuilt from the job queue can be evicted twice). Returns how many were written."""
+        with self._lock:
+            if self._keys is None:
+                self._keys = {(r.get("TaskId"), r.get("OpportunityId")) for r in self._read()}
+            new = [r for r in summaries if (r["TaskId"], r["OpportunityId"]) not in self._keys]
+            if new:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(r) + "\n" for r in new))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._keys.update((r["TaskId"], r["OpportunityId"]) for r in new)
+            return len(new)
+
+    def records(self, limit=None):
+        """Newest first."""
+        with self._lock:
+            rows = self._read()
+        rows.reverse()
+        return rows[:limit] if limit else rows
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return []
+        rows = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    pass  # Torn last line of an interrupted write
+        return rows
+
+
+def failed_deal_summaries(task_id, task):
+    """
+    One summary per opportunity of a finished task that never got an envelope, for the
+    TaskFailureLog. Sent SOWs are already in the history (logged when the envelope is created).
+    The error comes from the task's per-opportunity errors, which survive the log ring buffer.
+    """
+    summaries = []
+    for opp_id in task.get("opportunity_ids", []):
+        if opp_id in task["results"]:
+            continue
+        prefix = f"[{opp_id}] "
+        error = task.get("errors", {}).get(opp_id)
+        if error is None:
+            lines = [line for line in task["logs"] if line.startswith(prefix)]
+            error = lines[-1] if lines else "No error was reported"
+        summaries.append({
+            "TaskId": task_id,
+            "OpportunityId": opp_id,
+            "FailedAt": datetime.datetime.now().isoformat(timespec="seconds"),
+            "Error": error[len(prefix):] if error.startswith(prefix) else error
+        })
+    return summaries
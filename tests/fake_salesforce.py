@@ -0,0 +1,136 @@
+# tests/fake_salesforce.py
+"""
+Minimal in-process fake of the Salesforce Bulk API 2.0 ingest endpoints, for exercising
+BulkStageUpdater without an org:
+
+    with FakeSalesforce(fail={"006A": "FIELD_CUSTOM_VALIDATION_EXCEPTION"}) as sf:
+        updater = BulkStageUpdater(base_url=sf.base_url, session_id=sf.session_id, ...)
+
+Jobs go Open -> UploadComplete -> InProgress -> 'final_state' over 'polls_until_done' status polls.
+"""
+import io
+import csv
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+API_PREFIX = "/services/data/v59.0/"
+
+
+class FakeSalesforce:
+    def __init__(self, fail=None, unprocessed=(), final_state="JobComplete", error_message=None, polls_until_done=2, session_id="fake-session"):
+        self.fail = dict(fail or {})          # Id -> sf__Error reported in failedResults
+        self.unprocessed = set(unprocessed)   # Ids reported in unprocessedrecords
+        self.final_state = final_state
+        self.error_message = error_message
+        self.polls_until_done = polls_until_done
+        self.session_id = session_id
+
+        self.calls = []   # (method, path relative to the API root)
+        self.jobs = {}    # job_id -> {"request": dict, "state": str, "csv": str, "polls": int}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.base_url = f"http://127.0.0.1:{self._server.server_address[1]}{API_PREFIX}"
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def uploaded_rows(self, job_id):
+        return list(csv.DictReader(io.StringIO(self.jobs[job_id]["csv"])))
+
+    # --- REQUEST HANDLING ---
+
+    def _handle(self, method, path, headers, body):
+        """Returns (status, content_type, body)."""
+        with self._lock:
+            self.calls.append((method, path))
+        if headers.get("Authorization") != f"Bearer {self.session_id}":
+            return 401, "application/json", json.dumps([{"errorCode": "INVALID_SESSION_ID", "message": "Session expired or invalid"}])
+
+        parts = path.strip("/").split("/")
+        if parts[:2] != ["jobs", "ingest"]:
+            return 404, "application/json", json.dumps([{"errorCode": "NOT_FOUND", "message": path}])
+
+        with self._lock:
+            if method == "POST" and len(parts) == 2:
+                job_id = f"750fake{len(self.jobs):011d}"
+                self.jobs[job_id] = {"request": json.loads(body), "state": "Open", "csv": "", "polls": 0}
+                return 200, "application/json", json.dumps({"id": job_id, "state": "Open"})
+
+            job = self.jobs.get(parts[2]) if len(parts) > 2 else None
+            if job is None:
+                return 404, "application/json", json.dumps([{"errorCode": "NOT_FOUND", "message": "Unknown job"}])
+
+            if method == "PUT" and parts[3:] == ["batches"]:
+                if job["state"] != "Open":
+                    return 409, "application/json", json.dumps([{"errorCode": "INVALIDJOBSTATE", "message": job["state"]}])
+                job["csv"] += body.decode("utf-8")
+                return 201, "text/plain", ""
+
+            if method == "PATCH" and len(parts) == 3:
+                job["state"] = json.loads(body)["state"]
+                return 200, "application/json", json.dumps({"id": parts[2], "state": job["state"]})
+
+            if method == "GET" and len(parts) == 3:
+                if job["state"] in ("UploadComplete", "InProgress"):
+                    job["polls"] += 1
+                    job["state"] = self.final_state if job["polls"] >= self.polls_until_done else "InProgress"
+                return 200, "application/json", json.dumps(self._job_info(parts[2], job))
+
+            if method == "GET" and parts[3:] == ["failedResults"]:
+                rows = [r for r in self.uploaded_rows(parts[2]) if r["Id"] in self.fail]
+                return 200, "text/csv", self._to_csv(["sf__Id", "sf__Error", "Id", "StageName"],
+                                                     [[r["Id"], self.fail[r["Id"]], r["Id"], r["StageName"]] for r in rows])
+
+            if method == "GET" and parts[3:] == ["unprocessedrecords"]:
+                rows = [r for r in self.uploaded_rows(parts[2]) if r["Id"] in self.unprocessed]
+                return 200, "text/csv", self._to_csv(["Id", "StageName"], [[r["Id"], r["StageName"]] for r in rows])
+
+        return 405, "application/json", json.dumps([{"errorCode": "METHOD_NOT_ALLOWED", "message": f"{method} {path}"}])
+
+    def _job_info(self, job_id, job):
+        rows = self.uploaded_rows(job_id)
+        info = {"id": job_id, "state": job["state"], "object": job["request"].get("object"),
+                "operation": job["request"].get("operation"), "numberRecordsProcessed": 0, "numberRecordsFailed": 0}
+        if job["state"] == "JobComplete":
+            info["numberRecordsProcessed"] = len([r for r in rows if r["Id"] not in self.unprocessed])
+            info["numberRecordsFailed"] = len([r for r in rows if r["Id"] in self.fail])
+        elif job["state"] == "Failed":
+            info["errorMessage"] = self.error_message or "InvalidBatch : Failed to process query"
+        return info
+
+    @staticmethod
+    def _to_csv(header, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(header)
+        writer.writerows(rows)
+        return buffer.getvalue()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                path = self.path[len(API_PREFIX):] if self.path.startswith(API_PREFIX) else self.path
+                status, content_type, payload = fake._handle(self.command, path, self.headers, body)
+                data = payload.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_PATCH = _respond
+
+            def log_message(self, *args):
+                pass  # Keep test output quiet
+
+        return Handler
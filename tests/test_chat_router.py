@@ -0,0 +1,57 @@
+# tests/test_chat_router.py
+"""
+Rule-based fast path of the chat agent (chat_router.ChatRouter).
+
+    python -m pytest tests            (or: python -m unittest discover tests)
+"""
+import unittest
+
+from chat_router import ChatRouter, FETCH_OPEN, FETCH_HISTORY, SEARCH_HISTORY, TRIGGER_CLOSING, GREETING
+
+
+class ChatRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = ChatRouter(use_classifier=False)
+
+    def assertRoutes(self, message, intent, query=None):
+        self.assertEqual(self.router.route(message), (intent, query), message)
+
+    def test_history_search_needs_the_history_named(self):
+        self.assertRoutes("search history for acme", SEARCH_HISTORY, "acme")
+        self.assertRoutes("find past deals with united oil", SEARCH_HISTORY, "united oil")
+        self.assertRoutes("search the sow history for burlington", SEARCH_HISTORY, "burlington")
+        self.assertRoutes("lookup sows for edge communications", SEARCH_HISTORY, "edge communications")
+        self.assertRoutes("show history for grand hotels?", SEARCH_HISTORY, "grand hotels")
+        self.assertIsNone(self.router.route("find acme"))
+        self.assertIsNone(self.router.route("search for acme"))
+
+    def test_live_lookups_go_to_the_agent(self):
+        for message in [
+            "look up the warranty status of agreement 8f2a",
+            "find the opportunity details for 006XX",
+            "find line items for 006abc",
+            "search sows for line items of 006abc",
+            "find sow details for acme",
+        ]:
+            self.assertIsNone(self.router.route(message), message)
+
+    def test_open_deals_are_fetched_not_searched(self):
+        self.assertRoutes("find open deals", FETCH_OPEN)
+        self.assertRoutes("show me the open opportunities", FETCH_OPEN)
+        self.assertRoutes("what's in the pipeline?", FETCH_OPEN)
+        self.assertIsNone(self.router.route("search history for active deals"))
+
+    def test_other_fast_path_intents(self):
+        self.assertRoutes("show the full history", FETCH_HISTORY)
+        self.assertRoutes("close the selected deals", TRIGGER_CLOSING)
+        self.assertRoutes("hello there", GREETING)
+
+    def test_hedged_or_long_messages_go_to_the_agent(self):
+        self.assertIsNone(self.router.route("don't close the selected deals"))
+        self.assertIsNone(self.router.route("why was the acme deal closed"))
+        self.assertIsNone(self.router.route(" ".join(["search history for"] + ["acme"] * 12)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+# tests/test_tools_bulk.py
+"""
+BulkStageUpdater against a local fake of the Bulk API 2.0 ingest endpoints.
+
+    python -m pytest tests            (or: python -m unittest discover tests)
+"""
+import unittest
+
+from tools_bulk import BulkStageUpdater
+from tools_http import HttpTransport
+from tests.fake_salesforce import FakeSalesforce
+
+
+def make_updates(count, stage="Closed Won"):
+    return {f"006fake{i:011d}": stage for i in range(count)}
+
+
+class BulkStageUpdaterTest(unittest.TestCase):
+
+    def make_updater(self, sf, threshold=3, single_update=None, session_id=None):
+        self.single_calls = []
+
+        def record_single(opportunity_id, new_stage):
+            self.single_calls.append((opportunity_id, new_stage))
+
+        return BulkStageUpdater(
+            base_url=sf.base_url,
+            session_id=session_id or sf.session_id,
+            single_update=single_update or record_single,
+            threshold=threshold,
+            poll_interval=0.01,
+            poll_timeout=5,
+            transport=HttpTransport(name="salesforce-bulk-test", max_retries=0)
+        )
+
+    def test_below_threshold_updates_records_one_by_one(self):
+        with FakeSalesforce() as sf:
+            updates = make_updates(2)
+            results = self.make_updater(sf).apply(updates)
+
+        self.assertEqual(sf.calls, [])
+        self.assertEqual(self.single_calls, list(updates.items()))
+        self.assertTrue(all(r["success"] for r in results.values()))
+
+    def test_below_threshold_reports_single_update_errors(self):
+        def flaky(opportunity_id, new_stage):
+            if opportunity_id.endswith("1"):
+                raise RuntimeError("ENTITY_IS_LOCKED")
+
+        with FakeSalesforce() as sf:
+            results = self.make_updater(sf, single_update=flaky).apply(make_updates(2))
+
+        self.assertEqual(results["006fake00000000000"], {"success": True, "error": None})
+        self.assertEqual(results["006fake00000000001"], {"success": False, "error": "ENTITY_IS_LOCKED"})
+
+    def test_at_threshold_runs_the_bulk_job_flow(self):
+        updates = make_updates(3)
+        with FakeSalesforce(polls_until_done=3) as sf:
+            results = self.make_updater(sf).apply(updates)
+
+        self.assertEqual(self.single_calls, [])
+        job_id, job = next(iter(sf.jobs.items()))
+        self.assertEqual(job["request"], {"object": "Opportunity", "operation": "update", "contentType": "CSV", "lineEnding": "LF"})
+        self.assertEqual(sf.uploaded_rows(job_id), [{"Id": opp_id, "StageName": stage} for opp_id, stage in updates.items()])
+        self.assertEqual(sf.calls, [
+            ("POST", "jobs/ingest"),
+            ("PUT", f"jobs/ingest/{job_id}/batches"),
+            ("PATCH", f"jobs/ingest/{job_id}"),
+            ("GET", f"jobs/ingest/{job_id}"),
+            ("GET", f"jobs/ingest/{job_id}"),
+            ("GET", f"jobs/ingest/{job_id}"),
+            ("GET", f"jobs/ingest/{job_id}/failedResults/"),
+            ("GET", f"jobs/ingest/{job_id}/unprocessedrecords/"),
+        ])
+        self.assertEqual(results, {opp_id: {"success": True, "error": None} for opp_id in updates})
+
+    def test_bulk_job_reports_failed_and_unprocessed_records(self):
+        updates = make_updates(5)
+        failed_id, unprocessed_id = "006fake00000000001", "006fake00000000003"
+        with FakeSalesforce(fail={failed_id: "FIELD_CUSTOM_VALIDATION_EXCEPTION:Amount is required"}, unprocessed=[unprocessed_id]) as sf:
+            results = self.make_updater(sf).apply(updates)
+
+        self.assertEqual(results[failed_id], {"success": False, "error": "FIELD_CUSTOM_VALIDATION_EXCEPTION:Amount is required"})
+        self.assertEqual(results[unprocessed_id], {"success": False, "error": "Record was not processed"})
+        succeeded = [opp_id for opp_id, r in results.items() if r["success"]]
+        self.assertEqual(sorted(succeeded), sorted(set(updates) - {failed_id, unprocessed_id}))
+
+    def test_failed_job_fails_every_record(self):
+        updates = make_updates(4)
+        with FakeSalesforce(final_state="Failed", error_message="InvalidBatch : Field name not found : StageName") as sf:
+            results = self.make_updater(sf).apply(updates)
+
+        self.assertEqual(results, {opp_id: {"success": False, "error": "InvalidBatch : Field name not found : StageName"} for opp_id in updates})
+        self.assertNotIn("failedResults", " ".join(path for _, path in sf.calls))
+
+    def test_rejected_session_fails_every_record(self):
+        updates = make_updates(3)
+        with FakeSalesforce() as sf:
+            results = self.make_updater(sf, session_id="expired").apply(updates)
+
+        self.assertEqual(len(sf.calls), 1)
+        for outcome in results.values():
+            self.assertFalse(outcome["success"])
+            self.assertIn("401", outcome["error"])
+
+    def test_session_callable_is_read_on_every_request(self):
+        with FakeSalesforce() as sf:
+            current = {"session": sf.session_id}
+            updater = self.make_updater(sf, session_id=lambda: current["session"])
+            self.assertTrue(all(r["success"] for r in updater.apply(make_updates(3)).values()))
+
+            sf.session_id = "renewed-session"
+            current["session"] = "renewed-session"
+            results = updater.apply(make_updates(3))
+
+        self.assertTrue(all(r["success"] for r in results.values()))
+
+    def test_rejected_session_logs_in_again_and_retries(self):
+        with FakeSalesforce() as sf:
+            current = {"session": "expired"}
+            rejected = []
+
+            def relogin(session_id):
+                rejected.append(session_id)
+                current["session"] = sf.session_id
+
+            updater = self.make_updater(sf, session_id=lambda: current["session"])
+            updater.relogin = relogin
+            results = updater.apply(make_updates(3))
+
+        self.assertEqual(rejected, ["expired"])
+        self.assertEqual(len(sf.jobs), 1)
+        self.assertTrue(all(r["success"] for r in results.values()))
+
+    def test_without_single_update_small_batches_use_bulk(self):
+        with FakeSalesforce() as sf:
+            updater = self.make_updater(sf)
+            updater.single_update = None
+            results = updater.apply(make_updates(1))
+
+        self.assertEqual(len(sf.jobs), 1)
+        self.assertTrue(all(r["success"] for r in results.values()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+# tool_schemas.py
+import json
+from typing import List, Optional
+from pydantic import BaseModel, Field
+from langchain.tools import StructuredTool
+
+# JSON-schema argument definitions for every Tool in main.py.
+# In "tool_calling" mode the model fills these as native function-call arguments, so the
+# tools receive clean JSON (no ```json fences, no free-text "Action Input" to parse).
+
+
+class OpportunityIdInput(BaseModel):
+    opportunity_id: str = Field(description="Salesforce Opportunity ID (15 or 18 characters)")
+
+
+class SendTemplateInput(BaseModel):
+    recipient_name: str
+    recipient_email: str
+    template_id: str = Field(description="DocuSign template ID")
+    signer_role_name: str
+    opportunity_id: str
+
+
+class AttachDocumentInput(BaseModel):
+    envelope_id: str = Field(description="DocuSign Envelope ID of the completed envelope")
+    record_id: str = Field(description="Salesforce Opportunity ID to attach the document to")
+    file_name: str = Field(default="Signed_Contract.pdf")
+
+
+class StageUpdateInput(BaseModel):
+    opportunity_id: str
+    new_stage: str = Field(description="Target StageName, e.g. 'Closed Won'")
+
+
+class BulkStageUpdateInput(BaseModel):
+    opportunity_ids: List[str]
+    new_stage: str = Field(description="Target StageName applied to every Opportunity")
+
+
+class AttachAndCloseInput(AttachDocumentInput):
+    new_stage: str = Field(default="Closed Won")
+
+
+class ScopeItem(BaseModel):
+    title: str = Field(description="Product name")
+    description: str = Field(description="One full sentence describing the implementation work")
+
+
+class Milestone(BaseModel):
+    name: str = Field(description="Product name of the line item")
+    description: str = ""
+    date: str = Field(default="", description="ServiceDate (YYYY-MM-DD), 'Upon Delivery' or blank")
+    amount: str = Field(description="TotalPrice of that line item, e.g. '$30,000.00'")
+
+
+class CompositePdfData(BaseModel):
+    background_text: str
+    objectives_text: str
+    scope_items: List[ScopeItem]
+    assumptions_list: List[str]
+    milestones: List[Milestone] = Field(description="Exactly one entry per line item")
+
+
+class SowClientInput(BaseModel):
+    client_name: str
+    client_email: str
+    account_name: str
+    project_name: str
+    signer_role_name: str
+    opportunity_id: str
+    total_fixed_fee: str = Field(description="Sum of all line items, e.g. '5000.00' (no symbols)")
+
+
+class CompositeSowInput(SowClientInput):
+    static_legal_template_id: str
+    pdf_data: CompositePdfData
+
+
+class DocGenScopeRow(BaseModel):
+    Delivery_of_product: str
+
+
+class DocGenMilestoneRow(BaseModel):
+    Milestone_Product: str
+    Milestone_Description: str = ""
+    Milestone_Date: str = ""
+    Milestone_Amount: str
+
+
+class DocGenPdfData(BaseModel):
+    project_background: str
+    project_start_date: str = ""
+    project_end_date: str = ""
+    consultant_key_attributes: str = ""
+    Project_Scope: List[DocGenScopeRow]
+    Project_Assumptions: List[DocGenMilestoneRow]
+
+
+class DocGenSowInput(SowClientInput):
+    template_id: str
+    pdf_data: DocGenPdfData
+
+
+class AgreementIdInput(BaseModel):
+    agreement_id: str = Field(description="DocuSign Navigator Agreement ID")
+
+
+class SearchQueryInput(BaseModel):
+    query: str = Field(description="Words to search for in project name, contact name/email, amount, close date (YYYY-MM-DD), status, Opportunity ID or Envelope ID")
+
+
+class NoInput(BaseModel):
+    query: Optional[str] = Field(default="", description="Ignored")
+
+
+# Tool name -> (schema, single_field).
+# single_field set: the tool takes that one value as its string input.
+# single_field None: the arguments are passed to the tool as one JSON string, like ReAct did.
+TOOL_SCHEMAS = {
+    "Get Opportunity Details": (OpportunityIdInput, "opportunity_id"),
+    "Create and Send DocuSign from Template": (SendTemplateInput, None),
+    "Download and Attach DocuSign Document to Salesforce": (AttachDocumentInput, None),
+    "Update Opportunity Stage": (StageUpdateInput, None),
+    "Bulk Update Opportunity Stages": (BulkStageUpdateInput, None),
+    "Attach Signed Document and Close Opportunity": (AttachAndCloseInput, None),
+    "Get Line Items": (OpportunityIdInput, "opportunity_id"),
+    "Create Composite SOW": (CompositeSowInput, None),
+    "Create DocGen SOW": (DocGenSowInput, None),
+    "Check Warranty Status": (AgreementIdInput, "agreement_id"),
+    "Fetch Open Projects": (NoInput, "query"),
+    "Search History Context": (SearchQueryInput, "query"),
+    "Fetch Full History Log": (NoInput, "query"),
+}
+
+
+def to_structured_tool(tool):
+    """Wraps a string-input Tool as a StructuredTool with its JSON-schema arguments."""
+    if tool.name not in TOOL_SCHEMAS:
+        raise KeyError(f"No argument schema defined for tool '{tool.name}'")
+    schema, single_field = TOOL_SCHEMAS[tool.name]
+    func = tool.func
+
+    if single_field:
+        def run(**kwargs):
+            return func(kwargs.get(single_field) or "")
+    else:
+        def run(**kwargs):
+            return func(json.dumps(schema(**kwargs).model_dump()))
+
+    return StructuredTool.from_function(func=run, name=tool.name, description=tool.description, args_schema=schema)
+
+
+def to_structured_tools(tools):
+    return [to_structured_tool(tool) for tool in tools]
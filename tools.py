@@ -2,15 +2,25 @@
 
 import os
 import base64
+import re
 import json
 import time
+import tempfile
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import requests  # <--- IMPORT REQUESTS
 import datetime
 from dotenv import load_dotenv
 from docusign_esign import ApiClient, EnvelopesApi, EnvelopeDefinition, Document, Signer, SignHere, Tabs, Recipients, TemplateRole, TextCustomField, CustomFields, Tabs, Text, Number
-from simple_salesforce import Salesforce
+from simple_salesforce import Salesforce, SalesforceLogin
+from simple_salesforce.exceptions import SalesforceExpiredSession
 from docusign_esign import CompositeTemplate, ServerTemplate, InlineTemplate, Document,DocGenFormField, DocGenFormFields
 from tools_pdf import generate_scope_and_milestones_pdf # Import the new PDF tool
+from tools_auth import docusign_tokens # Shared, cached DocuSign JWT token
+from tools_cache import TTLCache
+from tools_bulk import BulkStageUpdater
+from tools_history import open_history_store
 from docusign_esign import (
     ApiClient, EnvelopesApi, EnvelopeDefinition, Document, Signer, Recipients,
     CompositeTemplate, ServerTemplate, InlineTemplate, Envelope,
@@ -22,11 +32,17 @@ from dateutil import parser
 # Load environment variables from .env file
 load_dotenv()
 
+# Shared keep-alive transports for raw REST calls (reads pool/timeout settings from env)
+from tools_http import docusign_http, salesforce_http, MultipartFileStream, STREAM_CHUNK_SIZE, LimitedHTTPAdapter
+from tools_concurrency import rate_limits
+
 # --- AUTHENTICATION SETUP ---
 
 # Create a session and disable SSL verification
 session = requests.Session()
 session.verify = False
+session.mount("https://", LimitedHTTPAdapter("salesforce")) # simple_salesforce calls share the Salesforce concurrency cap
+salesforce_http.session.verify = session.verify # Same TLS settings for our raw Salesforce calls
 
 # Suppress only the single InsecureRequestWarning from urllib3
 from urllib3.exceptions import InsecureRequestWarning
@@ -42,30 +58,42 @@ sf = Salesforce(
     session=session  # <--- PASS THE MODIFIED SESSION
 )
 
+_salesforce_login_lock = threading.Lock()
+
+def refresh_salesforce_session(rejected_session_id=None):
+    """
+    Logs in again and points 'sf' at the new session (after Salesforce answered 401).
+    Threads that hit the same expired session share one login.
+    """
+    with _salesforce_login_lock:
+        if rejected_session_id and sf.session_id != rejected_session_id:
+            return sf.session_id  # Another thread already logged in again
+        session_id, _ = SalesforceLogin(
+            username=os.getenv("SALESFORCE_USERNAME"),
+            password=os.getenv("SALESFORCE_PASSWORD"),
+            security_token=os.getenv("SALESFORCE_SECURITY_TOKEN"),
+            session=session
+        )
+        sf.session_id = session_id
+        sf.headers['Authorization'] = f"Bearer {session_id}"
+        print("--- 🔑 Salesforce session renewed ---")
+        return session_id
+
 # --- TOOL DEFINITIONS ---
 
-HISTORY_FILE = "sow_history.json"
+HISTORY_FILE = "sow_history.json" # Import/export format only (see history_store.import_json / export_json)
+
+# Pluggable store: SQLite + FTS5 by default, HISTORY_BACKEND=jsonl for the append-only ledger + inverted index
+history_store = open_history_store()
+HISTORY_SEARCH_LIMIT = int(os.getenv("HISTORY_SEARCH_LIMIT", "50")) # Best-ranked matches returned to chat
 
 def log_deal_to_history(deal_data):
     """
-    Appends a successfully closed deal to the local JSON ledger.
+    Appends a successfully closed deal to the local history store.
     """
     print(f"--- 💾 MEMORY: Attempting to log deal for {deal_data.get('project_name')} ---")
     
-    history = []
-    
-    # 1. Load existing history if file exists
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, 'r') as f:
-                content = f.read()
-                if content.strip(): # Check if not empty
-                    history = json.loads(content)
-        except Exception as e:
-            print(f"⚠️ Warning: Could not read existing history file: {e}. Starting fresh.")
-            history = []
-    
-    # 2. Create Record
+    # 1. Create Record
     # We use .get() with defaults to prevent KeyErrors
     record = {
         "Id": deal_data.get('opportunity_id', 'Unknown'),
@@ -79,61 +107,39 @@ def log_deal_to_history(deal_data):
         "DocuSignLink": f"https://apps-d.docusign.com/send/documents/details/{deal_data.get('envelope_id')}" if deal_data.get('envelope_id') else "N/A"
     }
     
-    # 3. Add to history (Newest first)
-    history.insert(0, record)
-    
-    # 4. Write back to file
+    # 2. Append (no read-modify-write of the whole history)
     try:
-        with open(HISTORY_FILE, 'w') as f:
-            json.dump(history, f, indent=2)
-        print(f"✅ MEMORY: Successfully saved to {HISTORY_FILE}")
+        history_store.append(record)
+        print(f"✅ MEMORY: Successfully saved to {type(history_store).__name__}")
     except Exception as e:
         print(f"❌ MEMORY ERROR: Could not write to file: {e}")
 
 def get_local_history(tool_input: str = "") -> str:
     """
-    Returns the full JSON list of all sent SOWs/closed deals.
+    Returns the full JSON list of all sent SOWs/closed deals (newest first).
     Input is ignored but required by LangChain.
     """
     print("--- Calling Tool: get_local_history ---")
-    if not os.path.exists(HISTORY_FILE):
-        return "[]"
     try:
-        with open(HISTORY_FILE, 'r') as f:
-            return f.read()
+        return history_store.to_json()
     except Exception as e:
         return f"Error reading history: {e}"
 
 def search_history_for_chat(query: str) -> str:
     """
-    Searches the local SOW history. Performs a 'Universal Search' across ALL fields 
-    (Name, Email, ID, Amount, etc.) at once.
+    Searches the local SOW history across project name, contact name and email, amount,
+    close date, status, Opportunity ID and Envelope ID at once, returning the best-ranked matches.
     """
     print(f"--- Calling Tool: search_history_for_chat for: '{query}' ---")
     
-    if not os.path.exists(HISTORY_FILE):
-        print("❌ MEMORY ERROR: sow_history.json not found.")
-        return "No history file found. No SOWs have been sent yet."
-    
     try:
-        with open(HISTORY_FILE, 'r') as f:
-            history = json.load(f)
-            
-        results = []
-        query_terms = query.lower().split() # Split "United Oil" into ["united", "oil"]
-        
-        for record in history:
-            # 1. Create a "Search Blob"
-            # Combine ALL values in the record into one big lowercase string
-            # e.g. "006dm... united oil installations avi green 250000.0 ..."
-            searchable_blob = " ".join([str(v).lower() for v in record.values()])
-            
-            # 2. Universal Match Logic
-            # Check if ALL words in the query exist ANYWHERE in the blob
-            # This handles "United Oil" matching "United Oil Installations"
-            # and "Avi Green" matching "Avi Green"
-            if all(term in searchable_blob for term in query_terms):
-                results.append(record)
+        if not history_store.count():
+            print("❌ MEMORY ERROR: history store is empty.")
+            return "No history file found. No SOWs have been sent yet."
+
+        # Indexed lookup: every word in the query must match a token (or token prefix),
+        # e.g. "United Oil" -> "United Oil Installations", "avi.gr" -> "avi.green@..."
+        results = history_store.search(query, limit=HISTORY_SEARCH_LIMIT)
         
         if not results:
             print(f"⚠️ No matches found for '{query}'")
@@ -149,30 +155,12 @@ def search_history_for_chat(query: str) -> str:
 # --- ADD THIS NEW FUNCTION ---
 def get_docusign_client():
     """
-    Generates a fresh, authenticated DocuSign API client.
-    This is called inside every tool to ensure the token is never expired.
+    Returns an authenticated DocuSign API client.
+    The token is cached and refreshed in the background by the shared token manager,
+    so this no longer does an OAuth round trip on every tool call.
     """
-
-    print(f"--- 🔄 AUTHENTICATING: Requesting a fresh DocuSign token at {datetime.datetime.now()} ---")
     try:
-        api_client = ApiClient()
-        api_client.host = os.getenv("DOCUSIGN_HOST")
-        api_client.oauth_host_name = "account-d.docusign.com"
-
-        # Generate a new token
-        token_response = api_client.request_jwt_user_token(
-            client_id=os.getenv("DOCUSIGN_IK"),
-            user_id=os.getenv("DOCUSIGN_USER_ID"),
-            oauth_host_name="account-d.docusign.com",
-            private_key_bytes=open("docusign_private.key").read(),
-            expires_in=3600,
-            scopes=["signature", "impersonation","extended", "cors", "adm_store_unified_repo_read", "adm_store_unified_repo_write", "document_uploader_read", "document_uploader_write", "aow_manage", "public_dms_document_read", "public_dms_document_write"]
-        )
-        
-        # Attach the token to the client headers
-        api_client.set_default_header("Authorization", "Bearer " + token_response.access_token)
-        return api_client
-        
+        return docusign_tokens.get_api_client()
     except Exception as e:
         print(f"❌ DocuSign Authentication Failed: {e}")
         return None
@@ -180,22 +168,9 @@ def get_docusign_client():
 # tools.py (new tool)
 
 def get_docusign_token():
-    """Generates a raw Access Token string (For Raw API calls)."""
-    print(f"--- 🔄 AUTHENTICATING (Raw): Requesting token at {datetime.datetime.now()} ---")
+    """Returns the raw Access Token string (For Raw API calls) from the shared token manager."""
     try:
-        api_client = ApiClient()
-        api_client.host = os.getenv("DOCUSIGN_HOST")
-        api_client.oauth_host_name = "account-d.docusign.com"
-
-        token_response = api_client.request_jwt_user_token(
-            client_id=os.getenv("DOCUSIGN_IK"),
-            user_id=os.getenv("DOCUSIGN_USER_ID"),
-            oauth_host_name="account-d.docusign.com",
-            private_key_bytes=open("docusign_private.key").read(),
-            expires_in=3600,
-            scopes=["signature", "impersonation","extended", "cors", "adm_store_unified_repo_read", "adm_store_unified_repo_write", "document_uploader_read", "document_uploader_write", "aow_manage", "public_dms_document_read", "public_dms_document_write"]
-        )
-        return token_response.access_token
+        return docusign_tokens.get_token()
     except Exception as e:
         print(f"❌ DocuSign Raw Token Error: {e}")
         return None
@@ -224,7 +199,7 @@ def check_warranty_status(agreement_id: str) -> str:
     }
 
     try:
-        response = requests.get(url, headers=headers)
+        response = docusign_http.get(url, headers=headers, endpoint="navigator.agreement.get")
         
         if response.status_code == 404:
             return f"Agreement {agreement_id} not found in Navigator."
@@ -257,9 +232,13 @@ def check_warranty_status(agreement_id: str) -> str:
 def get_opportunity_line_items(opportunity_id: str) -> str:
     """Fetches the product line items for a Salesforce Opportunity."""
     print(f"--- Calling Tool: get_opportunity_line_items for {opportunity_id} ---")
+    cached = _snapshot_lookup(opportunity_id, "line_items")
+    if cached is not None:
+        print(f"--- ⚡ SNAPSHOT HIT: line items for {opportunity_id} ---")
+        return cached
     try:
         query = f"""
-            SELECT Product2.Name, Quantity, UnitPrice, Description, ServiceDate 
+            SELECT Product2.Name, Quantity, UnitPrice, TotalPrice, Description, ServiceDate 
             FROM OpportunityLineItem 
             WHERE OpportunityId = '{opportunity_id}'
         """
@@ -354,13 +333,10 @@ def create_docgen_sow_envelope(tool_input: str) -> str:
     if not clean_input:
         return "Error: Agent provided empty input. JSON required."
 
-    # 2. Auth
+    # 2. Auth: the shared SDK client for the envelope, the raw token for the DocGen REST calls
+    api_client = get_docusign_client()
     access_token = get_docusign_token()
-    if not access_token: return "Error: DocuSign Auth Failed"
-    
-    api_client = ApiClient()
-    api_client.host = os.getenv("DOCUSIGN_HOST")
-    api_client.set_default_header("Authorization", "Bearer " + access_token)
+    if not api_client or not access_token: return "Error: DocuSign Auth Failed"
     
     envelopes_api = EnvelopesApi(api_client)
     account_id = os.getenv("DOCUSIGN_API_ACCOUNT_ID")
@@ -408,6 +384,8 @@ def create_docgen_sow_envelope(tool_input: str) -> str:
             composite_templates=[comp_template]
         )
 
+        # The DocuSign SDK has its own HTTP client, so SDK calls take their rate-limit token explicitly
+        rate_limits.acquire("docusign")
         draft = envelopes_api.create_envelope(account_id, envelope_definition=envelope_def)
         envelope_id = draft.envelope_id
         print(f"--- Draft Envelope Created: {envelope_id} ---")
@@ -421,7 +399,7 @@ def create_docgen_sow_envelope(tool_input: str) -> str:
         }
         get_url = f"{base_url}/v2.1/accounts/{account_id}/envelopes/{envelope_id}/docGenFormFields"
         
-        response_get = requests.get(get_url, headers=headers)
+        response_get = docusign_http.get(get_url, headers=headers, endpoint="envelope.docGenFormFields.get")
         if response_get.status_code != 200: return f"Error Fetching DocGen Fields: {response_get.text}"
         
         get_data = response_get.json()
@@ -440,7 +418,7 @@ def create_docgen_sow_envelope(tool_input: str) -> str:
                 "docGenFormFieldList": fields_list_raw
             }]
         }
-        response_put = requests.put(put_url, headers=headers, json=request_body)
+        response_put = docusign_http.put(put_url, headers=headers, json=request_body, endpoint="envelope.docGenFormFields.put")
         if response_put.status_code != 200: return f"Error Updating DocGen Fields: {response_put.text}"
 
         # ============================================================
@@ -448,7 +426,7 @@ def create_docgen_sow_envelope(tool_input: str) -> str:
         # ============================================================
         # 4a. Fetch Existing Fields to find the ID
         cf_list_url = f"{base_url}/v2.1/accounts/{account_id}/envelopes/{envelope_id}/custom_fields"
-        cf_response = requests.get(cf_list_url, headers=headers)
+        cf_response = docusign_http.get(cf_list_url, headers=headers, endpoint="envelope.customFields.get")
         field_id = None
         
         if cf_response.status_code == 200:
@@ -471,13 +449,13 @@ def create_docgen_sow_envelope(tool_input: str) -> str:
         # 4c. Update via dedicated endpoint (Not Advanced Update)
         # This endpoint handles upserts correctly if fieldId is provided
         update_url = f"{base_url}/v2.1/accounts/{account_id}/envelopes/{envelope_id}/custom_fields"
-        requests.put(update_url, headers=headers, json=cf_update_body)
+        docusign_http.put(update_url, headers=headers, json=cf_update_body, endpoint="envelope.customFields.put")
 
         # ============================================================
         # STEP 5: SEND ENVELOPE
         # ============================================================
         send_url = f"{base_url}/v2.1/accounts/{account_id}/envelopes/{envelope_id}"
-        response_send = requests.put(send_url, headers=headers, json={ "status": "sent" })
+        response_send = docusign_http.put(send_url, headers=headers, json={ "status": "sent" }, endpoint="envelope.send")
         
         if response_send.status_code != 200:
             return f"Error Sending Envelope: {response_send.text}"
@@ -686,6 +664,7 @@ def create_composite_sow_envelope(tool_input: str) -> str:
 
         # Send
         envelopes_api = EnvelopesApi(api_client)
+        rate_limits.acquire("docusign")
         result = envelopes_api.create_envelope(os.getenv("DOCUSIGN_API_ACCOUNT_ID"), envelope_definition=envelope_def)
         envelope_id = result.envelope_id
         # --- NEW: Log to History ---
@@ -706,6 +685,134 @@ def create_composite_sow_envelope(tool_input: str) -> str:
         print(f"DocuSign API Error Detail: {e}")
         return f"Error generating SOW: {e}"
 
+# --- OPEN OPPORTUNITIES (TTL CACHED) ---
+# The page load, the chat agent's tool call and the chat router's table render all ask for
+# the same pipeline within seconds, so the normalized rows are cached per query for a short TTL.
+# Writes through update_opportunity_stage / update_contact_email patch or invalidate the cache.
+
+OPEN_OPPORTUNITIES_QUERY = """
+    SELECT Id, Name, Amount, CloseDate, 
+           (SELECT Contact.Id, Contact.Name, Contact.Email 
+            FROM OpportunityContactRoles 
+            WHERE IsPrimary = true LIMIT 1),
+           (SELECT Id FROM OpportunityLineItems)
+    FROM Opportunity 
+    WHERE StageName != 'Closed Won' AND IsClosed = false 
+    ORDER BY Amount DESC
+"""
+open_opportunities_cache = TTLCache(ttl_seconds=int(os.getenv("OPEN_OPPS_CACHE_TTL", "60")))
+
+def _normalize_open_opportunity(opp):
+    """Flattens the nested contact role / line item subqueries into UI columns."""
+    # --- 1. Process Contact Info (For UI Display & Editing) ---
+    contact_roles = opp.get('OpportunityContactRoles')
+    if contact_roles and contact_roles['records']:
+        contact = contact_roles['records'][0]['Contact']
+        opp['PrimaryContactId'] = contact['Id']
+        opp['PrimaryContactName'] = contact['Name']
+        opp['PrimaryContactEmail'] = contact['Email']
+    else:
+        opp['PrimaryContactId'] = None
+        opp['PrimaryContactName'] = 'N/A'
+        opp['PrimaryContactEmail'] = 'N/A'
+
+    # --- 2. Process Product Count (For UI Badge) ---
+    line_items = opp.get('OpportunityLineItems')
+    if line_items and line_items.get('records'):
+        opp['ProductCount'] = len(line_items['records'])
+    else:
+        opp['ProductCount'] = 0
+
+    # --- 3. Cleanup Nested Objects ---
+    if 'OpportunityContactRoles' in opp: del opp['OpportunityContactRoles']
+    if 'OpportunityLineItems' in opp: del opp['OpportunityLineItems']
+    if 'attributes' in opp: del opp['attributes']
+    return opp
+
+def iter_open_opportunities(query=OPEN_OPPORTUNITIES_QUERY):
+    """
+    Yields normalized open Opportunities. query_all_iter follows queryMore (nextRecordsUrl),
+    so pipelines larger than one 2000-record batch are returned in full, one batch at a time.
+    """
+    for opp in sf.query_all_iter(query):
+        yield _normalize_open_opportunity(opp)
+
+def _load_open_opportunities(query):
+    """
+    The whole open pipeline as a list, for the cache. page_open_opportunities filters, sorts and
+    counts across every row, so the normalized rows are held in memory (once per TTL); only the
+    raw API batches are dropped as they are consumed.
+    """
+    return list(iter_open_opportunities(query))
+
+# --- PAGED ACCESS (for /api/opportunities and the chat table) ---
+
+OPEN_OPPORTUNITY_SORT_FIELDS = {"Amount", "CloseDate", "Name", "ProductCount", "PrimaryContactName"}
+
+def _encode_cursor(offset):
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode()).decode()
+
+def _decode_cursor(cursor):
+    if not cursor:
+        return 0
+    try:
+        return max(0, int(json.loads(base64.urlsafe_b64decode(cursor.encode()))["offset"]))
+    except Exception:
+        raise ValueError("Invalid cursor.")
+
+def page_open_opportunities(cursor=None, limit=50, sort="Amount", order="desc", q=None, min_amount=None, max_amount=None, records=None):
+    """
+    Returns one page of the open pipeline:
+    { "records": [...], "next_cursor": str|None, "total": int, "cache_age": float }
+
+    Filtering and sorting run over the cached, normalized rows; 'cursor' is the opaque
+    value returned as 'next_cursor' by the previous page. Raises ValueError on bad parameters.
+    'records' pages over rows the caller already holds (e.g. the agent's tool output) instead of the cache.
+    """
+    if sort not in OPEN_OPPORTUNITY_SORT_FIELDS:
+        raise ValueError(f"Unsupported sort field '{sort}'.")
+    limit = max(1, min(int(limit), 500))
+    offset = _decode_cursor(cursor)
+
+    if records is None:
+        records, cache_age = get_open_opportunities_with_age()
+    else:
+        cache_age = 0.0
+
+    rows = records
+    if q:
+        needle = q.lower()
+        rows = [r for r in rows if needle in f"{r.get('Name', '')} {r.get('PrimaryContactName', '')} {r.get('PrimaryContactEmail', '')}".lower()]
+    if min_amount is not None:
+        rows = [r for r in rows if (r.get('Amount') or 0) >= float(min_amount)]
+    if max_amount is not None:
+        rows = [r for r in rows if (r.get('Amount') or 0) <= float(max_amount)]
+
+    # None values sort last regardless of direction
+    present = [r for r in rows if r.get(sort) is not None]
+    missing = [r for r in rows if r.get(sort) is None]
+    rows = sorted(present, key=lambda r: r[sort], reverse=(order == "desc")) + missing
+
+    page = rows[offset:offset + limit]
+    next_offset = offset + len(page)
+    return {
+        "records": page,
+        "next_cursor": _encode_cursor(next_offset) if next_offset < len(rows) else None,
+        "total": len(rows),
+        "cache_age": round(cache_age, 1),
+    }
+
+def get_open_opportunities_with_age(force_refresh=False):
+    """
+    Returns (records, cache_age_seconds) for the open pipeline.
+    Concurrent callers share a single Salesforce fetch. Raises on Salesforce errors.
+    """
+    if force_refresh:
+        open_opportunities_cache.invalidate(OPEN_OPPORTUNITIES_QUERY)
+    return open_opportunities_cache.get_or_load(
+        OPEN_OPPORTUNITIES_QUERY, lambda: _load_open_opportunities(OPEN_OPPORTUNITIES_QUERY)
+    )
+
 # We add 'tool_input' to swallow whatever the Agent sends
 def get_open_opportunities(tool_input: str = "") -> str:
     """
@@ -716,48 +823,12 @@ def get_open_opportunities(tool_input: str = "") -> str:
     """
     print("--- Calling Tool: get_open_opportunities ---")
     try:
-        # Updated Query: Fetches Contact Roles AND Line Items in one go
-        query = """
-            SELECT Id, Name, Amount, CloseDate, 
-                   (SELECT Contact.Id, Contact.Name, Contact.Email 
-                    FROM OpportunityContactRoles 
-                    WHERE IsPrimary = true LIMIT 1),
-                   (SELECT Id FROM OpportunityLineItems)
-            FROM Opportunity 
-            WHERE StageName != 'Closed Won' AND IsClosed = false 
-            ORDER BY Amount DESC
-        """
-        result = sf.query(query)
-        records = result.get('records', [])
-        
+        records, cache_age = get_open_opportunities_with_age()
+        if cache_age:
+            print(f"--- ⚡ CACHE HIT: open opportunities ({cache_age:.0f}s old) ---")
+
         if not records:
             return "[]"
-
-        for opp in records:
-            # --- 1. Process Contact Info (For UI Display & Editing) ---
-            contact_roles = opp.get('OpportunityContactRoles')
-            if contact_roles and contact_roles['records']:
-                contact = contact_roles['records'][0]['Contact']
-                opp['PrimaryContactId'] = contact['Id']
-                opp['PrimaryContactName'] = contact['Name']
-                opp['PrimaryContactEmail'] = contact['Email']
-            else:
-                opp['PrimaryContactId'] = None
-                opp['PrimaryContactName'] = 'N/A'
-                opp['PrimaryContactEmail'] = 'N/A'
-            
-            # --- 2. Process Product Count (For UI Badge) ---
-            line_items = opp.get('OpportunityLineItems')
-            if line_items and line_items.get('records'):
-                opp['ProductCount'] = len(line_items['records'])
-            else:
-                opp['ProductCount'] = 0
-
-            # --- 3. Cleanup Nested Objects ---
-            if 'OpportunityContactRoles' in opp: del opp['OpportunityContactRoles']
-            if 'OpportunityLineItems' in opp: del opp['OpportunityLineItems']
-            if 'attributes' in opp: del opp['attributes']
-            
         return json.dumps(records)
     except Exception as e:
         return f"Salesforce API Error: {e}"
@@ -770,6 +841,10 @@ def get_opportunity_details(opportunity_id: str) -> str:
     print(
         f"--- Calling Tool: get_opportunity_details with cleaned ID {cleaned_id} ---"
     )
+    cached = _snapshot_lookup(cleaned_id, "details")
+    if cached is not None:
+        print(f"--- ⚡ SNAPSHOT HIT: details for {cleaned_id} ---")
+        return cached
     try:
         query = f"""
             SELECT Name, Amount, StageName, Description, 
@@ -784,33 +859,104 @@ def get_opportunity_details(opportunity_id: str) -> str:
         if result['totalSize'] == 0:
             return f"Error: No Opportunity found with ID {opportunity_id}"
 
-        record = result['records'][0]
-        account = record.get('Account', {})
-
-        # Extract Account Name
-        account_name = record['Account']['Name'] if record['Account'] else "Unknown Account"
-
-        contact_roles = record.get('OpportunityContactRoles')
-        if not contact_roles or contact_roles['totalSize'] == 0:
-            return f"Error: No Primary Contact found for Opportunity {record['Name']}"
-
-        contact = contact_roles['records'][0]['Contact']
-        # Format a rich context string for the AI
-        details = json.dumps({
-            "Opportunity": record['Name'],
-            "Amount": record['Amount'],
-            "Stage": record['StageName'],
-            "Opp_Description": record.get('Description', 'No description provided.'),
-            "Account": account.get('Name'),
-            "Industry": account.get('Industry', 'Unknown Industry'),
-            "Account_Context": account.get('Description', 'No account details.'),
-            "Contact_Name": contact['Name'],
-            "Contact_Email": contact['Email']
-        })
-        return details
+        return _format_opportunity_details(result['records'][0])
     except Exception as e:
         return f"Salesforce API Error: {e}"
 
+def _format_opportunity_details(record):
+    """Formats an Opportunity record (with Account and primary contact) into the rich context string for the AI."""
+    account = record.get('Account') or {}
+
+    contact_roles = record.get('OpportunityContactRoles')
+    if not contact_roles or contact_roles['totalSize'] == 0:
+        return f"Error: No Primary Contact found for Opportunity {record['Name']}"
+
+    contact = contact_roles['records'][0]['Contact']
+    # Format a rich context string for the AI
+    return json.dumps({
+        "Opportunity": record['Name'],
+        "Amount": record['Amount'],
+        "Stage": record['StageName'],
+        "Opp_Description": record.get('Description', 'No description provided.'),
+        "Account": account.get('Name'),
+        "Industry": account.get('Industry', 'Unknown Industry'),
+        "Account_Context": account.get('Description', 'No account details.'),
+        "Contact_Name": contact['Name'],
+        "Contact_Email": contact['Email']
+    })
+
+# --- BULK PREFETCH (PER-TASK SNAPSHOT) ---
+# start_closing prefetches details + line items for every selected Opportunity with a few
+# 'WHERE Id IN (...)' queries. The snapshot is activated inside each deal thread, so the
+# 'Get Opportunity Details' / 'Get Line Items' tools answer from memory instead of Salesforce.
+
+SOQL_ID_CHUNK_SIZE = 200  # 200 quoted ids (~4KB) keeps each query far below the SOQL length limit
+_SF_ID_PATTERN = re.compile(r"^[a-zA-Z0-9]{15}(?:[a-zA-Z0-9]{3})?$")
+_active_snapshot = contextvars.ContextVar("opportunity_snapshot", default=None)
+
+def _soql_id_chunks(opportunity_ids):
+    ids = [i.strip() for i in opportunity_ids if i and _SF_ID_PATTERN.match(i.strip())]
+    ids = list(dict.fromkeys(ids)) # De-duplicate, keep order
+    for i in range(0, len(ids), SOQL_ID_CHUNK_SIZE):
+        yield ", ".join(f"'{opp_id}'" for opp_id in ids[i:i + SOQL_ID_CHUNK_SIZE])
+
+def prefetch_opportunity_snapshot(opportunity_ids):
+    """
+    Loads details and line items for many Opportunities in bulk.
+    Returns { opp_id: {"details": str, "line_items": str} } holding exactly what the
+    single-record tools would have returned. Returns {} on failure (tools then query live).
+    """
+    print(f"--- 📦 PREFETCH: Loading {len(opportunity_ids)} opportunities in bulk ---")
+    snapshot = {}
+    try:
+        for id_list in _soql_id_chunks(opportunity_ids):
+            details_query = f"""
+                SELECT Id, Name, Amount, StageName, Description, 
+                       Account.Name, Account.Industry, Account.Description,
+                       (SELECT Contact.Name, Contact.Email 
+                        FROM OpportunityContactRoles 
+                        WHERE IsPrimary = true LIMIT 1) 
+                FROM Opportunity 
+                WHERE Id IN ({id_list})
+            """
+            for record in sf.query_all(details_query).get('records', []):
+                snapshot[record['Id']] = {
+                    "details": _format_opportunity_details(record),
+                    "line_items": "No line items found."
+                }
+
+            items_query = f"""
+                SELECT OpportunityId, Product2.Name, Quantity, UnitPrice, TotalPrice, Description, ServiceDate 
+                FROM OpportunityLineItem 
+                WHERE OpportunityId IN ({id_list})
+            """
+            grouped = {}
+            for item in sf.query_all(items_query).get('records', []):
+                grouped.setdefault(item.pop('OpportunityId'), []).append(item)
+            for opp_id, items in grouped.items():
+                if opp_id in snapshot:
+                    snapshot[opp_id]["line_items"] = json.dumps(items)
+
+        # Allow lookups by the 15-character form of the Id as well
+        for opp_id in list(snapshot):
+            snapshot.setdefault(opp_id[:15], snapshot[opp_id])
+
+        print(f"✅ PREFETCH: Cached {len(snapshot)} opportunity keys.")
+        return snapshot
+    except Exception as e:
+        print(f"⚠️ PREFETCH failed, tools will query Salesforce directly: {e}")
+        return {}
+
+def use_opportunity_snapshot(snapshot):
+    """Activates a prefetched snapshot for the current thread / context (call at the start of a deal thread)."""
+    _active_snapshot.set(snapshot or None)
+
+def _snapshot_lookup(opportunity_id, field):
+    snapshot = _active_snapshot.get()
+    if not snapshot:
+        return None
+    entry = snapshot.get(str(opportunity_id).strip().strip("'\""))
+    return entry.get(field) if entry else None
 
 def create_and_send_docusign_from_template(tool_input: str) -> str:
     """
@@ -856,6 +1002,7 @@ def create_and_send_docusign_from_template(tool_input: str) -> str:
 
     try:
         envelopes_api = EnvelopesApi(api_client)
+        rate_limits.acquire("docusign")
         results = envelopes_api.create_envelope(
             account_id=os.getenv("DOCUSIGN_API_ACCOUNT_ID"),
             envelope_definition=envelope_definition)
@@ -874,6 +1021,7 @@ def get_docusign_envelope_status(envelope_id: str) -> str:
         return "Error: DocuSign API client is not authenticated."
     try:
         envelopes_api = EnvelopesApi(api_client)
+        rate_limits.acquire("docusign")
         results = envelopes_api.get_envelope(
             account_id=os.getenv("DOCUSIGN_API_ACCOUNT_ID"),
             envelope_id=envelope_id)
@@ -901,13 +1049,138 @@ def update_opportunity_stage(tool_input: str) -> str:
     try:
         sf.Opportunity.update(opportunity_id.strip(),
                               {'StageName': new_stage.strip()})
+        _on_opportunity_stage_changed(opportunity_id.strip(), new_stage.strip())
         return f"Successfully updated Opportunity {opportunity_id} to {new_stage}."
     except Exception as e:
         return f"Salesforce API Error: {e}"
 
 
+# --- BULK STAGE UPDATES (Bulk API 2.0) ---
+# Quarter-end bursts move hundreds of deals at once. Below BULK_STAGE_UPDATE_THRESHOLD the
+# updates go out one REST call each; at or above it they are sent as one Bulk API 2.0 job.
+
+def _single_stage_update(opportunity_id, new_stage):
+    session_id = sf.session_id
+    try:
+        sf.Opportunity.update(opportunity_id, {'StageName': new_stage})
+    except SalesforceExpiredSession:
+        refresh_salesforce_session(session_id)
+        sf.Opportunity.update(opportunity_id, {'StageName': new_stage})
+
+stage_updater = BulkStageUpdater(
+    base_url=sf.base_url,
+    session_id=lambda: sf.session_id,  # Read per request: the session is renewed on expiry
+    single_update=_single_stage_update,
+    transport=salesforce_http,
+    relogin=refresh_salesforce_session
+)
+
+def bulk_update_opportunity_stages(tool_input: str) -> str:
+    """
+    Updates the stage of many Salesforce Opportunities at once. The input must be a JSON string with
+    'opportunity_ids' (list) and 'new_stage', or 'updates': [{"opportunity_id": ..., "new_stage": ...}].
+    Large batches are sent as a single Bulk API 2.0 job. Returns a per-record summary.
+    """
+    print(f"--- Calling Tool: bulk_update_opportunity_stages ---")
+    try:
+        args = json.loads(tool_input)
+        if 'updates' in args:
+            updates = [(u['opportunity_id'], u['new_stage']) for u in args['updates']]
+        else:
+            updates = [(opp_id, args['new_stage']) for opp_id in args['opportunity_ids']]
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        return f"Error: Invalid input format. Details: {e}"
+
+    updates = {opp_id.strip(): stage.strip() for opp_id, stage in updates}
+    results = stage_updater.apply(updates)
+
+    for opp_id, outcome in results.items():
+        if outcome['success']:
+            _on_opportunity_stage_changed(opp_id, updates[opp_id])
+
+    failed = {opp_id: r['error'] for opp_id, r in results.items() if not r['success']}
+    summary = f"Updated {len(results) - len(failed)} of {len(results)} Opportunities."
+    if failed:
+        summary += f" Failures: {json.dumps(failed)}"
+    return summary
+
+def _on_opportunity_stage_changed(opportunity_id, new_stage):
+    """Write-through for the open opportunities cache."""
+    if new_stage == 'Closed Won':
+        # Drop the row; it no longer matches the open pipeline query
+        open_opportunities_cache.patch(
+            lambda rows: [r for r in rows if (r.get('Id') or '')[:15] != opportunity_id[:15]]
+        )
+    else:
+        # Other stages may or may not close the deal (IsClosed): refetch on next read
+        open_opportunities_cache.invalidate()
+
+def _on_contact_email_changed(contact_id, new_email):
+    """Write-through for the open opportunities cache."""
+    open_opportunities_cache.patch(
+        lambda rows: [dict(r, PrimaryContactEmail=new_email) if r.get('PrimaryContactId') == contact_id else r for r in rows]
+    )
+
 # tools.py (Final Version of the function)
 
+# --- STREAMING DOCUMENT TRANSFER (DocuSign -> temp file -> Salesforce multipart) ---
+# The signed package is never held in memory: it is spooled to disk in 1 MB chunks and
+# uploaded to ContentVersion with a multipart/form-data body read straight from that file.
+
+def _envelope_marker(envelope_id):
+    """ContentVersion.Description of an attached signed contract: the idempotency key of finalization."""
+    return f"DocuSign Envelope {envelope_id}"
+
+def _spool_envelope_document(envelope_id, spool, cancel=None):
+    """
+    Streams the combined signed PDF of an envelope into the open binary file 'spool'. Returns the size in bytes.
+    Setting the threading.Event 'cancel' stops the transfer at the next chunk.
+    """
+    access_token = get_docusign_token()
+    if not access_token:
+        raise RuntimeError("DocuSign API client is not authenticated.")
+
+    url = f"{os.getenv('DOCUSIGN_HOST')}/v2.1/accounts/{os.getenv('DOCUSIGN_API_ACCOUNT_ID')}/envelopes/{envelope_id}/documents/combined"
+    response = docusign_http.get(url, headers={"Authorization": f"Bearer {access_token}"}, stream=True, endpoint="envelope.documents.combined.get")
+    try:
+        if response.status_code != 200:
+            raise RuntimeError(f"DocuSign API Error ({response.status_code}): {response.text}")
+        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError(f"Download of envelope {envelope_id} cancelled")
+            spool.write(chunk)
+    finally:
+        response.close()
+
+    size = spool.tell()
+    spool.seek(0)
+    print(f"--- Document spooled from DocuSign ({size / 1024:.0f} KB) ---")
+    return size
+
+def _upload_content_version_stream(spool, file_name, record_id, envelope_id=None):
+    """Creates a ContentVersion from an open file using the multipart endpoint. Returns the Salesforce JSON response."""
+    fields = {
+        'Title': file_name,
+        'PathOnClient': file_name,
+        'FirstPublishLocationId': record_id
+    }
+    if envelope_id:
+        fields['Description'] = _envelope_marker(envelope_id)
+    entity = json.dumps(fields).encode('utf-8')
+    body = MultipartFileStream([
+        ('Content-Disposition: form-data; name="entity_content"\r\nContent-Type: application/json', entity),
+        (f'Content-Disposition: form-data; name="VersionData"; filename="{file_name}"\r\nContent-Type: application/octet-stream', spool)
+    ])
+    response = salesforce_http.post(
+        f"{sf.base_url}sobjects/ContentVersion",
+        data=body,
+        headers={"Authorization": f"Bearer {sf.session_id}", "Content-Type": body.content_type},
+        endpoint="sobjects.ContentVersion.multipart"
+    )
+    if response.status_code >= 400:
+        raise RuntimeError(f"Salesforce API Error ({response.status_code}): {response.text}")
+    return response.json()
+
 def download_and_attach_document_to_salesforce(tool_input: str) -> str:
     """
     Downloads a signed document from a completed DocuSign envelope and attaches it directly
@@ -915,9 +1188,6 @@ def download_and_attach_document_to_salesforce(tool_input: str) -> str:
     'envelope_id', 'record_id' (the Opportunity ID), and 'file_name'.
     """
     print(f"--- Calling Tool: download_and_attach_document_to_salesforce with input {tool_input} ---")
-    api_client = get_docusign_client()
-    if not api_client:
-        return "Error: DocuSign API client is not authenticated."
 
     try:
         args = json.loads(tool_input)
@@ -928,28 +1198,13 @@ def download_and_attach_document_to_salesforce(tool_input: str) -> str:
         return f"Error: Invalid input format. Details: {e}"
 
     try:
-        # Step 1: Get the document content DIRECTLY from DocuSign as bytes
-        envelopes_api = EnvelopesApi(api_client)
-        # This API call returns the file content as a bytes object
-        file_content_bytes = envelopes_api.get_document(
-            account_id=os.getenv("DOCUSIGN_API_ACCOUNT_ID"),
-            envelope_id=envelope_id,
-            document_id="combined"
-        )
-        print(f"--- Document content received from DocuSign (type: {type(file_content_bytes)}) ---")
+        with tempfile.TemporaryFile() as spool:
+            # Step 1: Stream the document from DocuSign to a temp file
+            _spool_envelope_document(envelope_id, spool)
 
-        # Step 2: Base64 encode the bytes and attach to Salesforce
-        file_content_base64 = base64.b64encode(file_content_bytes).decode('utf-8')
+            # Step 2: Stream the temp file to Salesforce as multipart/form-data
+            result = _upload_content_version_stream(spool, file_name, record_id, envelope_id)
 
-        content_version_data = {
-            'Title': file_name,
-            'PathOnClient': file_name,
-            'VersionData': file_content_base64,
-            'FirstPublishLocationId': record_id
-        }
-        
-        result = sf.ContentVersion.create(content_version_data)
-        
         if result.get('success'):
             return f"Successfully attached file '{file_name}' to Salesforce record {record_id}."
         else:
@@ -958,6 +1213,266 @@ def download_and_attach_document_to_salesforce(tool_input: str) -> str:
             
     except Exception as e:
         return f"An error occurred during the download/attach process: {type(e).__name__} - {e}"
+
+# --- COMPOSITE WRITES (attach + close in one round trip) ---
+# Salesforce's Composite API runs up to 25 subrequests in a single HTTP call. Each deal needs
+# two (ContentVersion insert + Opportunity stage update), so one request closes 12 deals.
+
+COMPOSITE_MAX_SUBREQUESTS = 25
+# Above this size the PDF is streamed via multipart instead of inlined as base64 JSON
+COMPOSITE_INLINE_MAX_BYTES = int(os.getenv("COMPOSITE_INLINE_MAX_BYTES", str(5 * 1024 * 1024)))
+
+def _composite_subrequests(deal, index):
+    """Builds the ContentVersion insert + Opportunity update pair for one deal."""
+    base = f"/services/data/v{sf.sf_version}/sobjects"
+    content_version = {
+        "Title": deal['file_name'],
+        "PathOnClient": deal['file_name'],
+        "VersionData": base64.b64encode(deal['file_bytes']).decode('utf-8'),
+        "FirstPublishLocationId": deal['opportunity_id']
+    }
+    if deal.get('envelope_id'):
+        content_version["Description"] = _envelope_marker(deal['envelope_id'])
+    return [
+        {
+            "method": "POST",
+            "url": f"{base}/ContentVersion",
+            "referenceId": f"attach_{index}",
+            "body": content_version
+        },
+        {
+            "method": "PATCH",
+            "url": f"{base}/Opportunity/{deal['opportunity_id']}",
+            "referenceId": f"stage_{index}",
+            "body": {"StageName": deal.get('new_stage', 'Closed Won')}
+        }
+    ]
+
+def _send_composite(deals):
+    """Sends one allOrNone Composite request. Returns {opp_id: error_list_or_None}."""
+    sub_requests = []
+    for i, deal in enumerate(deals):
+        sub_requests.extend(_composite_subrequests(deal, i))
+
+    response = sf.restful('composite', method='POST', data=json.dumps({
+        "allOrNone": True,
+        "compositeRequest": sub_requests
+    }))
+
+    outcome = {deal['opportunity_id']: None for deal in deals}
+    for item in response.get('compositeResponse', []):
+        if item.get('httpStatusCode', 500) >= 400:
+            index = int(item['referenceId'].split('_')[1])
+            opp_id = deals[index]['opportunity_id']
+            errors = item.get('body') if isinstance(item.get('body'), list) else [item.get('body')]
+            outcome[opp_id] = (outcome[opp_id] or []) + [e.get('message', str(e)) if isinstance(e, dict) else str(e) for e in errors]
+    return outcome
+
+def composite_finalize_deals(deals):
+    """
+    Attaches the signed PDF and moves the stage for many Opportunities using Composite requests.
+
+    deals: [{"opportunity_id": ..., "file_name": ..., "file_bytes": b"...", "new_stage": "Closed Won", "envelope_id": ...}]
+    Returns {opp_id: {"success": bool, "errors": [...]}}
+
+    Each request is all-or-none. If a packed request fails, its deals are resent one per
+    request so a single bad record cannot roll back the others.
+    """
+    per_request = COMPOSITE_MAX_SUBREQUESTS // 2
+    results = {}
+    for i in range(0, len(deals), per_request):
+        chunk = deals[i:i + per_request]
+        try:
+            outcome = _send_composite(chunk)
+        except Exception as e:
+            outcome = {deal['opportunity_id']: [str(e)] for deal in chunk}
+
+        if len(chunk) > 1 and any(outcome.values()):
+            # allOrNone rolled back the whole chunk: isolate the failing deal(s)
+            print(f"⚠️ Composite batch of {len(chunk)} rolled back, retrying deals individually...")
+            outcome = {}
+            for deal in chunk:
+                try:
+                    outcome.update(_send_composite([deal]))
+                except Exception as e:
+                    outcome[deal['opportunity_id']] = [str(e)]
+
+        stages = {deal['opportunity_id']: deal.get('new_stage', 'Closed Won') for deal in chunk}
+        for opp_id, errors in outcome.items():
+            results[opp_id] = {"success": not errors, "errors": errors or []}
+            if not errors:
+                _on_opportunity_stage_changed(opp_id, stages[opp_id])
+    return results
+
+def _attach_and_close_spooled(spool, size, record_id, file_name, new_stage, envelope_id=None):
+    """Attaches an already spooled document and moves the stage. Returns {"success": bool, "errors": [...]}."""
+    if size <= COMPOSITE_INLINE_MAX_BYTES:
+        # Small enough to inline as base64: one all-or-none Composite request
+        return composite_finalize_deals([{
+            "opportunity_id": record_id,
+            "file_name": file_name,
+            "file_bytes": spool.read(),
+            "new_stage": new_stage,
+            "envelope_id": envelope_id
+        }])[record_id]
+
+    # Large package: stream the upload, then move the stage
+    upload = _upload_content_version_stream(spool, file_name, record_id, envelope_id)
+    if not upload.get('success'):
+        return {"success": False, "errors": [f"Attach failed: {upload.get('errors', 'Unknown error')}"]}
+    sf.Opportunity.update(record_id, {'StageName': new_stage})
+    _on_opportunity_stage_changed(record_id, new_stage)
+    return {"success": True, "errors": []}
+
+def attach_and_close_opportunity(tool_input: str) -> str:
+    """
+    Downloads the signed document from a completed DocuSign envelope, attaches it to the
+    Opportunity AND updates its stage in one all-or-none Salesforce Composite request.
+    The input must be a JSON string with 'envelope_id', 'record_id' (the Opportunity ID),
+    'file_name' and optionally 'new_stage' (defaults to 'Closed Won').
+    """
+    print(f"--- Calling Tool: attach_and_close_opportunity with input {tool_input} ---")
+    try:
+        args = json.loads(tool_input)
+        envelope_id = args['envelope_id']
+        record_id = args['record_id'].strip()
+        file_name = args['file_name']
+        new_stage = args.get('new_stage', 'Closed Won')
+    except (json.JSONDecodeError, KeyError, AttributeError) as e:
+        return f"Error: Invalid input format. Details: {e}"
+
+    try:
+        with tempfile.TemporaryFile() as spool:
+            size = _spool_envelope_document(envelope_id, spool)
+            result = _attach_and_close_spooled(spool, size, record_id, file_name, new_stage, envelope_id)
+
+        if result['success']:
+            return f"Successfully attached file '{file_name}' and updated Opportunity {record_id} to {new_stage}."
+        return f"Salesforce API Error during composite update: {result['errors']}"
+    except Exception as e:
+        return f"An error occurred during the attach/close process: {type(e).__name__} - {e}"
+
+# --- DETERMINISTIC FINALIZATION (webhook fast path, no LLM) ---
+# The DocuSign download and the Salesforce state check are independent, so they run in
+# parallel; the document is then streamed to ContentVersion. Stage changes are collected
+# across the whole batch of envelopes and applied through stage_updater, so a quarter-end
+# burst of signed contracts becomes one Bulk API job. DocuSign Connect redelivers
+# webhooks, so a deal that is already attached and closed is skipped.
+# Attachments are matched on the envelope id stamped into their Description, not on the
+# file name: every signed contract of an Opportunity is called Signed_Contract.pdf.
+
+def opportunity_finalize_state(opportunity_id, envelope_id):
+    """Returns (current_stage, already_attached) for the idempotency check."""
+    result = sf.query(f"""
+        SELECT StageName,
+               (SELECT ContentDocument.Description FROM ContentDocumentLinks)
+        FROM Opportunity
+        WHERE Id = '{opportunity_id}'
+    """)
+    if result['totalSize'] == 0:
+        raise RuntimeError(f"No Opportunity found with ID {opportunity_id}")
+    record = result['records'][0]
+    links = (record.get('ContentDocumentLinks') or {}).get('records', [])
+    marker = _envelope_marker(envelope_id)
+    attached = any(marker in ((link.get('ContentDocument') or {}).get('Description') or '') for link in links)
+    return record['StageName'], attached
+
+FINALIZE_ATTACH_THREADS = int(os.getenv("FINALIZE_ATTACH_THREADS", "8"))
+
+def _attach_signed_envelope(envelope_id, opportunity_id, file_name, timings):
+    """
+    Attaches the signed document unless it already is. Returns the Opportunity's current stage.
+    The stage itself is left to the caller, which applies it together with the rest of the batch.
+    """
+    def _timed(step, fn, *args):
+        step_started = time.monotonic()
+        try:
+            return fn(*args)
+        finally:
+            timings[step] = round(time.monotonic() - step_started, 3)
+
+    # Leaving the pool waits for the download thread, so a download that is no longer needed
+    # is told to stop at its next chunk instead of running to the end
+    cancel = threading.Event()
+    with tempfile.TemporaryFile() as spool, ThreadPoolExecutor(max_workers=2) as pool:
+        download = pool.submit(_timed, "docusign_download", _spool_envelope_document, envelope_id, spool, cancel)
+        check = pool.submit(_timed, "salesforce_check", opportunity_finalize_state, opportunity_id, envelope_id)
+        try:
+            stage, attached = check.result()
+        except Exception as e:
+            cancel.set()
+            raise RuntimeError(f"Salesforce state check failed: {e}") from e
+
+        if attached:
+            # Redelivered webhook: never attach the same contract twice
+            cancel.set()
+            return stage, False
+
+        download.result()
+        upload = _timed("salesforce_attach", _upload_content_version_stream, spool, file_name, opportunity_id, envelope_id)
+        if not upload.get('success'):
+            raise RuntimeError(f"Attach failed: {upload.get('errors', 'Unknown error')}")
+    return stage, True
+
+def finalize_signed_envelopes(deals, file_name="Signed_Contract.pdf", new_stage="Closed Won"):
+    """
+    Finalizes a batch of completed envelopes without the agent: attaches each signed document,
+    then moves every stage that still differs through stage_updater in one go (a Bulk API job
+    at or above BULK_STAGE_UPDATE_THRESHOLD). 'deals' is a list of {"envelope_id", "opportunity_id"}.
+    Returns {envelope_id: {"success": bool, "skipped": bool, "attached": bool, "errors": [...], "timings": {step: seconds}}},
+    where "attached" means the signed document is on the Opportunity (only the stage may be missing).
+    """
+    started = time.monotonic()
+    deals = [dict(deal, opportunity_id=deal["opportunity_id"].strip()) for deal in deals]
+    results = {}
+    stages = {}
+
+    def attach(deal):
+        timings = {}
+        try:
+            stage, attached_now = _attach_signed_envelope(deal["envelope_id"], deal["opportunity_id"], file_name, timings)
+            return deal, stage, attached_now, None, timings
+        except Exception as e:
+            return deal, None, False, f"{type(e).__name__} - {e}", timings
+
+    with ThreadPoolExecutor(max_workers=max(1, min(FINALIZE_ATTACH_THREADS, len(deals)))) as pool:
+        for deal, stage, attached_now, error, timings in pool.map(attach, deals):
+            envelope_id = deal["envelope_id"]
+            if error:
+                results[envelope_id] = {"success": False, "skipped": False, "attached": False, "errors": [error], "timings": timings}
+                continue
+            results[envelope_id] = {"success": True, "skipped": not attached_now and stage == new_stage, "attached": True, "errors": [], "timings": timings}
+            if stage != new_stage:
+                stages[envelope_id] = deal["opportunity_id"]
+
+    if stages:
+        stage_started = time.monotonic()
+        outcomes = stage_updater.apply({opp_id: new_stage for opp_id in stages.values()})
+        stage_seconds = round(time.monotonic() - stage_started, 3)
+        for envelope_id, opp_id in stages.items():
+            outcome = outcomes.get(opp_id) or {"success": False, "error": "No result from the stage update"}
+            results[envelope_id]["timings"]["salesforce_stage"] = stage_seconds
+            if outcome["success"]:
+                _on_opportunity_stage_changed(opp_id, new_stage)
+            else:
+                # The document is attached (or was already): a retry only has to move the stage
+                results[envelope_id].update(success=False, errors=[f"Stage update failed: {outcome['error']}"])
+
+    total = round(time.monotonic() - started, 3)
+    for deal in deals:
+        result = results[deal["envelope_id"]]
+        result["timings"]["total"] = total
+        print(f"⏱️ FINALIZE: Opp {deal['opportunity_id']} / envelope {deal['envelope_id']}: {result['timings']}")
+    return results
+
+def finalize_signed_envelope(envelope_id, opportunity_id, file_name="Signed_Contract.pdf", new_stage="Closed Won"):
+    """
+    Attaches the signed document of a completed envelope and moves the Opportunity stage without the agent.
+    Returns {"success": bool, "skipped": bool, "attached": bool, "errors": [...], "timings": {step: seconds}}.
+    """
+    deal = {"envelope_id": envelope_id, "opportunity_id": opportunity_id}
+    return finalize_signed_envelopes([deal], file_name, new_stage)[envelope_id]
+
 def update_contact_email(tool_input: str) -> str:
     """Updates the email address for a specific Salesforce Contact. The input must be a JSON string with the keys 'contact_id' and 'new_email'."""
     print(f"--- Calling Tool: update_contact_email with input {tool_input} ---")
@@ -970,6 +1485,7 @@ def update_contact_email(tool_input: str) -> str:
 
     try:
         sf.Contact.update(contact_id, {'Email': new_email})
+        _on_contact_email_changed(contact_id, new_email)
         return f"Successfully updated email for Contact {contact_id}."
     except Exception as e:
         return f"Salesforce API Error: {e}"
\ No newline at end of file
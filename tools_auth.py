@@ -0,0 +1,162 @@
+# tools_auth.py
+import os
+import time
+import datetime
+import threading
+from docusign_esign import ApiClient
+
+DOCUSIGN_OAUTH_HOST = "account-d.docusign.com"
+DOCUSIGN_SCOPES = ["signature", "impersonation", "extended", "cors", "adm_store_unified_repo_read", "adm_store_unified_repo_write", "document_uploader_read", "document_uploader_write", "aow_manage", "public_dms_document_read", "public_dms_document_write"]
+
+
+class DocuSignTokenManager:
+    """
+    Shared, thread-safe holder for the DocuSign JWT access token.
+
+    - The private key is read from disk once and kept in memory.
+    - The token is reused until shortly before it expires.
+    - A background timer refreshes it ahead of expiry so tool calls never wait on OAuth.
+    - Only one thread talks to the OAuth server at a time; the others wait for its result.
+    """
+
+    def __init__(self, private_key_path="docusign_private.key", expires_in=3600, refresh_margin=300, expiry_skew=60):
+        self.private_key_path = private_key_path
+        self.expires_in = expires_in
+        self.refresh_margin = refresh_margin  # Background refresh fires this many seconds before expiry
+        self.expiry_skew = expiry_skew        # Never hand out a token with less than this left
+
+        self._lock = threading.Lock()
+        self._refresh_done = threading.Condition(self._lock)
+        self._refreshing = False
+        self._private_key = None
+        self._token = None
+        self._api_client = None
+        self._expires_at = 0.0
+        self._timer = None
+
+        # Counters (read via stats())
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    # --- PUBLIC API ---
+
+    def get_token(self):
+        """Returns a valid access token string, or None if authentication failed."""
+        token, _ = self._get()
+        return token
+
+    def get_api_client(self):
+        """Returns a shared ApiClient carrying the current Bearer token, or None if authentication failed."""
+        _, api_client = self._get()
+        return api_client
+
+    def invalidate(self):
+        """Drops the cached token (e.g. after a 401) so the next call re-authenticates."""
+        with self._lock:
+            self._token = None
+            self._api_client = None
+            self._expires_at = 0.0
+
+    def stats(self):
+        with self._lock:
+            remaining = max(0, int(self._expires_at - time.monotonic())) if self._token else 0
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "failures": self.failures,
+                "token_seconds_remaining": remaining,
+            }
+
+    # --- INTERNALS ---
+
+    def _is_fresh(self):
+        return self._token is not None and time.monotonic() < self._expires_at - self.expiry_skew
+
+    def _get(self):
+        with self._lock:
+            if self._is_fresh():
+                self.hits += 1
+                return self._token, self._api_client
+
+            self.misses += 1
+            if self._refreshing:
+                # Another thread is already talking to DocuSign: wait for its result
+                while self._refreshing:
+                    self._refresh_done.wait()
+                if self._is_fresh():
+                    return self._token, self._api_client
+                return None, None
+            self._refreshing = True
+
+        return self._refresh()
+
+    def _refresh(self):
+        """Performs the JWT grant. Caller must have set self._refreshing under the lock."""
+        print(f"--- 🔄 AUTHENTICATING: Requesting a fresh DocuSign token at {datetime.datetime.now()} ---")
+        token, api_client, lifetime = None, None, 0
+        try:
+            if self._private_key is None:
+                with open(self.private_key_path) as f:
+                    self._private_key = f.read()
+
+            oauth_client = ApiClient()
+            oauth_client.host = os.getenv("DOCUSIGN_HOST")
+            oauth_client.oauth_host_name = DOCUSIGN_OAUTH_HOST
+
+            token_response = oauth_client.request_jwt_user_token(
+                client_id=os.getenv("DOCUSIGN_IK"),
+                user_id=os.getenv("DOCUSIGN_USER_ID"),
+                oauth_host_name=DOCUSIGN_OAUTH_HOST,
+                private_key_bytes=self._private_key,
+                expires_in=self.expires_in,
+                scopes=DOCUSIGN_SCOPES
+            )
+            token = token_response.access_token
+            try:
+                lifetime = int(token_response.expires_in or self.expires_in)
+            except (TypeError, ValueError):
+                lifetime = self.expires_in
+
+            api_client = ApiClient()
+            api_client.host = os.getenv("DOCUSIGN_HOST")
+            api_client.set_default_header("Authorization", "Bearer " + token)
+        except Exception as e:
+            print(f"❌ DocuSign Authentication Failed: {e}")
+
+        with self._lock:
+            if token:
+                self._token = token
+                self._api_client = api_client
+                self._expires_at = time.monotonic() + lifetime
+                self.refreshes += 1
+                self._schedule_background_refresh(lifetime - self.refresh_margin)
+            else:
+                self.failures += 1
+                if self._is_fresh():
+                    # Old token is still usable: try the background refresh again shortly
+                    self._schedule_background_refresh(30)
+            self._refreshing = False
+            self._refresh_done.notify_all()
+            return token, api_client
+
+    def _schedule_background_refresh(self, delay):
+        """Caller must hold the lock."""
+        if self._timer:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(delay, 1), self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        self._refresh()
+
+
+# Single instance shared by every tool in the process
+docusign_tokens = DocuSignTokenManager()
@@ -0,0 +1,132 @@
+# tools_bulk.py
+import io
+import os
+import csv
+import time
+from tools_http import HttpTransport
+
+TERMINAL_JOB_STATES = {"JobComplete", "Failed", "Aborted"}
+
+
+class BulkStageUpdater:
+    """
+    Applies a batch of Opportunity stage updates either one by one (small batches)
+    or as a single Salesforce Bulk API 2.0 ingest job (large batches).
+
+    The Salesforce endpoint is injected ('base_url' like https://host/services/data/v59.0/
+    and 'session_id'), so the job flow can be exercised against a local fake server.
+    'session_id' may be a callable, read on every request so a refreshed login is picked up;
+    'relogin' (optional) is called once when Salesforce answers 401, then the request is retried.
+    """
+
+    def __init__(self, base_url, session_id, single_update=None, threshold=None, poll_interval=2.0, poll_timeout=600, transport=None, relogin=None):
+        self.base_url = base_url.rstrip('/') + '/'
+        self.session_id = session_id
+        self.relogin = relogin  # fn(rejected_session_id), renews the session behind 'session_id'
+        self.single_update = single_update  # fn(opportunity_id, new_stage) -> None, raises on failure
+        self.threshold = threshold if threshold is not None else int(os.getenv("BULK_STAGE_UPDATE_THRESHOLD", "50"))
+        self.poll_interval = poll_interval
+        self.poll_timeout = poll_timeout
+        self.http = transport or HttpTransport(name="salesforce-bulk")
+
+    def apply(self, updates):
+        """
+        Applies {opportunity_id: new_stage}, choosing single vs bulk by the threshold.
+        Returns {opportunity_id: {"success": bool, "error": str|None}}.
+        """
+        if not updates:
+            return {}
+
+        if len(updates) >= self.threshold or not self.single_update:
+            print(f"--- 📦 BULK: Submitting {len(updates)} stage updates as a Bulk API 2.0 job ---")
+            return self.run_bulk_job(updates)
+
+        print(f"--- Applying {len(updates)} stage updates individually (below bulk threshold {self.threshold}) ---")
+        results = {}
+        for opp_id, stage in updates.items():
+            try:
+                self.single_update(opp_id, stage)
+                results[opp_id] = {"success": True, "error": None}
+            except Exception as e:
+                results[opp_id] = {"success": False, "error": str(e)}
+        return results
+
+    # --- BULK API 2.0 JOB FLOW ---
+
+    def run_bulk_job(self, updates):
+        """Create job -> upload CSV -> mark UploadComplete -> poll -> read failedResults."""
+        results = {opp_id: {"success": True, "error": None} for opp_id in updates}
+        try:
+            job = self._call("POST", "jobs/ingest", json={
+                "object": "Opportunity",
+                "operation": "update",
+                "contentType": "CSV",
+                "lineEnding": "LF"
+            }).json()
+            job_id = job["id"]
+
+            self._call("PUT", f"jobs/ingest/{job_id}/batches", data=self._to_csv(updates).encode("utf-8"),
+                       headers={"Content-Type": "text/csv"})
+            self._call("PATCH", f"jobs/ingest/{job_id}", json={"state": "UploadComplete"})
+
+            state = self._wait_for_job(job_id)
+            print(f"--- 📦 BULK: Job {job_id} finished with state '{state['state']}' "
+                  f"({state.get('numberRecordsProcessed', 0)} processed, {state.get('numberRecordsFailed', 0)} failed) ---")
+
+            if state["state"] != "JobComplete":
+                message = state.get("errorMessage") or f"Bulk job ended in state {state['state']}"
+                return {opp_id: {"success": False, "error": message} for opp_id in updates}
+
+            failed_csv = self._call("GET", f"jobs/ingest/{job_id}/failedResults/").text
+            for row in csv.DictReader(io.StringIO(failed_csv)):
+                opp_id = row.get("Id") or row.get("sf__Id")
+                if opp_id in results:
+                    results[opp_id] = {"success": False, "error": row.get("sf__Error", "Unknown error")}
+
+            unprocessed_csv = self._call("GET", f"jobs/ingest/{job_id}/unprocessedrecords/").text
+            for row in csv.DictReader(io.StringIO(unprocessed_csv)):
+                if row.get("Id") in results:
+                    results[row["Id"]] = {"success": False, "error": "Record was not processed"}
+            return results
+
+        except Exception as e:
+            print(f"❌ BULK: Job failed: {e}")
+            return {opp_id: {"success": False, "error": str(e)} for opp_id in updates}
+
+    def _wait_for_job(self, job_id):
+        deadline = time.monotonic() + self.poll_timeout
+        while True:
+            state = self._call("GET", f"jobs/ingest/{job_id}").json()
+            if state.get("state") in TERMINAL_JOB_STATES:
+                return state
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Bulk job {job_id} still '{state.get('state')}' after {self.poll_timeout}s")
+            time.sleep(self.poll_interval)
+
+    def _session(self):
+        return self.session_id() if callable(self.session_id) else self.session_id
+
+    def _call(self, method, path, headers=None, **kwargs):
+        def send(session_id):
+            all_headers = {"Authorization": f"Bearer {session_id}", "Content-Type": "application/json"}
+            all_headers.update(headers or {})
+            return self.http.request(method, self.base_url + path, headers=all_headers, **kwargs)
+
+        session_id = self._session()
+        response = send(session_id)
+        if response.status_code == 401 and self.relogin:
+            print(f"--- 🔑 BULK: Session rejected on {method} {path}, logging in again ---")
+            self.relogin(session_id)
+            response = send(self._session())
+        if response.status_code >= 400:
+            raise RuntimeError(f"Bulk API {method} {path} failed ({response.status_code}): {response.text}")
+        return response
+
+    @staticmethod
+    def _to_csv(updates):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(["Id", "StageName"])
+        for opp_id, stage in updates.items():
+            writer.writerow([opp_id, stage])
+        return buffer.getvalue()
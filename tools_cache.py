@@ -0,0 +1,162 @@
+# tools_cache.py
+import json
+import time
+import sqlite3
+import threading
+
+
+class TTLCache:
+    """
+    Small in-memory cache with a time-to-live per entry and single-flight loading.
+
+    When several threads miss on the same key at once, only the first one runs the
+    loader; the others wait and share its result (or its exception).
+    """
+
+    def __init__(self, ttl_seconds=60):
+        self.ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = {}   # key -> (value, loaded_at)
+        self._inflight = {}  # key -> threading.Event
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_load(self, key, loader):
+        """Returns (value, age_seconds). Calls loader() at most once per expired key across threads."""
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and time.monotonic() - entry[1] < self.ttl:
+                    self.hits += 1
+                    return entry[0], time.monotonic() - entry[1]
+
+                waiting_on = self._inflight.get(key)
+                if waiting_on is None:
+                    self.misses += 1
+                    done = self._inflight[key] = threading.Event()
+                    break
+
+            # Another thread is loading this key: wait, then re-check the cache
+            waiting_on.wait()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry:
+                    self.hits += 1
+                    return entry[0], time.monotonic() - entry[1]
+            # The loader failed for the other thread; loop and try ourselves
+
+        try:
+            value = loader()
+            with self._lock:
+                self._entries[key] = (value, time.monotonic())
+            return value, 0.0
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            done.set()
+
+    def invalidate(self, key=None):
+        """Drops one key, or everything if key is None."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def patch(self, fn):
+        """
+        Applies fn(value) -> new_value to every cached entry in place (keeps its age).
+        Used for write-through updates where we know exactly which rows changed.
+        """
+        with self._lock:
+            for key, (value, loaded_at) in list(self._entries.items()):
+                self._entries[key] = (fn(value), loaded_at)
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "ages_seconds": [round(now - loaded_at, 1) for _, loaded_at in self._entries.values()],
+            }
+
+
+class PersistentLRUCache:
+    """
+    On-disk key/value cache (SQLite) for JSON-serializable values, with TTL and LRU eviction.
+
+    Survives restarts, so retries of the same work after a crash or redeploy are still hits.
+    Entries older than ttl_seconds are ignored and purged; above max_entries the least
+    recently used ones are dropped.
+    """
+
+    def __init__(self, path, max_entries=500, ttl_seconds=7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache(last_used)")
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the cached value, or None on a miss / expired entry."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] < self.ttl:
+                self._conn.execute("UPDATE cache SET last_used = ? WHERE key = ?", (now, key))
+                self._conn.commit()
+                self.hits += 1
+                return json.loads(row[0])
+            if row:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now)
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def invalidate(self, key=None):
+        """Drops one key, or everything if key is None."""
+        with self._lock:
+            if key is None:
+                self._conn.execute("DELETE FROM cache")
+            else:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def _evict(self, now):
+        expired = self._conn.execute("DELETE FROM cache WHERE created_at <= ?", (now - self.ttl,)).rowcount
+        overflow = self._conn.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        ).rowcount
+        self.evictions += expired + overflow
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": entries}
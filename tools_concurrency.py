@@ -0,0 +1,399 @@
+# tools_concurrency.py
+import os
+import time
+import uuid
+import threading
+import email.utils
+from collections import deque
+from contextlib import contextmanager
+
+
+class QueueFullError(Exception):
+    """Raised by BoundedWorkerPool.submit when accepting the work would exceed max_queue."""
+
+
+class DependencyLimiter:
+    """
+    Per-dependency concurrency caps ("llm", "salesforce", "docusign"), so a large batch keeps
+    every worker busy without opening more parallel calls than a downstream service tolerates.
+    Limits come from DEP_CONCURRENCY_<NAME> (0 or unset = unlimited).
+    """
+
+    def __init__(self, defaults=None):
+        self._lock = threading.Lock()
+        self._defaults = defaults or {}
+        self._slots = {}
+        self._stats = {}
+
+    def _semaphore(self, name):
+        with self._lock:
+            if name not in self._slots:
+                limit = int(os.getenv(f"DEP_CONCURRENCY_{name.upper()}", str(self._defaults.get(name, 0))))
+                self._slots[name] = threading.BoundedSemaphore(limit) if limit > 0 else None
+                self._stats[name] = {"limit": limit, "in_flight": 0, "waits": 0, "wait_seconds": 0.0}
+            return self._slots[name]
+
+    def acquire(self, name):
+        semaphore = self._semaphore(name)
+        started = time.monotonic()
+        if semaphore is not None:
+            semaphore.acquire()
+        waited = time.monotonic() - started
+        with self._lock:
+            s = self._stats[name]
+            s["in_flight"] += 1
+            if waited > 0.001:
+                s["waits"] += 1
+                s["wait_seconds"] += waited
+
+    def release(self, name):
+        semaphore = self._semaphore(name)
+        with self._lock:
+            self._stats[name]["in_flight"] -= 1
+        if semaphore is not None:
+            semaphore.release()
+
+    @contextmanager
+    def slot(self, name):
+        self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(s, wait_seconds=round(s["wait_seconds"], 2)) for name, s in self._stats.items()}
+
+
+class BoundedWorkerPool:
+    """
+    Fixed number of worker threads draining one FIFO queue.
+
+    Jobs are grouped (e.g. by task_id) so the UI can show, per item, whether it is running or
+    its position in the queue. submit() refuses work beyond max_queue (backpressure) unless
+    force=True (used for webhooks, which must never be dropped).
+    """
+
+    def __init__(self, name, max_workers=None, max_queue=None):
+        self.name = name
+        self.max_workers = max_workers or int(os.getenv("DEAL_WORKERS", "8"))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv("DEAL_QUEUE_MAX", "1000"))
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._running = {}
+        self._threads = []
+        self.completed = 0
+        self.failed = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    # --- SUBMIT ---
+
+    def can_accept(self, count=1):
+        with self._cond:
+            return len(self._queue) + count <= self.max_queue
+
+    def submit(self, group, key, fn, *args, force=False, **kwargs):
+        """Queues fn(*args, **kwargs). Returns the job id. Raises QueueFullError when the queue is full."""
+        job = {"id": uuid.uuid4().hex, "group": group, "key": key, "fn": fn, "args": args, "kwargs": kwargs,
+               "queued_at": time.monotonic()}
+        with self._cond:
+            if not force and len(self._queue) >= self.max_queue:
+                raise QueueFullError(f"{self.name} queue is full ({self.max_queue} jobs waiting).")
+            self._queue.append(job)
+            self._start_workers()
+            self._cond.notify()
+        return job["id"]
+
+    # --- STATUS ---
+
+    def positions(self, group):
+        """{key: {"state": "running"} | {"state": "queued", "position": n}} for one group (position is 1-based, pool-wide)."""
+        with self._cond:
+            out = {job["key"]: {"state": "running"} for job in self._running.values() if job["group"] == group}
+            for index, job in enumerate(self._queue):
+                if job["group"] == group:
+                    out[job["key"]] = {"state": "queued", "position": index + 1}
+            return out
+
+    def stats(self):
+        with self._cond:
+            started = self.completed + self.failed + len(self._running)
+            return {
+                "workers": self.max_workers,
+                "busy": len(self._running),
+                "queued": len(self._queue),
+                "max_queue": self.max_queue,
+                "completed": self.completed,
+                "failed": self.failed,
+                "avg_queue_wait_seconds": round(self._wait_total / started, 2) if started else 0.0,
+                "max_queue_wait_seconds": round(self._wait_max, 2),
+            }
+
+    # --- WORKERS ---
+
+    def _start_workers(self):
+        # Called with the condition held; threads are started lazily up to max_workers
+        while len(self._threads) < min(self.max_workers, len(self._queue) + len(self._running)):
+            thread = threading.Thread(target=self._work, name=f"{self.name}-worker-{len(self._threads) + 1}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                job = self._queue.popleft()
+                waited = time.monotonic() - job["queued_at"]
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+                self._running[job["id"]] = job
+
+            failed = False
+            try:
+                job["fn"](*job["args"], **job["kwargs"])
+            except Exception as e:
+                failed = True
+                print(f"❌ [{self.name}] Job {job['key']} failed: {e}")
+            finally:
+                with self._cond:
+                    self._running.pop(job["id"], None)
+                    if failed:
+                        self.failed += 1
+                    else:
+                        self.completed += 1
+
+
+class TokenBucket:
+    """'limit' requests per 'window' seconds, refilled continuously, holding at most 'burst' tokens."""
+
+    def __init__(self, limit, window, burst):
+        self.limit = limit
+        self.window = window
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # monotonic time before which nobody may call (Retry-After / exhausted quota)
+
+    @property
+    def rate(self):
+        return self.limit / self.window
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now, cost):
+        """Seconds until 'cost' tokens are available (0 = now)."""
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+class RateLimitScheduler:
+    """
+    Central rate-limit scheduler: one token bucket per dependency. Every outbound call takes a
+    token first (acquire) and reports its response (observe), so a batch of deals queues here
+    instead of hitting 429s or burning through a daily/hourly quota.
+
+    Quotas start from known service limits and can be overridden with
+    RATE_LIMIT_<NAME>="<requests>/<seconds>" and RATE_LIMIT_<NAME>_BURST. They are then adjusted
+    from the services' own rate-limit headers (Azure OpenAI x-ratelimit-*, DocuSign X-RateLimit-*)
+    and from Retry-After on 429. Salesforce reports a rolling 24h allowance (Sforce-Limit-Info)
+    rather than a rate: it never sets the pace, it only stops calls once the remaining allowance
+    drops to RATE_LIMIT_<NAME>_RESERVE (a fraction kept for other integrations of the org).
+    """
+
+    def __init__(self, quotas):
+        self._lock = threading.Lock()
+        self._quotas = quotas
+        self._buckets = {}
+        self._stats = {}
+        self.share = 1  # Number of processes splitting the quota (see set_share)
+
+    def set_share(self, processes):
+        """Gives this process 1/processes of every quota (the web process and each deal worker get a share)."""
+        with self._lock:
+            self.share = max(int(processes), 1)
+            for name, bucket in self._buckets.items():
+                limit, window, burst = self._configured(name)
+                bucket.limit, bucket.burst = limit, burst
+                bucket.tokens = min(bucket.tokens, burst)
+
+    def _configured(self, name):
+        limit, window, burst = self._quotas.get(name, (0, 1, 1))
+        value = os.getenv(f"RATE_LIMIT_{name.upper()}")
+        if value:
+            limit, _, seconds = value.partition("/")
+            limit, window = float(limit), float(seconds or 60)
+        burst = float(os.getenv(f"RATE_LIMIT_{name.upper()}_BURST", burst))
+        return limit / self.share, window, max(burst / self.share, 1)
+
+    def _bucket(self, name):
+        # Called with the lock held; None = no quota configured for this dependency
+        if name not in self._buckets:
+            limit, window, burst = self._configured(name)
+            self._buckets[name] = TokenBucket(limit, window, burst) if limit > 0 else None
+            self._stats[name] = {"requests": 0, "waits": 0, "wait_seconds": 0.0, "max_wait_seconds": 0.0,
+                                 "throttled": 0, "reported_remaining": None, "reported_limit": None}
+        return self._buckets[name]
+
+    # --- CALLERS ---
+
+    def acquire(self, name, cost=1):
+        """Blocks until the dependency's bucket has 'cost' tokens, then takes them."""
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                bucket = self._bucket(name)
+                now = time.monotonic()
+                if bucket is None:
+                    wait = 0.0
+                else:
+                    bucket.refill(now)
+                    wait = bucket.wait_time(now, cost)
+                    if wait <= 0:
+                        bucket.tokens -= cost
+                if wait <= 0:
+                    waited = now - started
+                    s = self._stats[name]
+                    s["requests"] += 1
+                    if waited > 0.001:
+                        s["waits"] += 1
+                        s["wait_seconds"] += waited
+                        s["max_wait_seconds"] = max(s["max_wait_seconds"], waited)
+                    return waited
+            # Re-check at least every few seconds: header updates may shorten (or extend) the wait
+            time.sleep(min(wait, 5.0))
+
+    def observe(self, name, status_code, headers):
+        """Feeds a response back: rate-limit headers resize the bucket, a 429 pauses every caller."""
+        headers = headers or {}
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._bucket(name)
+            if bucket is None:
+                return
+            s = self._stats[name]
+            limit, remaining, reset_in, allowance = _parse_rate_limit_headers(headers)
+            if limit:
+                s["reported_limit"] = limit
+            if allowance:
+                if remaining is not None:
+                    s["reported_remaining"] = remaining
+                    usable = remaining - limit * float(os.getenv(f"RATE_LIMIT_{name.upper()}_RESERVE", "0.05"))
+                    bucket.refill(now)
+                    bucket.tokens = min(bucket.tokens, max(usable, 0) / self.share)
+                    if usable <= 0:
+                        # Rolling window: no reset time, so look again after one bucket window
+                        bucket.blocked_until = max(bucket.blocked_until, now + bucket.window)
+            else:
+                if limit:
+                    bucket.limit = limit / self.share
+                if remaining is not None:
+                    s["reported_remaining"] = remaining
+                    bucket.refill(now)
+                    bucket.tokens = min(bucket.tokens, remaining / self.share)
+                    if remaining <= 0 and reset_in:
+                        bucket.blocked_until = max(bucket.blocked_until, now + reset_in)
+            if status_code == 429:
+                s["throttled"] += 1
+                retry_after = _retry_after_seconds(headers.get("Retry-After"))
+                retry_after_ms = _header_number(headers, "retry-after-ms")
+                if retry_after is None and retry_after_ms is not None:
+                    retry_after = retry_after_ms / 1000
+                bucket.blocked_until = max(bucket.blocked_until, now + (retry_after or bucket.window / bucket.limit))
+                bucket.tokens = 0.0
+
+    # --- METRICS ---
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            out = {}
+            for name, s in self._stats.items():
+                bucket = self._buckets[name]
+                requests = s["requests"] or 1
+                out[name] = {
+                    "requests": s["requests"],
+                    "throttled_429": s["throttled"],
+                    "waits": s["waits"],
+                    "avg_queue_wait_ms": round(1000 * s["wait_seconds"] / requests, 1),
+                    "max_queue_wait_ms": round(1000 * s["max_wait_seconds"], 1),
+                    "reported_limit": s["reported_limit"],
+                    "reported_remaining": s["reported_remaining"],
+                }
+                if bucket is not None:
+                    bucket.refill(now)
+                    out[name].update({
+                        "limit_per_minute": round(bucket.rate * 60, 2),
+                        "burst": bucket.burst,
+                        "tokens": round(bucket.tokens, 2),
+                        "paused_for_seconds": round(max(bucket.blocked_until - now, 0), 1),
+                    })
+            return out
+
+
+def _header_number(headers, *names):
+    for name in names:
+        value = headers.get(name)
+        if value not in (None, ""):
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return None
+
+
+def _parse_rate_limit_headers(headers):
+    """
+    (limit, remaining, seconds_until_reset, is_allowance) from whichever rate-limit headers the
+    service sent. is_allowance marks a total for a long rolling period rather than a rate.
+    """
+    # Salesforce: "Sforce-Limit-Info: api-usage=18/100000" (24h rolling allowance)
+    info = headers.get("Sforce-Limit-Info")
+    if info and "api-usage=" in info:
+        try:
+            used, limit = info.split("api-usage=")[1].split(",")[0].split("/")
+            return float(limit), float(limit) - float(used), None, True
+        except ValueError:
+            pass
+
+    # DocuSign: X-RateLimit-Limit / X-RateLimit-Remaining / X-RateLimit-Reset (epoch seconds)
+    # Azure OpenAI: x-ratelimit-limit-requests / x-ratelimit-remaining-requests
+    limit = _header_number(headers, "X-RateLimit-Limit", "x-ratelimit-limit-requests")
+    remaining = _header_number(headers, "X-RateLimit-Remaining", "x-ratelimit-remaining-requests")
+    reset = _header_number(headers, "X-RateLimit-Reset")
+    reset_in = max(reset - time.time(), 0) if reset else None
+    return limit, remaining, reset_in, False
+
+
+def _retry_after_seconds(value):
+    if value in (None, ""):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+# Shared per-dependency caps, used by the HTTP transports, the Salesforce session and the LLM
+dependency_limits = DependencyLimiter(defaults={"llm": 4, "salesforce": 10, "docusign": 5})
+
+# Shared per-dependency request quotas: (requests, window seconds, burst).
+# Azure OpenAI: deployment RPM; DocuSign: 3,000 calls per hour per account.
+# Salesforce has no per-minute limit: the bucket paces calls from a per-minute budget, and the
+# org's daily allowance is enforced from Sforce-Limit-Info (see RateLimitScheduler.observe).
+rate_limits = RateLimitScheduler(quotas={
+    "llm": (int(os.getenv("AZURE_OPENAI_RPM", "300")), 60, 20),
+    "salesforce": (int(os.getenv("SALESFORCE_API_RPM", "600")), 60, 100),
+    "docusign": (int(os.getenv("DOCUSIGN_HOURLY_API_LIMIT", "3000")), 3600, 100),
+})
@@ -0,0 +1,751 @@
+# tools_history.py
+import os
+import re
+import json
+import math
+import heapq
+import bisect
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+
+try:
+    import fcntl  # Cross-process file locking (Unix)
+except ImportError:  # pragma: no cover - Windows dev boxes
+    fcntl = None
+
+
+class _FileLock:
+    """Exclusive advisory lock on '<path>.lock' so separate processes never interleave writes."""
+
+    def __init__(self, path):
+        self.path = path + ".lock"
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = open(self.path, "a")
+        if fcntl:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._fd.close()
+        self._fd = None
+
+
+class HistoryLedger:
+    """
+    Append-only JSONL ledger of sent SOWs.
+
+    - Writes append one line under a single-writer lock (thread lock + file lock), so parallel
+      deal threads can no longer overwrite each other's records.
+    - fsync is batched: a background flusher syncs at most every 'fsync_interval' seconds.
+    - Reads are served from an in-memory, newest-first list that is topped up from the
+      file tail when another process has appended.
+    - Compaction rewrites the log in the background (dropping torn lines and records
+      superseded by a later one with the same EnvelopeId) every 'compact_every' appends.
+    - On first use, an existing legacy JSON array file is imported once.
+    """
+
+    def __init__(self, path="sow_history.jsonl", legacy_path="sow_history.json", fsync_interval=1.0, compact_every=500):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+
+        self._lock = threading.RLock()
+        self._file_lock = _FileLock(path)
+        self._records = []        # Oldest first, mirrors the file
+        self._offset = 0          # Bytes of the file already loaded
+        self._inode = None
+        self._json_cache = None   # Cached newest-first JSON string
+        self._dirty = False       # Written but not yet fsynced
+        self._appends_since_compaction = 0
+        self._listeners = []
+        self._loaded = False
+        self._generation = 0      # Bumped whenever records are rewritten (compaction/reload)
+
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    # --- PUBLIC API ---
+
+    def append(self, record):
+        """Appends one record (a dict) to the ledger."""
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        with self._lock:
+            self._ensure_loaded()
+            with self._file_lock:
+                self._refresh_from_disk()
+                with open(self.path, "ab") as f:
+                    f.write(line)
+                    f.flush()
+                    self._offset = f.tell()
+            self._records.append(record)
+            self._json_cache = None
+            self._dirty = True
+            self._appends_since_compaction += 1
+            listeners = list(self._listeners)
+            should_compact = self._appends_since_compaction >= self.compact_every
+
+        for listener in listeners:
+            listener(record)
+        if should_compact:
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def records(self):
+        """All records, newest first. Treat the returned dicts as read-only."""
+        with self._lock:
+            self._ensure_loaded()
+            self._refresh_from_disk()
+            return self._records[::-1]
+
+    def count(self):
+        with self._lock:
+            self._ensure_loaded()
+            self._refresh_from_disk()
+            return len(self._records)
+
+    def to_json(self):
+        """The whole ledger as a newest-first JSON array string (cached between writes)."""
+        with self._lock:
+            self._ensure_loaded()
+            self._refresh_from_disk()
+            if self._json_cache is None:
+                self._json_cache = json.dumps(self._records[::-1])
+            return self._json_cache
+
+    def tail(self, generation, count):
+        """
+        Incremental read for derived indexes: returns (generation, records, reset).
+        If 'generation' is still current, records are those after the first 'count' (oldest first);
+        otherwise reset=True and records is the full ledger.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            self._refresh_from_disk()
+            if generation != self._generation:
+                return self._generation, list(self._records), True
+            return self._generation, self._records[count:], False
+
+    def add_listener(self, fn):
+        """Registers fn(record), called after every append (used to keep search indexes current)."""
+        with self._lock:
+            self._listeners.append(fn)
+
+    def flush(self):
+        """Forces pending appends to disk (fsync)."""
+        with self._lock:
+            if not self._dirty or not os.path.exists(self.path):
+                return
+            with open(self.path, "ab") as f:
+                os.fsync(f.fileno())
+            self._dirty = False
+
+    def compact(self):
+        """Rewrites the log atomically, keeping only the latest record per EnvelopeId."""
+        with self._lock:
+            self._ensure_loaded()
+            with self._file_lock:
+                self._refresh_from_disk()
+                latest = {}
+                for i, record in enumerate(self._records):
+                    key = record.get("EnvelopeId")
+                    latest[key if key not in (None, "N/A") else f"__row_{i}"] = i
+                kept = [self._records[i] for i in sorted(latest.values())]
+
+                tmp_path = self.path + ".compact"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    for record in kept:
+                        f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+
+                dropped = len(self._records) - len(kept)
+                self._records = kept
+                self._offset = os.path.getsize(self.path)
+                self._inode = os.stat(self.path).st_ino
+                self._json_cache = None
+                self._dirty = False
+                self._appends_since_compaction = 0
+                self._generation += 1
+        print(f"--- 🧹 MEMORY: Compacted history ledger ({len(kept)} records, {dropped} dropped) ---")
+
+    # --- INTERNALS ---
+
+    def _ensure_loaded(self):
+        """Caller holds self._lock. Loads the log (migrating the legacy JSON file once)."""
+        if self._loaded:
+            return
+        with self._file_lock:
+            if not os.path.exists(self.path) and self.legacy_path and os.path.exists(self.legacy_path):
+                self._migrate_legacy()
+        self._loaded = True
+        self._refresh_from_disk()
+
+    def _migrate_legacy(self):
+        print(f"--- 💾 MEMORY: Migrating {self.legacy_path} to append-only log {self.path} ---")
+        try:
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                content = f.read()
+            legacy = json.loads(content) if content.strip() else []
+        except Exception as e:
+            print(f"⚠️ Warning: Could not read legacy history file: {e}. Starting fresh.")
+            return
+
+        tmp_path = self.path + ".migrate"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in reversed(legacy):  # Legacy file is newest first; the log is oldest first
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        os.replace(self.legacy_path, self.legacy_path + ".migrated")
+        print(f"✅ MEMORY: Migrated {len(legacy)} records.")
+
+    def _refresh_from_disk(self):
+        """Caller holds self._lock. Reads lines appended by other processes (or reloads after their compaction)."""
+        if not os.path.exists(self.path):
+            return
+        stat = os.stat(self.path)
+        if self._inode is not None and (stat.st_ino != self._inode or stat.st_size < self._offset):
+            self._records, self._offset = [], 0  # Replaced by a compaction elsewhere
+            self._generation += 1
+        self._inode = stat.st_ino
+        if stat.st_size == self._offset:
+            return
+
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Partially written line; pick it up next time
+                self._offset += len(line)
+                try:
+                    self._records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print("⚠️ Warning: Skipping corrupt line in history ledger.")
+        self._json_cache = None
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"⚠️ Warning: History fsync failed: {e}")
+
+
+_TOKEN_SPLIT = re.compile(r"[^0-9a-z]+")
+
+
+def _tokenize(text):
+    return [t for t in _TOKEN_SPLIT.split(str(text).lower()) if t]
+
+
+class HistorySearchIndex:
+    """
+    In-memory inverted index over the history ledger, used by the JSONL backend only
+    (HISTORY_BACKEND=jsonl); the SQLite backend searches its FTS5 table instead.
+
+    - postings: token -> set of record ids (positions in the ledger, oldest first)
+    - prefix map: a sorted token vocabulary; a prefix lookup is one bisect range, so partial
+      names/emails ("barb", "avi.gr") match without storing every prefix of every token
+    - Every query term must match (like the old full scan); results are ranked by
+      tf-idf style scores (exact token beats prefix) and then newest first.
+
+    The index is built once and kept current incrementally from the ledger tail.
+    """
+
+    MIN_PREFIX = 2
+    SKIP_FIELDS = {"DocuSignLink"}  # Derived from EnvelopeId; indexing it only adds URL noise
+
+    def __init__(self, ledger):
+        self.ledger = ledger
+        self._lock = threading.Lock()
+        self._generation = None
+        self._records = []
+        self._postings = {}
+        self._vocabulary = []  # Sorted tokens
+        ledger.add_listener(lambda record: self.sync())
+
+    def sync(self):
+        """Indexes records appended since the last sync (full rebuild after a compaction)."""
+        with self._lock:
+            generation, new_records, reset = self.ledger.tail(self._generation, len(self._records))
+            if reset:
+                self._records, self._postings, self._vocabulary = [], {}, []
+            self._generation = generation
+
+            new_tokens = []
+            for record in new_records:
+                new_tokens.extend(self._add(len(self._records), record))
+                self._records.append(record)
+
+            if len(new_tokens) > 1000:
+                self._vocabulary = sorted(self._postings)  # Bulk load: one sort beats many inserts
+            else:
+                for token in new_tokens:
+                    bisect.insort(self._vocabulary, token)
+
+    def search(self, query, limit=None, match_any=False):
+        """Returns matching records, best first. match_any=True ranks records matching ANY term (more terms score higher)."""
+        terms = _tokenize(query)
+        if not terms:
+            return []
+        self.sync()
+
+        with self._lock:
+            scores = None
+            total = max(len(self._records), 1)
+            for term in terms:
+                term_scores = {}
+                for token in self._matching_tokens(term):
+                    ids = self._postings[token]
+                    weight = (2.0 if token == term else 1.0) * math.log(1 + total / len(ids))
+                    for record_id in ids:
+                        term_scores[record_id] = max(term_scores.get(record_id, 0.0), weight)
+
+                if scores is None:
+                    scores = term_scores
+                elif match_any:
+                    for rid, s in term_scores.items():
+                        scores[rid] = scores.get(rid, 0.0) + s
+                else:
+                    scores = {rid: s + term_scores[rid] for rid, s in scores.items() if rid in term_scores}
+                if not scores and not match_any:
+                    return []
+
+            # Best score first, newest (highest id) first among equals
+            rank_key = lambda item: (item[1], item[0])
+            if limit:
+                ranked = heapq.nlargest(limit, scores.items(), key=rank_key)
+            else:
+                ranked = sorted(scores.items(), key=rank_key, reverse=True)
+            return [self._records[record_id] for record_id, _ in ranked]
+
+    def _matching_tokens(self, term):
+        """Caller holds the lock. The exact token plus every token it is a prefix of."""
+        if len(term) < self.MIN_PREFIX:
+            return [term] if term in self._postings else []
+        start = bisect.bisect_left(self._vocabulary, term)
+        end = bisect.bisect_left(self._vocabulary, term + "\uffff", lo=start)
+        return self._vocabulary[start:end]
+
+    def _add(self, record_id, record):
+        """Caller holds the lock. Returns tokens seen for the first time."""
+        new_tokens = []
+        for field, value in record.items():
+            if field in self.SKIP_FIELDS:
+                continue
+            for token in _tokenize(value):
+                ids = self._postings.get(token)
+                if ids is None:
+                    ids = self._postings[token] = set()
+                    new_tokens.append(token)
+                ids.add(record_id)
+        return new_tokens
+
+
+# ==============================================================================
+#  PLUGGABLE HISTORY STORES
+#  Every history consumer (log_deal_to_history, get_local_history,
+#  search_history_for_chat, classify_intent) goes through one of these.
+# ==============================================================================
+
+HISTORY_FIELDS = ["Id", "Name", "Amount", "PrimaryContactName", "PrimaryContactEmail", "CloseDate", "Status", "EnvelopeId", "DocuSignLink"]
+
+# Full-text searchable columns of the SQLite backend (DocuSignLink is derived from EnvelopeId)
+SEARCH_FIELDS = [f for f in HISTORY_FIELDS if f != "DocuSignLink"]
+
+
+class HistoryStore(ABC):
+    """Interface shared by the history backends. Records are plain dicts with HISTORY_FIELDS."""
+
+    @abstractmethod
+    def append(self, record): ...
+
+    @abstractmethod
+    def count(self): ...
+
+    @abstractmethod
+    def records(self, limit=None): ...  # Newest first
+
+    @abstractmethod
+    def to_json(self): ...  # Newest-first JSON array string
+
+    @abstractmethod
+    def search(self, query, limit=None, match_any=False): ...
+
+    @abstractmethod
+    def get_by_opportunity(self, opportunity_id): ...
+
+    @abstractmethod
+    def get_by_envelope(self, envelope_id): ...
+
+    @abstractmethod
+    def in_date_range(self, start, end, limit=None): ...  # CloseDate 'YYYY-MM-DD', inclusive; latest first
+
+    @abstractmethod
+    def add_listener(self, fn): ...
+
+    def import_json(self, path):
+        """Imports a JSON array (newest first, the legacy sow_history.json format) or a JSONL log (oldest first)."""
+        rows = self._read_json_rows(path)
+        self._bulk_append(rows)
+        return len(rows)
+
+    @staticmethod
+    def _read_json_rows(path):
+        """Records of an export file, oldest first."""
+        with open(path, "r", encoding="utf-8") as f:
+            content = f.read()
+        if path.endswith(".jsonl"):
+            return [json.loads(line) for line in content.splitlines() if line.strip()]
+        return list(reversed(json.loads(content))) if content.strip() else []
+
+    def export_json(self, path):
+        """Writes the whole history as a newest-first JSON array (the legacy format)."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_json())
+        os.replace(tmp_path, path)
+
+    def _bulk_append(self, rows):
+        for row in rows:
+            self.append(row)
+
+
+class LedgerHistoryStore(HistoryStore):
+    """JSONL ledger + in-memory inverted index (HISTORY_BACKEND=jsonl)."""
+
+    def __init__(self, path="sow_history.jsonl", legacy_path="sow_history.json"):
+        self.ledger = HistoryLedger(path=path, legacy_path=legacy_path)
+        self.index = HistorySearchIndex(self.ledger)
+
+    def append(self, record):
+        self.ledger.append(record)
+
+    def count(self):
+        return self.ledger.count()
+
+    def records(self, limit=None):
+        rows = self.ledger.records()
+        return rows[:limit] if limit else rows
+
+    def to_json(self):
+        return self.ledger.to_json()
+
+    def search(self, query, limit=None, match_any=False):
+        return self.index.search(query, limit=limit, match_any=match_any)
+
+    def get_by_opportunity(self, opportunity_id):
+        return [r for r in self.ledger.records() if r.get("Id") == opportunity_id]
+
+    def get_by_envelope(self, envelope_id):
+        return next((r for r in self.ledger.records() if r.get("EnvelopeId") == envelope_id), None)
+
+    def in_date_range(self, start, end, limit=None):
+        rows = sorted((r for r in self.ledger.records() if start <= str(r.get("CloseDate", "")) <= end),
+                      key=lambda r: str(r.get("CloseDate", "")), reverse=True)
+        return rows[:limit] if limit else rows
+
+    def add_listener(self, fn):
+        self.ledger.add_listener(fn)
+
+
+class SqliteHistoryStore(HistoryStore):
+    """
+    SQLite backend (HISTORY_BACKEND=sqlite, the default).
+
+    - B-tree indexes on Id, EnvelopeId and CloseDate for point and range lookups.
+    - An external-content FTS5 table over every field but DocuSignLink (kept in sync by
+      triggers) for bm25-ranked free-text search with prefix matching.
+    - WAL mode with one connection per thread, so readers never block the writer.
+    - On first start with an empty database the JSONL log / legacy JSON file is imported once.
+    """
+
+    def __init__(self, path="sow_history.db", import_paths=("sow_history.jsonl", "sow_history.json")):
+        self.path = path
+        self._local = threading.local()
+        self._listeners = []
+        self._json_cache = (None, None)  # (max rowid, JSON string)
+        self._lock = threading.Lock()
+
+        conn = self._conn()
+        columns = ", ".join(f"{field} TEXT" for field in HISTORY_FIELDS)
+        fts_columns = ", ".join(SEARCH_FIELDS)
+        new_values = ", ".join(f"new.{field}" for field in SEARCH_FIELDS)
+        old_values = ", ".join(f"old.{field}" for field in SEARCH_FIELDS)
+        schema = [
+            f"CREATE TABLE IF NOT EXISTS deals (rowid INTEGER PRIMARY KEY, {columns}, extra TEXT)",
+            "CREATE INDEX IF NOT EXISTS deals_opportunity ON deals(Id)",
+            "CREATE INDEX IF NOT EXISTS deals_envelope ON deals(EnvelopeId)",
+            "CREATE INDEX IF NOT EXISTS deals_close_date ON deals(CloseDate)",
+        ]
+        fts_schema = [
+            f"""CREATE VIRTUAL TABLE IF NOT EXISTS deals_fts USING fts5(
+                {fts_columns},
+                content='deals', content_rowid='rowid', prefix='2 3'
+            )""",
+            f"""CREATE TRIGGER IF NOT EXISTS deals_fts_insert AFTER INSERT ON deals BEGIN
+                INSERT INTO deals_fts(rowid, {fts_columns}) VALUES (new.rowid, {new_values});
+            END""",
+            f"""CREATE TRIGGER IF NOT EXISTS deals_fts_delete AFTER DELETE ON deals BEGIN
+                INSERT INTO deals_fts(deals_fts, rowid, {fts_columns}) VALUES ('delete', old.rowid, {old_values});
+            END""",
+        ]
+
+        # Schema, migration and the one-time import run in ONE write transaction: the web process
+        # and every deal worker open the store at startup, and only the first one may import
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in schema:
+                conn.execute(statement)
+
+            # Databases created before every field was searchable get their FTS table rebuilt once
+            existing = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'deals_fts'").fetchone()
+            if existing and "EnvelopeId" not in existing[0]:
+                for statement in ("DROP TRIGGER IF EXISTS deals_fts_insert", "DROP TRIGGER IF EXISTS deals_fts_delete",
+                                  "DROP TABLE IF EXISTS deals_fts"):
+                    conn.execute(statement)
+                existing = None
+            for statement in fts_schema:
+                conn.execute(statement)
+            if existing is None:
+                conn.execute("INSERT INTO deals_fts(deals_fts) VALUES ('rebuild')")
+
+            imported_from, imported = None, 0
+            if self.count() == 0:
+                for import_path in import_paths:
+                    if import_path and os.path.exists(import_path):
+                        rows = self._read_json_rows(import_path)
+                        self._insert_rows(conn, rows)
+                        imported_from, imported = import_path, len(rows)
+                        break
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if imported_from:
+            print(f"✅ MEMORY: Imported {imported} records from {imported_from} into {self.path}")
+
+    # --- CONNECTION ---
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            # Switching a new database to WAL needs an exclusive lock and does not wait on the
+            # busy timeout, so processes opening it together retry briefly
+            for attempt in range(50):
+                try:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    break
+                except sqlite3.OperationalError:
+                    if attempt == 49:
+                        raise
+                    time.sleep(0.1)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- WRITES ---
+
+    def append(self, record):
+        self._bulk_append([record], notify=True)
+
+    def _bulk_append(self, rows, notify=False):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._insert_rows(conn, rows)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if notify:
+            for listener in list(self._listeners):
+                for record in rows:
+                    listener(record)
+
+    def _insert_rows(self, conn, rows):
+        # Caller holds the write transaction
+        placeholders = ", ".join("?" for _ in range(len(HISTORY_FIELDS) + 1))
+        conn.executemany(f"INSERT INTO deals ({', '.join(HISTORY_FIELDS)}, extra) VALUES ({placeholders})",
+                         [self._to_row(r) for r in rows])
+
+    @staticmethod
+    def _to_row(record):
+        extra = {k: v for k, v in record.items() if k not in HISTORY_FIELDS}
+        return [None if record.get(f) is None else str(record.get(f)) for f in HISTORY_FIELDS] + [json.dumps(extra) if extra else None]
+
+    @staticmethod
+    def _to_record(row):
+        record = {f: row[f] for f in HISTORY_FIELDS}
+        if row["extra"]:
+            record.update(json.loads(row["extra"]))
+        return record
+
+    # --- READS ---
+
+    def _select(self, where="", params=(), order="rowid DESC", limit=None):
+        sql = f"SELECT * FROM deals {where} ORDER BY {order}"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return [self._to_record(row) for row in self._conn().execute(sql, params)]
+
+    def count(self):
+        return self._conn().execute("SELECT count(*) FROM deals").fetchone()[0]
+
+    def records(self, limit=None):
+        return self._select(limit=limit)
+
+    def to_json(self):
+        # Append-only table: the newest rowid identifies the content, so the JSON is rebuilt only after a write
+        newest = self._conn().execute("SELECT max(rowid) FROM deals").fetchone()[0]
+        with self._lock:
+            if self._json_cache[0] == newest and self._json_cache[1] is not None:
+                return self._json_cache[1]
+        payload = json.dumps(self._select())
+        with self._lock:
+            self._json_cache = (newest, payload)
+        return payload
+
+    def get_by_opportunity(self, opportunity_id):
+        return self._select("WHERE Id = ?", (opportunity_id,))
+
+    def get_by_envelope(self, envelope_id):
+        rows = self._select("WHERE EnvelopeId = ?", (envelope_id,), limit=1)
+        return rows[0] if rows else None
+
+    def in_date_range(self, start, end, limit=None):
+        return self._select("WHERE CloseDate BETWEEN ? AND ?", (start, end), order="CloseDate DESC, rowid DESC", limit=limit)
+
+    SEARCH_CANDIDATES = 500  # Matches considered per query (per word with match_any), best first
+    RANK_WINDOW = 2000  # Newest matches scored by bm25 per query
+
+    def search(self, query, limit=None, match_any=False):
+        """
+        Every word must match a token of any searchable field: project name, contact name/email,
+        amount, close date, status, Opportunity ID or Envelope ID. Whole-word matches come first,
+        then prefix matches (e.g. a half-typed name); within each, by bm25 relevance, then newest first
+        (see _match_rowids for how many matches are ranked).
+        match_any=True accepts records matching ANY word, those matching more words first.
+        """
+        terms = _tokenize(query)
+        if not terms:
+            return []
+        wanted = limit or self.SEARCH_CANDIDATES
+        if match_any:
+            matched_words, scores = {}, {}
+            for term in terms:
+                for position, rowid in enumerate(self._match_rowids([term], max(self.SEARCH_CANDIDATES, wanted))):
+                    matched_words[rowid] = matched_words.get(rowid, 0) + 1
+                    scores[rowid] = scores.get(rowid, 0) + position
+            ranked = sorted(matched_words, key=lambda rowid: (-matched_words[rowid], scores[rowid], -rowid))[:wanted]
+        else:
+            ranked = self._match_rowids(terms, wanted)
+
+        conn = self._conn()
+        rows = []
+        if ranked:
+            by_rowid = {row["rowid"]: row for row in conn.execute(
+                f"SELECT * FROM deals WHERE rowid IN ({', '.join('?' for _ in ranked)})", ranked)}
+            rows = [self._to_record(by_rowid[rowid]) for rowid in ranked if rowid in by_rowid]
+
+        # Exact, case-sensitive Id / EnvelopeId point lookups for any word of the query
+        # (the FTS tokenizer lowercases and splits ids, which can miss or over-match them)
+        if not rows:
+            seen = set()
+            for word in query.split():
+                for record in self.get_by_opportunity(word) or [r for r in [self.get_by_envelope(word)] if r]:
+                    key = (record.get("Id"), record.get("EnvelopeId"), record.get("CloseDate"))
+                    if key not in seen:
+                        seen.add(key)
+                        rows.append(record)
+            rows = rows[:limit or None]
+        return rows
+
+    def _match_rowids(self, terms, limit):
+        """
+        Best 'limit' rowids matching every term, ordered by bm25 (newest first on ties): whole words
+        first, topped up with prefix matches. bm25 scores every row it orders, so only the newest
+        RANK_WINDOW matches are ranked: a query matching fewer records is ranked in full, a very
+        common word (100k matches) costs a few ms instead of a few hundred. A prefix query merges
+        the postings of every token it covers, so it only runs when the whole-word matches fall short.
+        """
+        sql = ("SELECT rowid FROM (SELECT rowid, bm25(deals_fts) AS score FROM deals_fts WHERE deals_fts MATCH ? "
+               "ORDER BY rowid DESC LIMIT ?) ORDER BY score, rowid DESC LIMIT ?")
+        window = max(self.RANK_WINDOW, limit)
+        conn = self._conn()
+        rowids = [row[0] for row in conn.execute(sql, (" AND ".join(f'"{t}"' for t in terms), window, limit))]
+        if len(rowids) < limit:
+            exact = set(rowids)
+            prefixed = conn.execute(sql, (" AND ".join(f'"{t}"*' for t in terms), window, limit))
+            rowids += [row[0] for row in prefixed if row[0] not in exact][:limit - len(rowids)]
+        return rowids
+
+    def add_listener(self, fn):
+        self._listeners.append(fn)
+
+
+def open_history_store(backend=None):
+    """Factory for the configured backend: 'sqlite' (default) or 'jsonl'."""
+    backend = (backend or os.getenv("HISTORY_BACKEND", "sqlite")).lower()
+    if backend == "jsonl":
+        return LedgerHistoryStore()
+    return SqliteHistoryStore(path=os.getenv("HISTORY_DB_FILE", "sow_history.db"))
+
+
+# --- LLM PROMPT CONTEXT ---
+
+_CONTEXT_STOPWORDS = {
+    "a", "about", "all", "an", "and", "any", "are", "can", "did", "do", "does", "for", "from", "give", "has",
+    "have", "hi", "how", "i", "in", "is", "it", "me", "my", "of", "on", "or", "please", "send", "sent", "show",
+    "sow", "sows", "that", "the", "to", "was", "we", "what", "when", "which", "who", "with", "you", "link", "deal", "deals"
+}
+
+
+def _compact_history_line(record):
+    """One short line per deal, e.g. '2025-11-25 | United Oil Install | $250000 | Avi Green <avi@uo.com> | SOW Sent | env=1a2b... | opp=006...'"""
+    return " | ".join([
+        str(record.get("CloseDate", "")),
+        str(record.get("Name", "")),
+        f"${record.get('Amount', '')}",
+        f"{record.get('PrimaryContactName', '')} <{record.get('PrimaryContactEmail', '')}>",
+        str(record.get("Status", "")),
+        f"env={record.get('EnvelopeId', 'N/A')}",
+        f"opp={record.get('Id', '')}",
+    ])
+
+
+def select_history_context(store, message, k=10, token_budget=600):
+    """
+    Picks the history records most relevant to 'message' and renders them one per line.
+
+    Records are ranked lexically (any message word, stopwords removed, matched against every
+    searchable field); remaining slots are filled with the newest deals. Lines are added until
+    'k' records or roughly 'token_budget' tokens (~4 characters per token) are used.
+    """
+    terms = [t for t in _tokenize(message) if t not in _CONTEXT_STOPWORDS and len(t) > 1]
+    picked = store.search(" ".join(terms), limit=k, match_any=True) if terms else []
+
+    if len(picked) < k:
+        seen = {(r.get("Id"), r.get("EnvelopeId")) for r in picked}
+        picked += [r for r in store.records(limit=k * 2) if (r.get("Id"), r.get("EnvelopeId")) not in seen][:k - len(picked)]
+
+    lines, used = [], 0
+    for record in picked:
+        line = _compact_history_line(record)
+        cost = len(line) // 4 + 1
+        if used + cost > token_budget:
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(lines) if lines else "(no deals in history yet)"
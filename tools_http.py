@@ -0,0 +1,268 @@
+# tools_http.py
+import os
+import re
+import time
+import uuid
+import random
+import threading
+import email.utils
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from tools_concurrency import dependency_limits, rate_limits
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+STREAM_CHUNK_SIZE = 1024 * 1024  # 1 MB
+
+# Collapses ids in URL paths so latency is grouped per endpoint, not per envelope
+_ID_SEGMENT = re.compile(r"/(?:[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|[0-9a-zA-Z]{15,18}|\d+)(?=/|$)")
+
+
+class LimitedHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter that takes a rate-limit token and holds a per-dependency concurrency slot
+    (see tools_concurrency) while each request is sent, then reports the response headers back.
+    """
+
+    def __init__(self, dependency=None, **kwargs):
+        self.dependency = dependency
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if not self.dependency:
+            return super().send(request, **kwargs)
+        # Wait for a token before taking a slot, so throttled callers don't hold connections
+        rate_limits.acquire(self.dependency)
+        with dependency_limits.slot(self.dependency):
+            response = super().send(request, **kwargs)
+        rate_limits.observe(self.dependency, response.status_code, response.headers)
+        return response
+
+
+def rate_limited_httpx_client(dependency, timeout=None):
+    """
+    httpx.Client for SDKs built on httpx (openai / AzureChatOpenAI): every request, including the
+    SDK's own retries, goes through the rate-limit scheduler and reports its headers back.
+    """
+    import httpx  # Only needed by the LLM client
+
+    def on_request(request):
+        rate_limits.acquire(dependency)
+
+    def on_response(response):
+        rate_limits.observe(dependency, response.status_code, response.headers)
+
+    return httpx.Client(
+        timeout=timeout or httpx.Timeout(float(os.getenv("LLM_READ_TIMEOUT", "600")), connect=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))),
+        event_hooks={"request": [on_request], "response": [on_response]}
+    )
+
+
+class HttpTransport:
+    """
+    Pooled, keep-alive HTTP client for raw REST calls.
+
+    - One requests.Session per transport, so TLS connections are reused across tool calls.
+    - Every call gets a (connect, read) timeout.
+    - 429/5xx responses are retried with jittered exponential backoff, honouring Retry-After.
+    - Latency is recorded per endpoint and exposed through stats().
+    - 'dependency' caps concurrent requests across all callers (DEP_CONCURRENCY_<NAME>) and
+      schedules them against that service's rate limit (RATE_LIMIT_<NAME>).
+    """
+
+    def __init__(self, name, pool_size=None, timeout=None, max_retries=None, backoff_base=0.5, backoff_cap=20.0, dependency=None):
+        self.name = name
+        self.dependency = dependency
+        self.pool_size = pool_size or int(os.getenv("HTTP_POOL_SIZE", "20"))
+        self.timeout = timeout or (float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")), float(os.getenv("HTTP_READ_TIMEOUT", "60")))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("HTTP_MAX_RETRIES", "3"))
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        self.session = requests.Session()
+        adapter = LimitedHTTPAdapter(dependency, pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._stats_lock = threading.Lock()
+        self._latency = {}
+
+    # --- PUBLIC API ---
+
+    def request(self, method, url, endpoint=None, timeout=None, retry_non_idempotent=False, **kwargs):
+        """
+        Sends a request through the shared pool and returns the requests.Response.
+        'endpoint' is an optional label for the latency stats (defaults to METHOD /path/{id}).
+        Network errors are re-raised once retries are exhausted, like requests itself.
+        """
+        method = method.upper()
+        label = endpoint or f"{method} {_ID_SEGMENT.sub('/{id}', urlparse(url).path)}"
+        can_retry = retry_non_idempotent or method in IDEMPOTENT_METHODS
+        attempt = 0
+
+        while True:
+            if attempt and hasattr(kwargs.get("data"), "seek"):
+                kwargs["data"].seek(0)  # Streamed bodies must be rewound before a retry
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(label, time.monotonic() - started, error=True)
+                if not can_retry or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                print(f"⚠️ [{self.name}] {label} failed ({type(e).__name__}), retrying in {delay:.1f}s...")
+            else:
+                self._record(label, time.monotonic() - started, error=response.status_code >= 400)
+                retryable = response.status_code == 429 or (response.status_code in RETRY_STATUS_CODES and can_retry)
+                if not retryable or attempt >= self.max_retries:
+                    return response
+                delay = self._retry_after(response) or self._backoff(attempt)
+                print(f"⚠️ [{self.name}] {label} returned {response.status_code}, retrying in {delay:.1f}s...")
+                response.close()
+
+            attempt += 1
+            self._record_retry(label)
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def stats(self):
+        """Per-endpoint call counts and latency (milliseconds)."""
+        with self._stats_lock:
+            out = {}
+            for label, s in self._latency.items():
+                out[label] = {
+                    "calls": s["calls"],
+                    "errors": s["errors"],
+                    "retries": s["retries"],
+                    "avg_ms": round(1000 * s["total"] / s["calls"], 1) if s["calls"] else 0,
+                    "max_ms": round(1000 * s["max"], 1),
+                }
+            return out
+
+    # --- INTERNALS ---
+
+    def _backoff(self, attempt):
+        # "Full jitter": random delay between 0 and the exponential ceiling
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+
+    def _retry_after(self, response):
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        try:
+            return min(float(value), self.backoff_cap)
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value).timestamp()
+            return min(max(retry_at - time.time(), 0), self.backoff_cap)
+        except (TypeError, ValueError):
+            return None
+
+    def _entry(self, label):
+        return self._latency.setdefault(label, {"calls": 0, "errors": 0, "retries": 0, "total": 0.0, "max": 0.0})
+
+    def _record(self, label, elapsed, error=False):
+        with self._stats_lock:
+            s = self._entry(label)
+            s["calls"] += 1
+            s["total"] += elapsed
+            s["max"] = max(s["max"], elapsed)
+            if error:
+                s["errors"] += 1
+
+    def _record_retry(self, label):
+        with self._stats_lock:
+            self._entry(label)["retries"] += 1
+
+
+class MultipartFileStream:
+    """
+    File-like multipart/form-data body that streams a large file from disk.
+
+    requests sends objects with read() + __len__ chunk by chunk with a fixed Content-Length,
+    so the upload never holds more than one chunk of the file in memory.
+    parts: list of (headers_text, bytes_or_fileobj). File objects must be seekable.
+    """
+
+    def __init__(self, parts, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self._segments = []
+        for headers_text, payload in parts:
+            self._segments.append(f"--{self.boundary}\r\n{headers_text}\r\n\r\n".encode("utf-8"))
+            self._segments.append(payload)
+            self._segments.append(b"\r\n")
+        self._segments.append(f"--{self.boundary}--\r\n".encode("utf-8"))
+        self._length = sum(self._segment_size(s) for s in self._segments)
+        self.seek(0)
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def seek(self, position):
+        if position != 0:
+            raise ValueError("MultipartFileStream can only be rewound to the start.")
+        self._index = 0
+        self._offset = 0
+        for segment in self._segments:
+            if hasattr(segment, "seek"):
+                segment.seek(0)
+
+    def read(self, size=-1):
+        size = self._length if size is None or size < 0 else size
+        out = []
+        while size > 0 and self._index < len(self._segments):
+            segment = self._segments[self._index]
+            if isinstance(segment, bytes):
+                piece = segment[self._offset:self._offset + size]
+                self._offset += len(piece)
+                done = self._offset >= len(segment)
+            else:
+                piece = segment.read(size)
+                done = not piece or len(piece) < size
+            out.append(piece)
+            size -= len(piece)
+            if done:
+                self._index += 1
+                self._offset = 0
+        return b"".join(out)
+
+    @staticmethod
+    def _segment_size(segment):
+        if isinstance(segment, bytes):
+            return len(segment)
+        segment.seek(0, os.SEEK_END)
+        size = segment.tell()
+        segment.seek(0)
+        return size
+
+
+# Shared transport for every raw DocuSign REST call
+docusign_http = HttpTransport(name="docusign", dependency="docusign")
+
+# Shared transport for raw Salesforce REST calls that simple_salesforce does not cover (Bulk 2.0, multipart)
+salesforce_http = HttpTransport(name="salesforce", dependency="salesforce")